@@ -0,0 +1,101 @@
+# admission.py
+"""
+Cancellation tokens and admission control for generations.
+
+CancelToken is a per-request flag the decode loop polls between tokens
+(StoppingCriteria in generate(), a check per step in the scheduler), so a
+request whose consumer went away stops within one token instead of running to
+max_new_tokens.
+
+AdmissionController caps how many generations run at once. Up to `max_queue`
+more wait in FIFO order (optionally with a timeout); beyond that a request is
+rejected immediately, so a burst degrades into bounded queueing plus fast
+"busy" errors instead of an ever-growing pile of threads.
+"""
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+class Rejected(RuntimeError):
+    """Queue full or queue wait timed out."""
+
+class AdmissionController:
+    def __init__(self, max_concurrency: int = 8, max_queue: int = 32, timeout_s: Optional[float] = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout_s = timeout_s
+        self.active = 0
+        self.stats = {"admitted": 0, "rejected": 0, "timeouts": 0, "cancelled": 0,
+                      "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+        self._waiters: "deque[threading.Event]" = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self, cancel: Optional[CancelToken] = None) -> Optional[float]:
+        """Block for a slot; returns the queue wait in ms, or None if cancelled while waiting.
+        Raises Rejected when the queue is full or the wait exceeds timeout_s."""
+        t0 = time.perf_counter()
+        with self._lock:
+            if self.active < self.max_concurrency and not self._waiters:
+                self.active += 1
+                return self._admitted(t0)
+            if len(self._waiters) >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise Rejected(f"busy: {self.active} running, {len(self._waiters)} queued")
+            ready = threading.Event()
+            self._waiters.append(ready)
+
+        deadline = t0 + self.timeout_s if self.timeout_s else None
+        while not ready.wait(0.05):
+            gone = cancel is not None and cancel.cancelled
+            late = deadline is not None and time.perf_counter() > deadline
+            if not (gone or late):
+                continue
+            with self._lock:
+                if ready.is_set():
+                    break  # the slot arrived meanwhile; the caller sees the cancel itself
+                self._waiters.remove(ready)
+                self.stats["cancelled" if gone else "timeouts"] += 1
+            if gone:
+                return None
+            raise Rejected(f"busy: waited {self.timeout_s:.0f}s for a free slot")
+        with self._lock:
+            return self._admitted(t0)
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()  # hand the slot straight to the oldest waiter
+            else:
+                self.active -= 1
+
+    def _admitted(self, t0: float) -> float:
+        wait_ms = (time.perf_counter() - t0) * 1000.0
+        self.stats["admitted"] += 1
+        self.stats["wait_ms_total"] += wait_ms
+        self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], wait_ms)
+        return wait_ms
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            admitted = self.stats["admitted"]
+            return {
+                "active": self.active, "queued": len(self._waiters),
+                "max_concurrency": self.max_concurrency, "max_queue": self.max_queue,
+                **{k: v for k, v in self.stats.items() if k != "wait_ms_total"},
+                "mean_wait_ms": self.stats["wait_ms_total"] / admitted if admitted else 0.0,
+            }
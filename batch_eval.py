@@ -0,0 +1,307 @@
+# batch_eval.py
+"""
+Bulk MedMCQA evaluation built on test_adapter.py.
+
+Streams questions from a JSONL or CSV file (MedMCQA columns: id, question,
+opa..opd, cop, subject_name), groups them into length-bucketed dynamic batches
+with left padding, and appends every prediction to a checkpoint file so a
+killed run resumes where it stopped. Writes accuracy, per-subject breakdown
+and throughput to summary.json.
+
+--mode score skips decoding: one forward pass per batch and a comparison of
+the A/B/C/D letter logits (letter_scorer.py), plus calibration stats.
+
+With --token-cache (the default), prompts come pre-tokenized from
+dataset_cache.py: built once per tokenizer / template / prompt / data file,
+then read as length-sorted batches straight from the memory-mapped arrays.
+
+    python batch_eval.py --base Qwen/Qwen2.5-7B-Instruct \\
+        --adapter Pk3112/medmcqa-lora-qwen2.5-7b-instruct \\
+        --data medmcqa_val.jsonl --out eval_qwen --mode answer --load-in-4bit
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List
+
+import numpy as np
+import torch
+
+import letter_scorer
+from test_adapter import ANSWER_ONLY_PROMPT, EXPLAIN_PROMPT, build_chat_text, load_base_and_adapter
+
+LETTERS = "ABCD"
+_ANSWER_RE = re.compile(r"\b(?i:answer)\s*(?:is\s*)?:?\s*\(?([A-D])\b")
+_BARE_RE = re.compile(r"^\W*([A-D])\W*$")   # the whole reply is one letter ("B", "(B).")
+_PAREN_RE = re.compile(r"\(([A-D])\)")      # "(B)"; a bare \bA\b would match the article in free text
+
+# ---- input ----
+def read_rows(path: str) -> Iterator[Dict]:
+    """Yield raw rows from .jsonl or .csv without loading the whole file."""
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+def gold_letter(cop, one_based: bool = False):
+    """MedMCQA `cop` -> letter. HF dataset uses 0..3, the original JSON 1..4; letters pass through."""
+    if cop is None or cop == "":
+        return None
+    s = str(cop).strip().upper()
+    if s in LETTERS:
+        return s
+    idx = int(float(s)) - (1 if one_based else 0)
+    return LETTERS[idx] if 0 <= idx < 4 else None
+
+def parse_letter(text: str):
+    m = _ANSWER_RE.search(text) or _BARE_RE.match(text) or _PAREN_RE.search(text)
+    return m.group(1) if m else None
+
+def _row_id(row: Dict, index: int) -> str:
+    return str(row.get("id") or index)
+
+# ---- checkpoint ----
+def load_done(pred_path: str) -> Dict[str, Dict]:
+    """Read finished predictions; drop a half-written last line left by a killed run."""
+    done = {}
+    if not os.path.exists(pred_path):
+        return done
+    good = 0
+    with open(pred_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            done[rec["id"]] = rec
+            good += len(line)
+    if good < os.path.getsize(pred_path):
+        with open(pred_path, "r+b") as f:
+            f.truncate(good)
+    return done
+
+# ---- batching ----
+def bucket_batches(items: List[Dict], batch_size: int, max_batch_tokens: int) -> Iterator[List[Dict]]:
+    """Sort a window by prompt length, then cut batches so batch * longest <= token budget."""
+    items = sorted(items, key=lambda it: it["n_prompt"])
+    batch: List[Dict] = []
+    for it in items:
+        longest = max([b["n_prompt"] for b in batch] + [it["n_prompt"]])
+        if batch and (len(batch) >= batch_size or longest * (len(batch) + 1) > max_batch_tokens):
+            yield batch
+            batch = []
+        batch.append(it)
+    if batch:
+        yield batch
+
+def _count_new_tokens(row: torch.Tensor, eos_id, pad_id) -> int:
+    """Generated tokens up to and including EOS; finished rows are right-filled with pad."""
+    ids = row.tolist()
+    for i, t in enumerate(ids):
+        if t == eos_id:
+            return i + 1
+        if t == pad_id:
+            return i
+    return len(ids)
+
+def generate_batch(model, tok, texts: List[str], max_new_tokens: int):
+    """Left-padded greedy generation; returns (responses, new_token_counts)."""
+    inputs = tok(texts, return_tensors="pt", padding=True, add_special_tokens=False)
+    return generate_ids(model, tok, inputs["input_ids"], inputs["attention_mask"], max_new_tokens)
+
+def generate_ids(model, tok, input_ids: torch.Tensor, attention_mask: torch.Tensor, max_new_tokens: int):
+    """generate_batch on already tokenized, left-padded prompts."""
+    inputs = {"input_ids": input_ids.to(model.device), "attention_mask": attention_mask.to(model.device)}
+    with torch.no_grad():
+        out = model.generate(
+            **inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=tok.pad_token_id,
+            eos_token_id=tok.eos_token_id,
+        )
+    new = out[:, inputs["input_ids"].shape[1]:]
+    responses = tok.batch_decode(new, skip_special_tokens=True)
+    counts = [_count_new_tokens(r, tok.eos_token_id, tok.pad_token_id) for r in new]
+    return [r.strip() for r in responses], counts
+
+# ---- summary ----
+def summarize(done: Dict[str, Dict], run_stats: Dict) -> Dict:
+    per_subject = defaultdict(lambda: {"n": 0, "correct": 0})
+    n = correct = 0
+    for rec in done.values():
+        if rec.get("gold") is None:
+            continue
+        n += 1
+        correct += int(rec["correct"])
+        s = per_subject[rec.get("subject") or "unknown"]
+        s["n"] += 1
+        s["correct"] += int(rec["correct"])
+    for s in per_subject.values():
+        s["accuracy"] = 100.0 * s["correct"] / s["n"]
+    secs = run_stats["seconds"] or 1e-9
+    summary = {
+        "n_scored": n,
+        "accuracy": 100.0 * correct / n if n else None,
+        "per_subject": dict(sorted(per_subject.items())),
+        "throughput": {
+            "questions": run_stats["questions"],
+            "seconds": run_stats["seconds"],
+            "questions_per_s": run_stats["questions"] / secs,
+            "gen_tokens_per_s": run_stats["gen_tokens"] / secs,
+            "prompt_tokens_per_s": run_stats["prompt_tokens"] / secs,
+        },
+    }
+    scored = [r for r in done.values() if r.get("logits") and r.get("gold") is not None]
+    if scored:
+        raw = torch.tensor([r["logits"] for r in scored])
+        gold = [letter_scorer.LETTERS.index(r["gold"]) for r in scored]
+        t_fit = letter_scorer.fit_temperature(raw, gold)
+        summary["calibration"] = {
+            "temperature": run_stats.get("temperature", 1.0),
+            "ece": letter_scorer.expected_calibration_error(
+                torch.softmax(raw / run_stats.get("temperature", 1.0), -1), gold),
+            "fitted_temperature": t_fit,
+            "ece_fitted": letter_scorer.expected_calibration_error(torch.softmax(raw / t_fit, -1), gold),
+        }
+    return summary
+
+# ---- driver ----
+def run_eval(model, tok, args) -> Dict:
+    os.makedirs(args.out, exist_ok=True)
+    pred_path = os.path.join(args.out, "predictions.jsonl")
+    done = load_done(pred_path)
+    if done:
+        print(f"[eval] resuming: {len(done)} predictions already in {pred_path}")
+
+    template = EXPLAIN_PROMPT if args.mode == "explain" else ANSWER_ONLY_PROMPT
+    stats = {"questions": 0, "gen_tokens": 0, "prompt_tokens": 0, "seconds": 0.0, "temperature": args.temperature}
+    letter_ids = letter_scorer.letter_token_ids(tok) if args.mode == "score" else None
+
+    def _run(input_ids, attention_mask):
+        if args.mode != "score":
+            responses, counts = generate_ids(model, tok, input_ids, attention_mask, args.max_new)
+            return [{"response": r, "pred": parse_letter(r), "gen_tokens": n} for r, n in zip(responses, counts)]
+        letters, probs, raw = letter_scorer.score_inputs(model, input_ids, attention_mask, letter_ids, args.temperature)
+        return [{"response": f"Answer: {l}", "pred": l, "gen_tokens": 0,
+                 "probs": [round(x, 6) for x in p], "logits": [round(x, 4) for x in z]}
+                for l, p, z in zip(letters, probs.tolist(), raw.tolist())]
+
+    def _batch(batch, input_ids, attention_mask, fout):
+        t0 = time.perf_counter()
+        outputs = _run(input_ids, attention_mask)
+        stats["seconds"] += time.perf_counter() - t0
+        for it, res in zip(batch, outputs):
+            rec = {"id": it["id"], "subject": it["subject"], "gold": it["gold"],
+                   "correct": res["pred"] is not None and res["pred"] == it["gold"],
+                   "prompt_tokens": it["n_prompt"], **res}
+            fout.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            done[rec["id"]] = rec
+            stats["questions"] += 1
+            stats["gen_tokens"] += res["gen_tokens"]
+            stats["prompt_tokens"] += it["n_prompt"]
+        fout.flush()
+        os.fsync(fout.fileno())  # checkpoint: a kill loses at most the batch in flight
+        print(f"[eval] {len(done)} done • {stats['questions'] / stats['seconds']:.2f} q/s")
+
+    def _flush(window, fout):
+        lengths = tok([it["text"] for it in window], add_special_tokens=False)["input_ids"]
+        for it, ids in zip(window, lengths):
+            it["n_prompt"] = len(ids)
+        for batch in bucket_batches(window, args.batch_size, args.max_batch_tokens):
+            inputs = tok([it["text"] for it in batch], return_tensors="pt", padding=True, add_special_tokens=False)
+            _batch(batch, inputs["input_ids"], inputs["attention_mask"], fout)
+
+    def _cached(fout):
+        import dataset_cache  # imports this module; deferred to avoid the cycle
+
+        # pre-tokenized rows, length-sorted over the whole file instead of per read-ahead window
+        ds = dataset_cache.build(args.data, tok, args.mode, args.token_cache, args.cop_one_based)
+        todo = np.arange(min(len(ds), args.limit) if args.limit else len(ds))
+        todo = todo[np.fromiter((ds.row_ids[i] not in done for i in todo), dtype=bool, count=len(todo))]
+        for idx in ds.batches(args.batch_size, args.max_batch_tokens, todo):
+            input_ids, attention_mask = ds.collate(idx, tok.pad_token_id)
+            batch = [{"id": ds.row_ids[i], "subject": ds.subject(i), "gold": ds.gold(i), "n_prompt": int(ds.lengths[i])}
+                     for i in idx.tolist()]
+            _batch(batch, torch.from_numpy(input_ids), torch.from_numpy(attention_mask), fout)
+
+    def _streamed(fout):
+        window: List[Dict] = []
+        for i, row in enumerate(read_rows(args.data)):
+            if args.limit and i >= args.limit:
+                break
+            rid = _row_id(row, i)
+            if rid in done:
+                continue
+            prompt = template.format(question=row["question"], opa=row["opa"], opb=row["opb"],
+                                     opc=row["opc"], opd=row["opd"])
+            text = build_chat_text(tok, prompt)
+            if args.mode == "score":
+                text += letter_scorer.ANSWER_PREFIX  # the scored token is the letter right after it
+            window.append({"id": rid, "subject": row.get("subject_name"),
+                           "gold": gold_letter(row.get("cop"), args.cop_one_based), "text": text})
+            if len(window) >= args.window:
+                _flush(window, fout)
+                window = []
+        if window:
+            _flush(window, fout)
+
+    with open(pred_path, "a", encoding="utf-8") as fout:
+        (_cached if args.token_cache else _streamed)(fout)
+
+    summary = summarize(done, stats)
+    summary.update({"base": args.base, "adapter": args.adapter, "mode": args.mode, "data": args.data})
+    with open(os.path.join(args.out, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+def main():
+    ap = argparse.ArgumentParser(description="Bulk MedMCQA evaluation with dynamic batching and resume")
+    ap.add_argument("--base", required=True)
+    ap.add_argument("--adapter", required=True)
+    ap.add_argument("--data", required=True, help="JSONL or CSV with question, opa..opd, cop, subject_name")
+    ap.add_argument("--out", required=True, help="Output dir (predictions.jsonl checkpoint + summary.json)")
+    ap.add_argument("--mode", choices=["answer", "explain", "score"], default="answer",
+                    help="score = single forward pass over the A/B/C/D letter logits (no decoding)")
+    ap.add_argument("--temperature", type=float, default=1.0, help="score mode: softmax temperature for probabilities")
+    ap.add_argument("--load-in-4bit", action="store_true")
+    ap.add_argument("--merged-dir", default="merged", help="merge_export.py --root (its output cache): a fresh artifact there is "
+                         "loaded instead of base + adapter, a stale one is ignored ('' = don't look)")
+    ap.add_argument("--max-new", type=int, default=None, help="default: 8 for answer, 256 for explain")
+    ap.add_argument("--batch-size", type=int, default=16)
+    ap.add_argument("--max-batch-tokens", type=int, default=8192, help="cap on batch_size * longest prompt")
+    ap.add_argument("--window", type=int, default=256, help="rows read ahead and length-sorted together")
+    ap.add_argument("--limit", type=int, default=0)
+    ap.add_argument("--cop-one-based", action="store_true", help="cop is 1..4 (original MedMCQA JSON)")
+    ap.add_argument("--token-cache", default=".cache/tokenized",
+                    help="pre-tokenized prompt cache dir (dataset_cache.py); '' = tokenize while reading")
+    args = ap.parse_args()
+    if args.max_new is None:
+        args.max_new = 8 if args.mode == "answer" else 256
+
+    model, tok = load_base_and_adapter(args.base, args.adapter, args.load_in_4bit, args.merged_dir)
+    summary = run_eval(model, tok, args)
+
+    acc = summary["accuracy"]
+    tp = summary["throughput"]
+    print(f"\nAccuracy: {acc:.2f}% on {summary['n_scored']}" if acc is not None else "\nAccuracy: n/a")
+    for name, s in summary["per_subject"].items():
+        print(f"  {name}: {s['accuracy']:.2f}% ({s['correct']}/{s['n']})")
+    print(f"Throughput: {tp['questions_per_s']:.2f} q/s • {tp['gen_tokens_per_s']:.1f} tok/s")
+    if "calibration" in summary:
+        c = summary["calibration"]
+        print(f"Calibration: ECE {c['ece']:.3f} @T={c['temperature']:.2f} • "
+              f"fitted T={c['fitted_temperature']:.2f} (ECE {c['ece_fitted']:.3f})")
+
+if __name__ == "__main__":
+    main()
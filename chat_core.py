@@ -1,8 +1,47 @@
 # chat_core.py
+import hashlib
+import json
+import re
+import time
+import uuid
+from bisect import bisect_left
+from itertools import accumulate
 import streamlit as st
-import ollama
-from config import MODEL, MAX_TURNS, BUDGET_CHARS, BACKEND, HF_BASE_ID, HF_ADAPTER_PATH, HF_LOAD_IN_4BIT, HF_MAX_NEW_TOKENS
-from hf_backend import stream_generate, get_last_metrics
+from config import MODEL, MODEL_CHOICES, MAX_TURNS, CONTEXT_TOKENS, OLLAMA_NUM_CTX, BACKEND, HF_LOAD_IN_4BIT, HF_MAX_NEW_TOKENS
+from config import HF_CONTINUOUS_BATCHING, HF_MAX_BATCH_SIZE, HF_PREFIX_CACHE_MB, HF_MODEL_MEMORY_GB, HF_MERGED_DIR
+from config import HF_STATIC_DECODE, HF_STATIC_MIN_BUCKET, HF_COMPILE_DECODE
+from config import HF_SPECULATIVE, HF_DRAFT_MODEL_ID, HF_SPEC_NUM_DRAFT, HF_SPEC_MAX_DRAFT, HF_SPEC_NGRAM
+from config import LETTER_SCORE_TEMPERATURE, ANSWER_ONLY_MAX_TOKENS
+from config import STOP_STRINGS, STOP_REGEXES, EXPLANATION_MAX_SENTENCES, ANSWER_STOP_REGEX
+from config import RESPONSE_CACHE, RESPONSE_CACHE_PATH, RESPONSE_CACHE_MEMORY_ITEMS, RESPONSE_CACHE_MAX_ITEMS, RESPONSE_CACHE_TTL_S
+from config import SERVER_URL, SERVER_REQUEST_TIMEOUT_S, SERVER_POOL_CONNECTIONS, OLLAMA_ASYNC
+from config import SEMANTIC_CACHE, SEMANTIC_CACHE_DIR, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_DIM, SEMANTIC_CACHE_TOP_K
+from config import METRICS_HOST, METRICS_PORT, TRACE_PATH
+from admission import CancelToken, Rejected
+from response_cache import ResponseCache, make_key
+from semantic_cache import SemanticCache, parse_mcq
+from stopping import StopMatcher
+import tracing
+from startup import Warmup, load_hf_backend, load_ollama_backend, load_worker_pool
+from tracing import Trace
+
+_response_cache = {"cache": None, "semantic": None}
+_http = {"client": None}  # pooled keep-alive client for BACKEND == "server"
+tracing.configure(TRACE_PATH)
+if METRICS_PORT:
+    tracing.start_metrics_server(METRICS_HOST, METRICS_PORT)  # once per process, shared by all sessions
+
+@st.cache_resource(show_spinner=False)
+def start_warmup() -> Warmup:
+    """Background cold start of the default model, once per process and shared by all sessions."""
+    return Warmup(dict(MODEL_CHOICES[MODEL], label=MODEL)).start()
+
+def _target():
+    """Model picked in the sidebar for this request: {"label", "base", "adapter"}."""
+    label = st.session_state.get("model_choice", MODEL)
+    if label not in MODEL_CHOICES:
+        label = MODEL
+    return dict(MODEL_CHOICES[label], label=label)
 
 def _cap_turns(messages):
     """Keep only the last MAX_TURNS user+assistant turns (preserve optional system at front)."""
@@ -14,28 +53,89 @@ def _cap_turns(messages):
         return head + tail
     return head + tail[-2 * MAX_TURNS :]
 
-def _trim_for_model(messages, budget_chars: int = BUDGET_CHARS):
+def _trim_for_model(messages, budget_tokens: int, count_tokens):
     """
-    Returns (trimmed_messages, before_chars, after_chars).
-    Char-based safety trim to prevent huge contexts.
+    Returns (trimmed_messages, before_tokens, after_tokens).
+    Drops the oldest user+assistant pairs (system kept) until the prompt fits
+    budget_tokens. Uses prefix sums + binary search over the per-message counts,
+    so it is O(n) in history length; the last message is always kept.
     """
-    def total_chars(ms):
-        return sum(len(m.get("content", "")) for m in ms)
-
-    before = total_chars(messages)
-    if before <= budget_chars:
-        return messages, before, before
-
     head = messages[:1] if messages and messages[0].get("role") == "system" else []
     tail = messages[1:] if head else messages[:]
+    head_tokens = sum(count_tokens(m) for m in head)
+    prefix = list(accumulate((count_tokens(m) for m in tail), initial=0))
+
+    before = head_tokens + prefix[-1]
+    if before <= budget_tokens or not tail:
+        return messages, before, before
 
-    while tail and (total_chars(head + tail) > budget_chars):
-        tail = tail[2:] if len(tail) >= 2 else tail[1:]
+    # candidate drop counts: whole pairs (0, 2, 4, ...), at most everything but the last message
+    n = len(tail)
+    drops = sorted(set(range(0, n, 2)) | {n - 1})
+    excess = before - budget_tokens
+    i = bisect_left([prefix[k] for k in drops], excess)
+    k = drops[min(i, len(drops) - 1)]
 
-    trimmed = head + tail
-    after = total_chars(trimmed)
+    trimmed = head + tail[k:]
+    after = before - prefix[k]
     return trimmed, before, after
 
+def _token_counter():
+    """
+    Per-message token counter with a session-scoped cache keyed by (role, content hash),
+    so each message is tokenized once. Returns (count_fn, budget_tokens).
+    """
+    target = _target()
+    if BACKEND == "ollama":
+        tag, budget = f"ollama:{target['label']}", OLLAMA_NUM_CTX - HF_MAX_NEW_TOKENS
+
+        def _count(text):
+            return (len(text) + 3) // 4 + 4  # no local tokenizer: ~4 chars/token + template overhead
+    elif BACKEND in ("server", "pool"):
+        # the model lives in another process: tokenizer.json only, no torch in the UI (token_budget.py)
+        import token_budget
+
+        _count, window = token_budget.counter(target["base"])
+        tag, budget = f"{BACKEND}:{target['base']}", min(window, CONTEXT_TOKENS or 10 ** 9) - HF_MAX_NEW_TOKENS
+    else:
+        hf = load_hf_backend()
+        tok = hf.get_tokenizer(target["base"])
+        overhead = hf.message_overhead(tok)
+        window = min(hf.context_window(target["base"]), CONTEXT_TOKENS or 10 ** 9)
+        tag, budget = f"hf:{target['base']}", window - HF_MAX_NEW_TOKENS
+
+        def _count(text):
+            return len(tok(text, add_special_tokens=False).input_ids) + overhead
+
+    store = st.session_state.get("__token_counts")
+    if not store or store.get("tag") != tag:
+        store = {"tag": tag, "counts": {}}
+        st.session_state["__token_counts"] = store
+    counts = store["counts"]
+
+    def count_tokens(m):
+        content = m.get("content", "")
+        key = (m.get("role"), hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest())
+        n = counts.get(key)
+        if n is None:
+            n = counts[key] = _count(content)
+        return n
+
+    return count_tokens, budget
+
+def _cancel_token():
+    """
+    Fresh cancel token for this session's request. A session runs one request at a
+    time, so the previous one's consumer is gone (rerun, new message): cancel it.
+    "Clear chat" cancels the current one (ui.render_sidebar).
+    """
+    old = st.session_state.get("__cancel")
+    if old is not None:
+        old.cancel("superseded")
+    token = CancelToken()
+    st.session_state["__cancel"] = token
+    return token
+
 def _apply_system(messages, use_sys: bool, sys_text: str):
     """Prepend system message (not shown in chat) if enabled."""
     if not use_sys or not sys_text.strip():
@@ -51,133 +151,388 @@ def _prepare_for_model(use_system: bool, system_prompt_text: str):
     """
     msgs = _apply_system(st.session_state.messages, use_system, system_prompt_text)
     msgs = _cap_turns(msgs)
-    trimmed, before, after = _trim_for_model(msgs)
-    st.session_state["__last_trim_info"] = (before, after)
+    count_tokens, budget = _token_counter()
+    trimmed, before, after = _trim_for_model(msgs, budget, count_tokens)
+    chars_before = sum(len(m.get("content", "")) for m in msgs)
+    chars_after = sum(len(m.get("content", "")) for m in trimmed)
+    st.session_state["__last_trim_info"] = (before, after, chars_before, chars_after)
     return trimmed
 
-def _save_metrics_from_chunk(chunk):
-    """Extract token/time metrics from a streaming chunk (dict or object)."""
+def _record(text: str):
+    """Keep streamed text for streamed_text(): a list append per chunk, joined once at the end."""
+    st.session_state.setdefault("__stream_parts", []).append(text)
+
+def _stop_kwargs(answer_only: bool = False):
+    regexes = list(STOP_REGEXES) + ([ANSWER_STOP_REGEX] if answer_only else [])
+    return {"stop_strings": list(STOP_STRINGS), "stop_regexes": regexes,
+            "max_sentences": None if answer_only else EXPLANATION_MAX_SENTENCES}
+
+def _ollama_options(options, answer_only: bool = False):
+    # stop strings are also enforced server-side; regex/sentence checks happen here
+    opts = dict(options or {})
+    opts.setdefault("num_ctx", OLLAMA_NUM_CTX)  # the window _trim_for_model budgets against
+    if STOP_STRINGS:
+        opts.setdefault("stop", list(STOP_STRINGS))
+    if answer_only:
+        opts.setdefault("num_predict", ANSWER_ONLY_MAX_TOKENS)
+    return opts or None
+
+def _ollama_stream(to_send, options=None, answer_only: bool = False):
+    ob = load_ollama_backend()
+    stop = StopMatcher(**_stop_kwargs(answer_only))
+    cancel = _cancel_token()
+    trace, times, final = Trace("ollama", model=_target()["label"]), [], {}
+    st.session_state["__last_metrics"] = {}
+    t0 = time.perf_counter()
     try:
-        if isinstance(chunk, dict):
-            if chunk.get("done"):
-                st.session_state["__last_metrics"] = {
-                    "prompt_eval_count": chunk.get("prompt_eval_count"),
-                    "eval_count": chunk.get("eval_count"),
-                    "prompt_eval_duration": chunk.get("prompt_eval_duration"),
-                    "eval_duration": chunk.get("eval_duration"),
-                    "total_duration": chunk.get("total_duration"),
-                }
-        else:
-            if getattr(chunk, "done", False):
-                st.session_state["__last_metrics"] = {
-                    "prompt_eval_count": getattr(chunk, "prompt_eval_count", None),
-                    "eval_count": getattr(chunk, "eval_count", None),
-                    "prompt_eval_duration": getattr(chunk, "prompt_eval_duration", None),
-                    "eval_duration": getattr(chunk, "eval_duration", None),
-                    "total_duration": getattr(chunk, "total_duration", None),
-                }
-    except Exception:
-        pass
-
-def _ollama_stream(to_send):
-    response = ollama.chat(model=MODEL, stream=True, messages=to_send)
+        response = ob.stream(_target()["label"], to_send, _ollama_options(options, answer_only), use_async=OLLAMA_ASYNC)
+        yield from _relay_ollama(ob, response, stop, cancel, trace, times, final)
+    except ob.ERRORS as e:
+        # daemon gone / stream cut: main.py's fallback continues from what was shown (streamed_text())
+        final["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        # one streamed chunk is one token, so chunk arrival times are the decode steps
+        trace.decode_timeline(t0, times)
+        trace.metrics.update(ob.metrics(final.get("chunk"), t0, times))
+        if stop.stopped:
+            trace.metrics["stop_reason"] = stop.reason
+        elif "error" in final:
+            trace.metrics["stop_reason"] = "error"
+        elif cancel.cancelled:
+            trace.metrics["stop_reason"] = "cancelled"
+        trace.finish()
+        _save_hf_metrics(trace.metrics)
+        if "error" in final:
+            st.session_state["__last_metrics"].update(interrupted=True, error=final["error"])
+
+def _relay_ollama(ob, response, stop, cancel, trace, times, final):
     for chunk in response:
-        _save_metrics_from_chunk(chunk)  # your existing function
-        token = ""
-        if isinstance(chunk, dict):
-            msg = chunk.get("message")
-            if isinstance(msg, dict):
-                token = msg.get("content", "")
-            if not token:
-                token = chunk.get("response", "")
-        else:
-            msg = getattr(chunk, "message", None)
-            if msg is not None:
-                if isinstance(msg, dict):
-                    token = msg.get("content", "")
-                else:
-                    token = getattr(msg, "content", "") or ""
-            if not token:
-                token = getattr(chunk, "response", "") or ""
+        if ob.field(chunk, "done"):
+            final["chunk"] = chunk
+        token = ob.text(chunk)
+        if token:
+            times.append(time.perf_counter())
+        token = stop.feed(token)
         if token:
-            st.session_state["full_message"] += token
+            _record(token)
             yield token
+        if stop.stopped or cancel.cancelled:
+            # closing the stream drops the HTTP connection, which aborts generation server-side
+            close = getattr(response, "close", None)
+            if close:
+                close()
+            break
+    tail = stop.flush()
+    if tail:
+        _record(tail)
+        yield tail
 
-def _ollama_once(to_send):
-    resp = ollama.chat(model=MODEL, stream=False, messages=to_send)
-    text, metrics = "", {}
-    if isinstance(resp, dict):
-        msg = resp.get("message")
-        if isinstance(msg, dict) and "content" in msg:
-            text = msg["content"]
-        elif "response" in resp:
-            text = resp["response"]
-        metrics = {
-            "prompt_eval_count": resp.get("prompt_eval_count"),
-            "eval_count": resp.get("eval_count"),
-            "prompt_eval_duration": resp.get("prompt_eval_duration"),
-            "eval_duration": resp.get("eval_duration"),
-            "total_duration": resp.get("total_duration"),
-        }
-    else:
-        msg = getattr(resp, "message", None)
-        if msg is not None:
-            if isinstance(msg, dict):
-                text = msg.get("content", "")
-            else:
-                text = getattr(msg, "content", "") or ""
-        if not text:
-            text = getattr(resp, "response", "") or ""
-        metrics = {
-            "prompt_eval_count": getattr(resp, "prompt_eval_count", None),
-            "eval_count": getattr(resp, "eval_count", None),
-            "prompt_eval_duration": getattr(resp, "prompt_eval_duration", None),
-            "eval_duration": getattr(resp, "eval_duration", None),
-            "total_duration": getattr(resp, "total_duration", None),
-        }
-    st.session_state["__last_metrics"] = metrics
-    return text, metrics
+def _ollama_once(to_send, options=None, answer_only: bool = False, partial: str = ""):
+    """Non-streamed reply. With `partial` (what an interrupted stream already showed) the
+    model continues that assistant message instead of starting over; returns the whole reply."""
+    ob = load_ollama_backend()
+    messages = list(to_send) + ([{"role": "assistant", "content": partial}] if partial else [])
+    try:
+        resp = ob.chat(_target()["label"], messages, _ollama_options(options, answer_only))
+    except ob.ERRORS as e:
+        reply = _error_reply(f"ollama error: {type(e).__name__}: {e}")
+        return (partial + "\n\n" + reply if partial else reply), st.session_state["__last_metrics"]
+    stop = StopMatcher(**_stop_kwargs(answer_only))
+    text = stop.feed(partial) + stop.feed(ob.text(resp)) + stop.flush()
+    m = ob.metrics(resp)
+    if stop.stopped:
+        m["stop_reason"] = stop.reason
+    _save_hf_metrics(m)
+    return text, st.session_state["__last_metrics"]
+
+def _session_id() -> str:
+    return st.session_state.setdefault("__session_id", uuid.uuid4().hex)
+
+def _hf_call(fn: str, to_send, trace: Trace, **kwargs):
+    """hf_backend.<fn> in this process, or on a model worker process (session affinity) for "pool"."""
+    kwargs["session"] = _session_id()  # the backend keeps this conversation's prompt token ids
+    if BACKEND == "pool":
+        return load_worker_pool().stream(fn, to_send, kwargs, session=kwargs["session"], cancel=_cancel_token(),
+                                         trace=trace)
+    return getattr(load_hf_backend(), fn)(to_send, cancel=_cancel_token(), trace=trace, **kwargs)
 
 def _hf_stream(to_send):
     # to_send is a chat list; stream_generate expects same
-    for chunk in stream_generate(
-        to_send,
-        base_id=HF_BASE_ID,
-        adapter_path=HF_ADAPTER_PATH,
+    target = _target()
+    trace = Trace("hf", model=target["label"])
+    stream = _hf_call(
+        "stream_generate", to_send, trace,
+        base_id=target["base"],
+        adapter_path=target["adapter"],
         load_in_4bit=HF_LOAD_IN_4BIT,
         max_new_tokens=HF_MAX_NEW_TOKENS,
-    ):
-        st.session_state["full_message"] += chunk
-        yield chunk
+        batching=HF_CONTINUOUS_BATCHING,
+        max_batch_size=HF_MAX_BATCH_SIZE,
+        prefix_cache_mb=HF_PREFIX_CACHE_MB,
+        memory_budget_gb=HF_MODEL_MEMORY_GB,
+        merged_dir=HF_MERGED_DIR,
+        speculative=HF_SPECULATIVE,
+        draft_model_id=HF_DRAFT_MODEL_ID,
+        num_draft_tokens=HF_SPEC_NUM_DRAFT,
+        max_draft_tokens=HF_SPEC_MAX_DRAFT,
+        spec_ngram=HF_SPEC_NGRAM,
+        static_cache=HF_STATIC_DECODE,
+        static_max_len=CONTEXT_TOKENS,
+        static_min_bucket=HF_STATIC_MIN_BUCKET,
+        compile_decode=HF_COMPILE_DECODE,
+        **_stop_kwargs(),
+    )
+    yield from _relay_hf(stream, trace)
+
+def _hf_score(to_send):
+    # answer-only: single forward pass over the letter logits, no decoding
+    target = _target()
+    trace = Trace("hf", model=target["label"])
+    stream = _hf_call(
+        "score_answer", to_send, trace,
+        base_id=target["base"],
+        adapter_path=target["adapter"],
+        load_in_4bit=HF_LOAD_IN_4BIT,
+        temperature=LETTER_SCORE_TEMPERATURE,
+        memory_budget_gb=HF_MODEL_MEMORY_GB,
+        merged_dir=HF_MERGED_DIR,
+    )
+    yield from _relay_hf(stream, trace)
+
+def _relay_hf(stream, trace):
+    try:
+        for chunk in stream:
+            _record(chunk)
+            yield chunk
+    except Rejected as e:
+        trace.metrics["stop_reason"] = "rejected"
+        yield _error_reply(str(e))
+        return
+    finally:
+        trace.finish()
+    _save_hf_metrics(trace.metrics)
+
+def _save_hf_metrics(m):
     # store metrics in the same key shape expected by your UI
-    m = get_last_metrics()
     st.session_state["__last_metrics"] = {
         "prompt_eval_count": m.get("prompt_tokens"),
         "eval_count": m.get("gen_tokens"),
         "prompt_eval_duration": int((m.get("ttft_ms") or 0) * 1e6),
         "eval_duration": int((m.get("gen_ms") or 0) * 1e6),
         "total_duration": int((m.get("wall_s") or 0) * 1e9),
+        "cached_tokens": m.get("cached_tokens"),
+        "queue_ms": m.get("queue_ms"),
+        "tok_per_s": m.get("tok_per_s"),
+        "tpot_ms": m.get("tpot_ms"),
+        "acceptance_rate": m.get("acceptance_rate"),
+        "load_ms": m.get("load_ms"),
+        "stop_reason": m.get("stop_reason"),
     }
 
-def _hf_once(to_send):
+def _hf_once(to_send, answer_only: bool = False):
     # Non-stream fallback for HF: just run a single generate call and return text+metrics.
     # We can reuse the streaming path and collect the text.
     buf = []
-    for chunk in _hf_stream(to_send):
+    for chunk in (_hf_score(to_send) if answer_only else _hf_stream(to_send)):
         buf.append(chunk)
-    return "".join(buf), get_last_metrics()
+    return "".join(buf), st.session_state.get("__last_metrics")
+
+# === server.py over HTTP ===
+def _http_client():
+    if _http["client"] is None:
+        import httpx
+        _http["client"] = httpx.Client(
+            base_url=SERVER_URL,
+            timeout=httpx.Timeout(SERVER_REQUEST_TIMEOUT_S, connect=5.0),
+            limits=httpx.Limits(max_connections=4 * SERVER_POOL_CONNECTIONS,
+                                max_keepalive_connections=SERVER_POOL_CONNECTIONS),
+        )
+    return _http["client"]
+
+def _server_payload(to_send, answer_only: bool, stream: bool):
+    return {"model": _target()["label"], "messages": to_send, "stream": stream, "answer_only": answer_only,
+            "max_tokens": ANSWER_ONLY_MAX_TOKENS if answer_only else HF_MAX_NEW_TOKENS}
+
+def _error_reply(detail: str) -> str:
+    # shown in the chat; stop_reason "error" keeps it out of the response caches
+    st.session_state["__last_metrics"] = {"stop_reason": "error"}
+    return f"_({detail})_"
+
+def _server_error(detail: str) -> str:
+    return _error_reply(f"server error: {detail}")
+
+def _server_stream(to_send, answer_only: bool = False):
+    import httpx
+    cancel = _cancel_token()  # before the request: a rerun during the connect cancels this one
+    try:
+        with _http_client().stream("POST", "/v1/chat/completions",
+                                   json=_server_payload(to_send, answer_only, stream=True)) as r:
+            if r.status_code != 200:
+                r.read()
+                try:
+                    detail = r.json().get("error", {}).get("message", "")
+                except ValueError:
+                    detail = r.text[:200]  # not the server's JSON error (proxy page, ...)
+                yield _server_error(f"{r.status_code} {detail}".strip())
+                return
+            for line in r.iter_lines():
+                if cancel.cancelled:
+                    break  # leaving the block closes the connection; the server stops generating
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                event = json.loads(line[6:])
+                if "error" in event:
+                    yield _server_error(event["error"].get("message", ""))
+                    return
+                choice = event["choices"][0]
+                token = choice.get("delta", {}).get("content")
+                if token:
+                    _record(token)
+                    yield token
+                if choice.get("finish_reason"):
+                    _save_hf_metrics(event.get("metrics") or {})
+    except httpx.HTTPError as e:
+        yield _server_error(f"{type(e).__name__}: {e}")
+
+def _server_once(to_send, answer_only: bool = False):
+    import httpx
+    try:
+        r = _http_client().post("/v1/chat/completions", json=_server_payload(to_send, answer_only, stream=False))
+        body = r.json()
+    except (httpx.HTTPError, ValueError) as e:
+        return _server_error(f"{type(e).__name__}: {e}"), st.session_state["__last_metrics"]
+    if r.status_code != 200:
+        return _server_error(f"{r.status_code} {body.get('error', {}).get('message', '')}"), st.session_state["__last_metrics"]
+    _save_hf_metrics(body.get("metrics") or {})
+    return body["choices"][0]["message"]["content"], st.session_state["__last_metrics"]
+
+# === Response cache ===
+def _get_response_cache():
+    if _response_cache["cache"] is None:
+        _response_cache["cache"] = ResponseCache(
+            RESPONSE_CACHE_PATH,
+            memory_items=RESPONSE_CACHE_MEMORY_ITEMS,
+            max_items=RESPONSE_CACHE_MAX_ITEMS,
+            ttl_s=RESPONSE_CACHE_TTL_S,
+        )
+    return _response_cache["cache"]
+
+def _get_semantic_cache():
+    if _response_cache["semantic"] is None:
+        _response_cache["semantic"] = SemanticCache(
+            SEMANTIC_CACHE_DIR,
+            dim=SEMANTIC_CACHE_DIM,
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            top_k=SEMANTIC_CACHE_TOP_K,
+        )
+    return _response_cache["semantic"]
+
+def _response_key(to_send, answer_only: bool):
+    """Everything that changes the output goes into the key."""
+    params = {"backend": BACKEND, "answer_only": answer_only, "stop": _stop_kwargs(answer_only)}
+    target = _target()
+    if BACKEND == "ollama":
+        params.update(model=target["label"], num_predict=ANSWER_ONLY_MAX_TOKENS if answer_only else None)
+    else:
+        params.update(base=target["base"], adapter=target["adapter"], fourbit=HF_LOAD_IN_4BIT,
+                      max_new_tokens=HF_MAX_NEW_TOKENS,
+                      temperature=LETTER_SCORE_TEMPERATURE if answer_only else 0.0)
+    return make_key(to_send, **params)
+
+def _replay(hit, lookup_s: float, source: str = "hit", chunk_chars: int = 24):
+    """Stream a cached answer back in word-aligned synthetic chunks (same interface as a backend)."""
+    t0 = time.perf_counter()
+    buf = ""
+    for piece in re.findall(r"\S+\s*|\s+", hit["text"]):
+        buf += piece
+        if len(buf) >= chunk_chars:
+            _record(buf)
+            yield buf
+            buf = ""
+    if buf:
+        _record(buf)
+        yield buf
+    replay_s = time.perf_counter() - t0
+    m = hit.get("metrics") or {}
+    st.session_state["__last_metrics"] = {
+        "prompt_eval_count": m.get("prompt_eval_count"),
+        "eval_count": m.get("eval_count"),
+        "prompt_eval_duration": int(lookup_s * 1e9),   # TTFT = cache lookup
+        "eval_duration": int(replay_s * 1e9),
+        "total_duration": int((lookup_s + replay_s) * 1e9),
+        "stop_reason": m.get("stop_reason"),
+        "cache": source,
+    }
+    if "similarity" in hit:
+        st.session_state["__last_metrics"]["similarity"] = hit["similarity"]
+        st.session_state["__last_metrics"].update(_semantic_stats())
+
+def _semantic_stats():
+    snap = _get_semantic_cache().snapshot()
+    return {"semantic_hit_rate": snap["hit_rate"], "semantic_lookup_ms": snap["mean_lookup_ms"]}
+
+def _store_when_done(stream, key, semantic=None):
+    """Pass chunks through; cache the full text only if the stream ran to completion."""
+    parts = []
+    for chunk in stream:
+        parts.append(chunk)
+        yield chunk
+    text = "".join(parts)
+    if not text.strip():
+        return
+    metrics = st.session_state.get("__last_metrics")
+    if (metrics or {}).get("stop_reason") == "error":
+        return
+    if key:
+        _get_response_cache().put(key, text, metrics)
+    if semantic:
+        user_text, namespace = semantic
+        _get_semantic_cache().add(user_text, text, namespace, metrics)
+        st.session_state["__last_metrics"] = dict(metrics or {}, **_semantic_stats())
 
 # === Public functions used by main.py ===
-def generate_response(use_system: bool, system_prompt_text: str):
+def generate_response(use_system: bool, system_prompt_text: str, answer_only: bool = False):
+    st.session_state["__stream_parts"] = []
     to_send = _prepare_for_model(use_system, system_prompt_text)
+    key = None
+    if RESPONSE_CACHE:
+        t0 = time.perf_counter()
+        key = _response_key(to_send, answer_only)
+        hit = _get_response_cache().get(key)
+        if hit is not None:
+            return _replay(hit, time.perf_counter() - t0)
+
+    semantic = None
+    user_text = to_send[-1].get("content", "") if to_send and to_send[-1].get("role") == "user" else ""
+    if SEMANTIC_CACHE and parse_mcq(user_text)[1] is not None:
+        # only full MCQs ("Explain more" must not match another chat's answer); the namespace is the
+        # exact key of everything before the question: settings, system prompt and earlier turns
+        semantic = (user_text, _response_key(to_send[:-1], answer_only))
+        hit = _get_semantic_cache().lookup(*semantic)
+        if hit is not None:
+            return _replay(hit, hit["lookup_ms"] / 1000.0, source="semantic")
+
     if BACKEND == "ollama":
-        return _ollama_stream(to_send)
+        stream = _ollama_stream(to_send, answer_only=answer_only)
+    elif BACKEND == "server":
+        stream = _server_stream(to_send, answer_only)
+    elif answer_only:
+        stream = _hf_score(to_send)
     else:
-        return _hf_stream(to_send)
+        stream = _hf_stream(to_send)
+    return _store_when_done(stream, key, semantic) if (key or semantic) else stream
+
+def streamed_text() -> str:
+    """Everything the last generate_response() stream yielded so far."""
+    return "".join(st.session_state.get("__stream_parts", []))
 
-def chat_once_fallback(use_system: bool, system_prompt_text: str):
+def chat_once_fallback(use_system: bool, system_prompt_text: str, answer_only: bool = False, partial: str = ""):
+    """One non-streamed reply. Ollama continues `partial` (an interrupted stream's text);
+    the other backends never report an interrupted stream and start over."""
     to_send = _prepare_for_model(use_system, system_prompt_text)
     if BACKEND == "ollama":
-        return _ollama_once(to_send)
+        return _ollama_once(to_send, answer_only=answer_only, partial=partial)
+    elif BACKEND == "server":
+        return _server_once(to_send, answer_only)
     else:
-        return _hf_once(to_send)
+        return _hf_once(to_send, answer_only=answer_only)
@@ -0,0 +1,204 @@
+# chat_tokens.py
+"""
+Prompt token ids for one conversation, built incrementally.
+
+Rendering the whole history with apply_chat_template and tokenizing the result
+costs O(history) on every turn. ChatTokens keeps one token-id segment per
+message instead, so a turn renders and tokenizes only the messages it has not
+seen:
+
+    first message   render([m0])                       (BOS, default system prompt, ...)
+    later message   render([ANCHOR, m]) - render([ANCHOR]): the template's text for m alone
+    generation      render(..., add_generation_prompt=True) - render(...), + a suffix
+                    (score_answer's "Answer:")
+
+Segments are tokenized on their own, which gives the same ids as one full
+tokenization only when each later segment starts with a special token: the
+tokenizer splits on those before BPE. ChatML (Qwen) and Llama 3 open every turn
+with one (<|im_start|>, <|start_header_id|>). usable() checks this once per
+tokenizer against the full render of a probe conversation; templates that
+fail it (per-position logic, no turn markers) keep the full render.
+
+Assistant replies generated here are not re-tokenized. record_reply() keeps the
+generated ids, and when the next request's history holds that reply, its
+segment is the generation prompt + those ids + the template's end of turn.
+The prefix KV cache is keyed by the same ids, so the reply's KV stays a hit.
+
+One buffer may serve concurrent requests of the same session (server.py keys
+sessions by the client's "user" field): prompt_ids() and record_reply() run
+under the buffer's lock. A reply recorded by one request and met by another
+is still only reused if it decodes to that message's text.
+
+check=True also renders and tokenizes the full conversation each turn and
+compares. A generated reply passes if it decodes to the same text. On a
+mismatch the full-render ids are used and a line is printed.
+"""
+import hashlib
+import threading
+import weakref
+from typing import Dict, List, Optional, Sequence, Tuple
+
+ANCHOR = {"role": "user", "content": "x"}
+PROBE = [{"role": "system", "content": "You are a medical expert."},
+         {"role": "user", "content": "Which nerve supplies the lateral rectus?"},
+         {"role": "assistant", "content": "Answer: C\nExplanation: The abducens nerve."},
+         {"role": "user", "content": "And the superior oblique?"}]
+_usable = weakref.WeakKeyDictionary()  # tok -> incremental rendering verified for its template
+
+def _render(tok, messages, generation: bool = False) -> str:
+    return tok.apply_chat_template(list(messages), tokenize=False, add_generation_prompt=generation)
+
+def _encode(tok, text: str) -> List[int]:
+    return tok(text, add_special_tokens=False).input_ids
+
+def _digest(message: Dict) -> Tuple[str, str]:
+    content = message.get("content", "")
+    return message.get("role"), hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+def usable(tok) -> bool:
+    """Whether per-message segments reproduce the full tokenization for this tokenizer's template."""
+    if tok not in _usable:
+        try:
+            probe = ChatTokens(tok, incremental=True)
+            _usable[tok] = all(probe.prompt_ids(PROBE[:n], suffix) == _encode(tok, _render(tok, PROBE[:n], True) + suffix)
+                               for n in range(1, len(PROBE) + 1) for suffix in ("", "Answer:"))
+        except Exception:  # template rejects the anchor / probe (strict alternation, ...)
+            _usable[tok] = False
+        if not _usable[tok]:
+            print(f"[chat-tokens] {getattr(tok, 'name_or_path', '?')}: template not incremental, rendering in full")
+    return _usable[tok]
+
+class ChatTokens:
+    def __init__(self, tok, check: bool = False, incremental: Optional[bool] = None):
+        self.tok = tok
+        self.check = check
+        self.incremental = usable(tok) if incremental is None else incremental
+        self._special = set(tok.all_special_ids) | set(getattr(tok, "added_tokens_decoder", {}) or {})
+        self._segments: Dict[tuple, List[int]] = {}  # (first?, role, content digest) -> ids
+        self._replies = set()  # keys of segments holding generated ids
+        self._generation: Dict[str, Tuple[str, List[int]]] = {}  # suffix -> (text, ids)
+        self._anchor: Optional[str] = None  # render([ANCHOR])
+        self._reply: Optional[List[int]] = None  # ids generated for the last prompt
+        self.stats = {"tokenized": 0, "reused": 0, "replies": 0, "mismatches": 0}
+        self._lock = threading.Lock()
+
+    def prompt_ids(self, messages: Sequence[Dict], suffix: str = "") -> List[int]:
+        """Token ids of render(messages, add_generation_prompt=True) + suffix."""
+        if not self.incremental:
+            return _encode(self.tok, _render(self.tok, messages, True) + suffix)
+        with self._lock:
+            return self._prompt_ids(messages, suffix)
+
+    def record_reply(self, generated: Sequence[int]):
+        """Ids the model generated for the last prompt; used if the reply comes back as history."""
+        with self._lock:
+            self._reply = list(generated)
+
+    def _prompt_ids(self, messages: Sequence[Dict], suffix: str) -> List[int]:
+        ids, used = [], set()
+        for i, m in enumerate(messages):
+            key = (i == 0,) + _digest(m)
+            seg = self._segments.get(key)
+            if seg is None:
+                seg, from_reply = self._segment(m, first=i == 0)
+                if from_reply:
+                    self._replies.add(key)
+                self._segments[key] = seg
+            else:
+                self.stats["reused"] += 1
+            used.add(key)
+            ids += seg
+        for key in [k for k in self._segments if k not in used]:
+            del self._segments[key]  # trimmed / edited messages
+        self._replies &= used
+        ids += self._generation_text(suffix)[1]
+        if self.check:
+            ids = self._verify(messages, suffix, ids, bool(self._replies))
+        return ids
+
+    def _segment(self, m: Dict, first: bool) -> Tuple[List[int], bool]:
+        if first:
+            text = _render(self.tok, [m])
+        else:
+            text = _render(self.tok, [ANCHOR, m])[len(self._anchor_text()):]
+        if m.get("role") == "assistant" and not first and self._reply is not None:
+            ids = self._from_reply(text)
+            if ids is not None:
+                return ids, True
+        self.stats["tokenized"] += 1
+        return _encode(self.tok, text), False
+
+    def _from_reply(self, text: str) -> Optional[List[int]]:
+        reply, self._reply = self._reply, None
+        while reply and reply[-1] in self._special:  # eos: the template writes its own end of turn
+            reply.pop()
+        head, head_ids = self._generation_text("")
+        body = self.tok.decode(reply)
+        if not text.startswith(head + body):
+            return None  # stop string trimmed the reply, template rewrites content, ...
+        tail = _encode(self.tok, text[len(head) + len(body):])
+        if tail and tail[0] not in self._special:
+            return None  # reply ends mid-word: its last token would merge with the template text
+        self.stats["replies"] += 1
+        return head_ids + reply + tail
+
+    def _anchor_text(self) -> str:
+        if self._anchor is None:
+            self._anchor = _render(self.tok, [ANCHOR])
+        return self._anchor
+
+    def _generation_text(self, suffix: str) -> Tuple[str, List[int]]:
+        if suffix not in self._generation:
+            text = _render(self.tok, [ANCHOR], True)[len(self._anchor_text()):] + suffix
+            self._generation[suffix] = (text, _encode(self.tok, text))
+        return self._generation[suffix]
+
+    def _verify(self, messages, suffix: str, ids: List[int], replied: bool) -> List[int]:
+        text = _render(self.tok, messages, True) + suffix
+        full = _encode(self.tok, text)
+        if ids == full or (replied and self.tok.decode(ids) == text):
+            return ids
+        self.stats["mismatches"] += 1
+        at = next((i for i, (a, b) in enumerate(zip(ids, full)) if a != b), min(len(ids), len(full)))
+        print(f"[chat-tokens] incremental ids differ from the full render at token {at} "
+              f"({len(ids)} vs {len(full)} tokens); using the full render")
+        self._segments.clear()
+        self._replies.clear()
+        return full
+
+def main():
+    """Check a tokenizer's template: python chat_tokens.py --base Qwen/Qwen2.5-7B-Instruct --turns 50"""
+    import argparse
+    import time
+
+    ap = argparse.ArgumentParser(description="Compare incremental prompt ids with the full chat-template render")
+    ap.add_argument("--base", required=True, help="tokenizer repo / path, or tiny-random")
+    ap.add_argument("--turns", type=int, default=50)
+    args = ap.parse_args()
+    if args.base.startswith("tiny-random"):
+        from tiny_model import build_tiny_tokenizer
+        tok = build_tiny_tokenizer()
+    else:
+        from transformers import AutoTokenizer
+        tok = AutoTokenizer.from_pretrained(args.base, use_fast=True)
+    buffer = ChatTokens(tok)
+    print(f"[chat-tokens] {args.base}: incremental {buffer.incremental}")
+    messages, t_inc, t_full = [{"role": "system", "content": PROBE[0]["content"]}], 0.0, 0.0
+    for turn in range(args.turns):
+        messages.append({"role": "user", "content": f"{PROBE[1]['content']} (case {turn})"})
+        t = time.perf_counter()
+        ids = buffer.prompt_ids(messages)
+        t_inc += time.perf_counter() - t
+        t = time.perf_counter()
+        full = _encode(tok, _render(tok, messages, True))
+        t_full += time.perf_counter() - t
+        if ids != full:
+            buffer.stats["mismatches"] += 1
+        reply = PROBE[2]["content"] + f" Case {turn}."
+        buffer.record_reply(_encode(tok, reply))
+        messages.append({"role": "assistant", "content": reply})
+    print(f"[chat-tokens] {args.turns} turns, {len(full)} tokens at the end: incremental {t_inc * 1000:.1f} ms, "
+          f"full render {t_full * 1000:.1f} ms; {buffer.stats}")
+
+if __name__ == "__main__":
+    main()
@@ -10,18 +10,113 @@ else:
     HF_BASE_ID = "Qwen/Qwen2.5-7B-Instruct"
     HF_ADAPTER_PATH = "Pk3112/medmcqa-lora-qwen2.5-7b-instruct"  # Hub repo id
 
+# Models selectable per request in the sidebar (HF base + LoRA; Ollama uses the label as model name).
+# The `llama` toggle above only picks the default.
+MODEL_CHOICES = {
+    "Qwen2.5-7B-Instruct": {"base": "Qwen/Qwen2.5-7B-Instruct",
+                            "adapter": "Pk3112/medmcqa-lora-qwen2.5-7b-instruct"},
+    "Llama-3-8B-Instruct": {"base": "meta-llama/Meta-Llama-3-8B-Instruct",
+                            "adapter": "Pk3112/medmcqa-lora-llama3-8b-instruct"},
+}
+MODEL_CHOICES[MODEL] = {"base": HF_BASE_ID, "adapter": HF_ADAPTER_PATH}
+
 # App settings
 MAX_TURNS = 20
-BUDGET_CHARS = 12000
+CONTEXT_TOKENS = None     # prompt budget = min(model context, this) - HF_MAX_NEW_TOKENS; None = model's own
+OLLAMA_NUM_CTX = 4096     # context window requested from Ollama (and budgeted for)
 PAGE_TITLE = "Chatbot"
 PAGE_ICON = "💬"
+STREAM_FLUSH_MS = 50      # streamed text reaches the page at most this often (tokens are coalesced in between)
+STREAM_FLUSH_CHARS = 80   # ...or as soon as this many characters are buffered
+HISTORY_RECENT_MESSAGES = 20  # past messages drawn as chat bubbles on every rerun
+HISTORY_PAGE_SIZE = 20        # older ones stay collapsed; "Show earlier" opens them a page at a time
 
 # Backend switch
-BACKEND = "hf"   # set to "ollama" to use Ollama again
+BACKEND = "hf"   # set to "ollama" to use Ollama again, "server" to call server.py over HTTP,
+                 # "pool" to run the model in POOL_WORKERS processes (worker_pool.py)
+WARMUP_ON_START = True  # load + warm the default model in the background at the first page load (startup.py)
 
 # HF (PEFT) settings (used when BACKEND == "hf")
 HF_LOAD_IN_4BIT = True   # requires bitsandbytes; hf_backend should use BitsAndBytesConfig
 HF_MAX_NEW_TOKENS = 256  # ← fixed stray quote
+HF_CONTINUOUS_BATCHING = False # share one batched decode loop across sessions (scheduler.py); see README
+HF_MAX_BATCH_SIZE = 8          # max sequences decoded together per step
+HF_PREFIX_CACHE_MB = 0         # KV memory budget for prefix reuse across turns/sessions; 0 disables
+HF_MODEL_MEMORY_GB = 24        # resident base models (RAM/VRAM); least recently used evicted above this
+HF_MERGED_DIR = "merged"       # merge_export.py output root; a fresh merged model is used instead of base+LoRA
+HF_CHAT_TOKEN_SESSIONS = 256   # conversations whose prompt token ids are kept between turns (chat_tokens.py)
+HF_CHAT_TOKENS_CHECK = False   # also render + tokenize the full history every turn and compare (debugging)
+HF_MAX_CONCURRENCY = HF_MAX_BATCH_SIZE  # generations running at once (admission.py)
+HF_MAX_QUEUE = 32              # more may wait for a slot; beyond that the user gets a "busy" reply
+HF_QUEUE_TIMEOUT_S = 60        # max wait for a slot; None = wait as long as it takes
+HF_CPU_PROFILE = "auto"        # without a GPU: "int8" (dynamic int8 linears, LoRA merged in), "bf16" (native bf16 CPUs)
+                               # or "fp32" (baseline); "auto" = int8. 4-bit is switched off on CPU. See cpu_profile.py
+HF_CPU_THREADS = None          # intra-op threads; None = torch default (one per core)
+HF_CPU_INTEROP_THREADS = None  # inter-op threads; None = torch default
+HF_CPU_PIN_CORES = None        # e.g. "0-15": pin the process to these cores (Linux)
+HF_STATIC_DECODE = False       # preallocated KV cache + torch.compile'd decode step (static_decode.py); compiles at load,
+                               # falls back to eager / generate() on failure. Like HF_SPECULATIVE, bypasses batching.
+HF_STATIC_MIN_BUCKET = 512     # smallest static cache; buckets double up to context budget + max new tokens (one compile each)
+HF_COMPILE_DECODE = True       # False = static cache without torch.compile
+HF_SPECULATIVE = None          # "prompt_lookup" (no extra model) or "draft"; same greedy text, fewer target forwards.
+                               # App only (server.py keeps batched decoding); replaces batching for explanations.
+HF_DRAFT_MODEL_ID = None       # for "draft": small model with the same tokenizer, e.g. "Qwen/Qwen2.5-0.5B-Instruct"
+HF_SPEC_NUM_DRAFT = 4          # initial draft length; grows after accepted drafts, shrinks after rejections
+HF_SPEC_MAX_DRAFT = 10
+HF_SPEC_NGRAM = 3              # longest n-gram matched by prompt lookup
+
+# Model worker processes (worker_pool.py, BACKEND == "pool"); each loads the default model at start
+POOL_WORKERS = 2
+POOL_DEVICES = None        # per worker, e.g. ["cuda:0", "cuda:1"]; None = inherit (CPU-only: cores split evenly)
+POOL_CORES = None          # per worker core sets, e.g. ["0-15", "16-31"] (one NUMA node / socket each)
+POOL_MAX_INFLIGHT = HF_MAX_CONCURRENCY  # beyond this a session leaves its worker for the least-loaded one
+POOL_REQUEST_TIMEOUT_S = 120  # a request fails after this long without a chunk from its worker (> HF_QUEUE_TIMEOUT_S)
+
+# Ollama client (ollama_backend.py, BACKEND == "ollama")
+OLLAMA_HOST = None                 # None = $OLLAMA_HOST or http://127.0.0.1:11434 (mock_ollama.py url for tests)
+OLLAMA_KEEP_ALIVE = "30m"          # how long the daemon keeps a model loaded after each request (Ollama's own: 5m)
+OLLAMA_PIN_MODELS = [MODEL]        # loaded at warm-up and never unloaded (keep_alive=-1); [] = none
+OLLAMA_POOL_CONNECTIONS = 8        # keep-alive connections kept by the client
+OLLAMA_TIMEOUT_S = 120
+OLLAMA_ASYNC = False               # stream through ollama.AsyncClient on one shared event-loop thread
+
+# OpenAI-compatible server (server.py) and the "server" backend's client
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8000
+SERVER_URL = "http://127.0.0.1:8000"   # where chat_core sends requests when BACKEND == "server"
+SERVER_MAX_CONCURRENCY = HF_MAX_BATCH_SIZE  # requests generating at once
+SERVER_MAX_QUEUE = 32                 # more may wait; beyond that -> 429
+SERVER_REQUEST_TIMEOUT_S = 120        # queue wait + generation
+SERVER_POOL_CONNECTIONS = 8           # keep-alive connections kept by the client
+
+# Request tracing / Prometheus metrics (tracing.py)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464        # the app serves GET /metrics here (server.py serves it on its own port); None = off
+TRACE_PATH = None          # e.g. ".cache/traces.jsonl": one JSON line per request with all spans
+
+# Early stop (both backends). Stop strings cut BEFORE the match, regexes AFTER it.
+STOP_STRINGS = ["\nQuestion:"]            # model starting a new MCQ on its own
+STOP_REGEXES = []
+EXPLANATION_MAX_SENTENCES = 6             # "3–6 sentences" in the MCQ prompt; None disables
+ANSWER_STOP_REGEX = r"Answer:\s*\(?[A-D]\b"  # answer-only decoding ends right after the letter
+
+# Response cache for repeated prompts (memory LRU + SQLite, see response_cache.py)
+RESPONSE_CACHE = False    # replay stored replies for identical prompts; see README
+RESPONSE_CACHE_PATH = ".cache/responses.sqlite3"   # None = memory tier only
+RESPONSE_CACHE_MEMORY_ITEMS = 256
+RESPONSE_CACHE_MAX_ITEMS = 10000
+RESPONSE_CACHE_TTL_S = 7 * 24 * 3600
+
+# Semantic near-duplicate cache (paraphrases, reordered options; see semantic_cache.py)
+SEMANTIC_CACHE = False
+SEMANTIC_CACHE_DIR = ".cache/semantic"
+SEMANTIC_CACHE_THRESHOLD = 0.92   # cosine similarity; keep high, wrong medical answers are costly
+SEMANTIC_CACHE_DIM = 4096
+SEMANTIC_CACHE_TOP_K = 5
+
+# "Answer only" mode (sidebar): HF scores the A/B/C/D logits in one forward pass
+LETTER_SCORE_TEMPERATURE = 1.0  # softmax temperature; fit with `batch_eval.py --mode score`
+ANSWER_ONLY_MAX_TOKENS = 8      # Ollama has no logits API, so it just decodes a short answer
 
 # Llama access reminder (gated model)
 if llama == 1:
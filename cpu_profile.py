@@ -0,0 +1,131 @@
+# cpu_profile.py
+"""
+CPU inference profile for boxes without a GPU (bitsandbytes 4-bit needs CUDA).
+
+    int8  dynamic int8 quantization of every nn.Linear (weights int8, activations
+          quantized per call); LoRA adapters are merged into the base first
+    bf16  bfloat16 weights, matmuls on AVX512-BF16 / AMX via oneDNN
+    fp32  plain float32 baseline
+
+"auto" picks int8 (fastest in the benchmark below, and 4x smaller); bf16 falls back
+to fp32 on CPUs without native bf16. Thread counts and optional core pinning are
+process-wide; apply them once, before the first forward.
+
+    python cpu_profile.py --hidden 1024 --layers 4    # tokens/s per profile on a random model
+"""
+import argparse
+import os
+import time
+import warnings
+from typing import Dict, List, Optional
+
+import torch
+
+PROFILES = ("int8", "bf16", "fp32")
+_applied: Dict = {}
+
+def bf16_supported() -> bool:
+    """Native bf16 matmul on this CPU (AVX512-BF16 or AMX)."""
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            flags = f.read()
+        return "avx512_bf16" in flags or "amx_bf16" in flags
+    except OSError:
+        return False
+
+def resolve(profile: Optional[str]) -> str:
+    if profile in (None, "auto"):
+        return "int8"
+    if profile not in PROFILES:
+        raise ValueError(f"unknown CPU profile {profile!r}; expected auto or one of {PROFILES}")
+    if profile == "bf16" and not bf16_supported():
+        print("[cpu] no native bf16 on this CPU; using fp32")
+        return "fp32"
+    return profile
+
+def parse_cores(cores) -> List[int]:
+    """'0-7,12' / [0, 1] -> sorted core ids."""
+    if isinstance(cores, str):
+        ids = set()
+        for part in cores.split(","):
+            lo, _, hi = part.strip().partition("-")
+            ids.update(range(int(lo), int(hi or lo) + 1))
+        return sorted(ids)
+    return sorted(int(c) for c in cores)
+
+def configure_threads(intra: Optional[int] = None, inter: Optional[int] = None, cores=None) -> Dict:
+    """
+    Pin the process to `cores` and set intra-/inter-op thread counts (first call wins:
+    torch cannot change inter-op threads once parallel work has started).
+    intra defaults to the number of pinned cores.
+    """
+    if _applied:
+        return dict(_applied)
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, parse_cores(cores))  # threads started later inherit the mask
+        intra = intra or len(parse_cores(cores))
+    if intra:
+        torch.set_num_threads(int(intra))
+    if inter:
+        try:
+            torch.set_num_interop_threads(int(inter))
+        except RuntimeError as e:
+            print(f"[cpu] inter-op threads unchanged: {e}")
+    _applied.update({"intra_threads": torch.get_num_threads(), "interop_threads": torch.get_num_interop_threads(),
+                     "cores": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None})
+    return dict(_applied)
+
+def load_dtype(profile: str) -> torch.dtype:
+    return torch.bfloat16 if profile == "bf16" else torch.float32
+
+def prepare(model, profile: str):
+    """Apply the profile to a loaded (already merged) model; returns the model to use."""
+    if profile == "int8":
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # torch.ao deprecation banner (torchao successor not required)
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif profile == "bf16" and next(model.parameters()).dtype != torch.bfloat16:
+        model = model.to(torch.bfloat16)
+    model.eval()
+    return model
+
+def merge_adapter(model, adapter_path: str):
+    """Fold a LoRA adapter into the base weights (int8 has no LoRA-aware quantized path)."""
+    from peft import PeftModel
+    return PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+
+def _bench():
+    from model_registry import model_nbytes
+    from tiny_model import build_tiny_model
+
+    ap = argparse.ArgumentParser(description="Tokens/s of each CPU profile on a random LLaMA-shaped model")
+    ap.add_argument("--hidden", type=int, default=1024)
+    ap.add_argument("--layers", type=int, default=4)
+    ap.add_argument("--prompt", type=int, default=256, help="prompt tokens")
+    ap.add_argument("--max-new", type=int, default=64)
+    ap.add_argument("--threads", type=int, default=None)
+    ap.add_argument("--interop", type=int, default=None)
+    ap.add_argument("--cores", default=None, help="pin to cores, e.g. 0-7")
+    args = ap.parse_args()
+
+    print("threads:", configure_threads(args.threads, args.interop, args.cores), "| native bf16:", bf16_supported())
+    ids = torch.randint(0, 200, (1, args.prompt))
+    reference = None
+    for profile in ("fp32", "int8", "bf16"):
+        model, tok = build_tiny_model(hidden_size=args.hidden, num_layers=args.layers)
+        model = prepare(model, profile)
+        gen = lambda: model.generate(ids, max_new_tokens=args.max_new, min_new_tokens=args.max_new, do_sample=False,
+                                     pad_token_id=tok.pad_token_id)
+        with torch.no_grad():
+            gen()  # warm-up
+            t0 = time.perf_counter()
+            out = gen()
+            dt = time.perf_counter() - t0
+        new = out[0, ids.shape[1]:]
+        reference = new if reference is None else reference
+        agree = (new == reference).float().mean().item()
+        print(f"{profile:5s} {args.max_new / dt:7.1f} tok/s  {model_nbytes(model) / 2 ** 20:7.1f} MB  "
+              f"tokens equal to fp32: {agree:.0%}")
+
+if __name__ == "__main__":
+    _bench()
@@ -0,0 +1,260 @@
+# dataset_cache.py
+"""
+Pre-tokenized, memory-mapped MedMCQA prompts for batch_eval.py and fine-tune prep.
+
+    python dataset_cache.py --base Qwen/Qwen2.5-7B-Instruct --data medmcqa_val.jsonl --mode answer
+    python dataset_cache.py --base tiny-random --data medmcqa_val.jsonl --mode score   # no download
+
+build() streams the raw JSONL/CSV (batch_eval.read_rows) in blocks of rows. For
+each block it formats the prompts, renders the chat template with one batched
+apply_chat_template call and tokenizes with one fast-tokenizer call. The
+results are appended to flat arrays on disk:
+
+    <cache_dir>/<key>/ids.bin       uint32 token ids of all rows back to back (np.memmap)
+                      offsets.npy   int64, row i is ids[offsets[i]:offsets[i + 1]]
+                      lengths.npy   int32 prompt tokens per row
+                      labels.npy    int8 gold letter index (0..3, -1 unknown)
+                      subjects.npy  int16 index into meta["subjects"]
+                      meta.json     row ids, subject names, key parts
+
+The key hashes the tokenizer (vocab, merges, normalizer, special tokens), the
+chat template (its source plus a probe render, so the system message counts),
+the prompt template and suffix for the mode, and the data file (path, size,
+mtime). Any change there is a new key, and the stale entries for the same data
+file and mode are removed. Nothing has to be cleared by hand.
+
+TokenizedSet.batches() cuts length-sorted index batches under a token budget
+with numpy, and collate() gathers one padded batch straight from the memmap.
+No per-example Python work happens once the cache exists.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from itertools import chain
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from batch_eval import LETTERS, gold_letter, read_rows
+from letter_scorer import ANSWER_PREFIX
+from test_adapter import ANSWER_ONLY_PROMPT, EXPLAIN_PROMPT, build_chat_text, chat_messages
+
+CACHE_DIR = ".cache/tokenized"
+FORMAT = 1  # bump when the on-disk layout changes
+_PROBE = "\x00probe\x00"
+
+def mode_prompt(mode: str):
+    """(prompt template, text appended after the chat template) for a batch_eval mode."""
+    if mode == "explain":
+        return EXPLAIN_PROMPT, ""
+    if mode == "answer":
+        return ANSWER_ONLY_PROMPT, ""
+    if mode == "score":
+        return ANSWER_ONLY_PROMPT, ANSWER_PREFIX  # the scored token is the letter right after it
+    raise ValueError(f"unknown mode {mode!r}")
+
+def _sha(*parts) -> str:
+    h = hashlib.sha256()
+    for p in parts:
+        h.update(p if isinstance(p, bytes) else str(p).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+def tokenizer_fingerprint(tok) -> str:
+    backend = getattr(tok, "backend_tokenizer", None)
+    if backend is not None:
+        spec = json.loads(backend.to_str())
+        spec.pop("padding", None)  # per-call state the last tok(...) call left behind, not the tokenizer
+        spec.pop("truncation", None)
+        vocab = json.dumps(spec, sort_keys=True)
+    else:
+        vocab = json.dumps(sorted(tok.get_vocab().items()))
+    return _sha(type(tok).__name__, vocab, json.dumps(tok.special_tokens_map, sort_keys=True, default=str))
+
+def template_fingerprint(tok) -> str:
+    return _sha(json.dumps(getattr(tok, "chat_template", None), sort_keys=True, default=str),
+                build_chat_text(tok, _PROBE))
+
+def cache_key(data_path: str, tok, mode: str, cop_one_based: bool = False) -> Dict[str, str]:
+    prompt, suffix = mode_prompt(mode)
+    st = os.stat(data_path)
+    parts = {
+        "format": str(FORMAT),
+        "tokenizer": tokenizer_fingerprint(tok),
+        "template": template_fingerprint(tok),
+        "prompt": _sha(prompt, suffix),
+        "data": _sha(os.path.abspath(data_path), st.st_size, st.st_mtime_ns, cop_one_based),
+    }
+    parts["key"] = _sha(*(parts[k] for k in sorted(parts)))[:24]
+    return parts
+
+class TokenizedSet:
+    """Read-only view of one cache entry; arrays are memory-mapped, not loaded."""
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode="r")
+        self.labels = np.load(os.path.join(path, "labels.npy"), mmap_mode="r")
+        self.subjects = np.load(os.path.join(path, "subjects.npy"), mmap_mode="r")
+        n_ids = int(self.offsets[-1]) if len(self.offsets) else 0
+        self.ids = np.memmap(os.path.join(path, "ids.bin"), dtype=np.uint32, mode="r", shape=(n_ids,)) \
+            if n_ids else np.zeros(0, dtype=np.uint32)
+        self.row_ids: List[str] = self.meta["row_ids"]
+        self.subject_names: List[str] = self.meta["subjects"]
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def tokens(self, i: int) -> np.ndarray:
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def gold(self, i: int) -> Optional[str]:
+        return LETTERS[self.labels[i]] if self.labels[i] >= 0 else None
+
+    def subject(self, i: int) -> Optional[str]:
+        return self.subject_names[self.subjects[i]] or None
+
+    def batches(self, batch_size: int, max_batch_tokens: int, indices: Optional[np.ndarray] = None,
+                shuffle: bool = False, seed: int = 0) -> Iterator[np.ndarray]:
+        """
+        Row indices in ascending length order, cut so len(batch) <= batch_size and
+        len(batch) * longest <= max_batch_tokens (a single over-long row is its own batch).
+        shuffle=True randomizes the batch order (training), not the batch contents.
+        """
+        idx = np.arange(len(self), dtype=np.int64) if indices is None else np.asarray(indices, dtype=np.int64)
+        idx = idx[np.argsort(self.lengths[idx], kind="stable")]
+        lens = np.asarray(self.lengths[idx], dtype=np.int64)
+        cuts, i, n = [], 0, len(idx)
+        ranks = np.arange(1, batch_size + 1, dtype=np.int64)
+        while i < n:
+            window = lens[i:i + batch_size]  # sorted: the last row of a prefix is its longest
+            fits = window * ranks[:len(window)] <= max_batch_tokens
+            take = max(1, int(np.argmin(fits)) if not fits.all() else len(window))
+            cuts.append((i, i + take))
+            i += take
+        order = np.random.default_rng(seed).permutation(len(cuts)) if shuffle else range(len(cuts))
+        for k in order:
+            yield idx[cuts[k][0]:cuts[k][1]]
+
+    def collate(self, batch: Sequence[int], pad_id: int, left: bool = True):
+        """(input_ids, attention_mask) int64 arrays for a batch, padded to its longest row."""
+        batch = np.asarray(batch, dtype=np.int64)
+        lens = np.asarray(self.lengths[batch], dtype=np.int64)
+        width = int(lens.max()) if len(batch) else 0
+        cols = np.arange(width, dtype=np.int64)[None, :]
+        pad = (width - lens)[:, None] if left else np.zeros((len(batch), 1), dtype=np.int64)
+        mask = (cols >= pad) & (cols < pad + lens[:, None])
+        src = np.asarray(self.offsets[batch], dtype=np.int64)[:, None] + cols - pad
+        input_ids = np.full((len(batch), width), pad_id, dtype=np.int64)
+        input_ids[mask] = self.ids[src[mask]]
+        return input_ids, mask.astype(np.int64)
+
+def _render(tok, rows: List[Dict], prompt: str, suffix: str) -> List[str]:
+    convs = [chat_messages(prompt.format(question=r["question"], opa=r["opa"], opb=r["opb"],
+                                         opc=r["opc"], opd=r["opd"])) for r in rows]
+    texts = tok.apply_chat_template(convs, tokenize=False, add_generation_prompt=True)
+    return [t + suffix for t in texts] if suffix else texts
+
+def build(data_path: str, tok, mode: str, cache_dir: str = CACHE_DIR, cop_one_based: bool = False,
+          block_rows: int = 1024) -> TokenizedSet:
+    """The cache entry for (data, tokenizer, template, mode); built first if missing."""
+    parts = cache_key(data_path, tok, mode, cop_one_based)
+    path = os.path.join(cache_dir, parts["key"])
+    if os.path.exists(os.path.join(path, "meta.json")):
+        return TokenizedSet(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    prompt, suffix = mode_prompt(mode)
+    t0 = time.perf_counter()
+    lengths, labels, subjects, row_ids = [], [], [], []
+    subject_index: Dict[str, int] = {}
+
+    def _flush(rows, f):
+        ids = tok(_render(tok, rows, prompt, suffix), add_special_tokens=False)["input_ids"]
+        n = [len(x) for x in ids]
+        lengths.extend(n)
+        np.fromiter(chain.from_iterable(ids), dtype=np.uint32, count=sum(n)).tofile(f)
+        for r in rows:
+            g = gold_letter(r.get("cop"), cop_one_based)
+            labels.append(LETTERS.index(g) if g else -1)
+            subjects.append(subject_index.setdefault(r.get("subject_name") or "", len(subject_index)))
+
+    with open(os.path.join(tmp, "ids.bin"), "wb") as f:
+        block: List[Dict] = []
+        for i, row in enumerate(read_rows(data_path)):
+            row_ids.append(str(row.get("id") or i))  # batch_eval._row_id
+            block.append(row)
+            if len(block) >= block_rows:
+                _flush(block, f)
+                block = []
+        if block:
+            _flush(block, f)
+
+    lengths_arr = np.asarray(lengths, dtype=np.int32)
+    np.save(os.path.join(tmp, "lengths.npy"), lengths_arr)
+    np.save(os.path.join(tmp, "offsets.npy"), np.concatenate([[0], np.cumsum(lengths_arr, dtype=np.int64)]))
+    np.save(os.path.join(tmp, "labels.npy"), np.asarray(labels, dtype=np.int8))
+    np.save(os.path.join(tmp, "subjects.npy"), np.asarray(subjects, dtype=np.int16))
+    meta = dict(parts, data_path=os.path.abspath(data_path), mode=mode, rows=len(row_ids),
+                tokens=int(lengths_arr.sum()), build_s=round(time.perf_counter() - t0, 3),
+                subjects=list(subject_index), row_ids=row_ids)
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+    try:
+        os.replace(tmp, path)
+    except OSError:  # another process finished the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    _prune(cache_dir, meta)
+    print(f"[tokcache] {meta['rows']} rows, {meta['tokens']} tokens -> {path} in {meta['build_s']:.1f}s")
+    return TokenizedSet(path)
+
+def _prune(cache_dir: str, fresh: Dict):
+    """Drop entries for the same data file and mode built with another tokenizer / template / file version."""
+    for name in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, name, "meta.json")
+        if name == fresh["key"] or not os.path.exists(meta_path):
+            continue
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                old = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if old.get("data_path") == fresh["data_path"] and old.get("mode") == fresh["mode"]:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+            print(f"[tokcache] removed stale {name} (tokenizer, template, prompt or data changed)")
+
+def main():
+    ap = argparse.ArgumentParser(description="Build / inspect the pre-tokenized MedMCQA cache")
+    ap.add_argument("--base", required=True, help="tokenizer source (e.g. Qwen/Qwen2.5-7B-Instruct, tiny-random)")
+    ap.add_argument("--data", required=True)
+    ap.add_argument("--mode", choices=["answer", "explain", "score"], default="answer")
+    ap.add_argument("--cache-dir", default=CACHE_DIR)
+    ap.add_argument("--cop-one-based", action="store_true")
+    ap.add_argument("--batch-size", type=int, default=16)
+    ap.add_argument("--max-batch-tokens", type=int, default=8192)
+    args = ap.parse_args()
+
+    from hf_backend import get_tokenizer
+    tok = get_tokenizer(args.base)
+    t = time.perf_counter()
+    ds = build(args.data, tok, args.mode, args.cache_dir, args.cop_one_based)
+    t_open = time.perf_counter() - t
+    t = time.perf_counter()
+    n_batches = real = padded = 0
+    for b in ds.batches(args.batch_size, args.max_batch_tokens):
+        ids, mask = ds.collate(b, tok.pad_token_id)
+        n_batches += 1
+        real += int(mask.sum())
+        padded += ids.size
+    print(f"[tokcache] {len(ds)} rows • open/build {t_open:.2f}s • {n_batches} batches collated in "
+          f"{time.perf_counter() - t:.2f}s • padding efficiency {real / max(padded, 1):.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,72 @@
 # hf_backend.py
+import functools
+import json
+import os
 import time
 import threading
+import weakref
 import torch
+from collections import OrderedDict
 from typing import Dict, Iterator, Tuple
-from transformers import AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
-from peft import PeftModel
+from transformers import AutoConfig, AutoTokenizer, AutoModelForCausalLM, TextIteratorStreamer
+from transformers import StoppingCriteria, StoppingCriteriaList
+import chat_tokens
+import cpu_profile
+import kv_cache
+from admission import AdmissionController, CancelToken
+from letter_scorer import ANSWER_PREFIX, LETTERS, format_answer, letter_token_ids, score_inputs
+from merge_export import MANIFEST, find_merged, load_merged
+from model_registry import ModelRegistry
+from prefix_cache import PrefixCache
+from scheduler import BatchScheduler, IncrementalDecoder
+from speculative import DraftModelDrafter, PromptLookupDrafter, speculative_generate
+from static_decode import StaticDecodeEngine
+from stopping import StopMatcher
+from tiny_model import TINY_MODEL_ID, build_tiny_model, build_tiny_tokenizer
+from tracing import Trace
 
-# Simple cache so we only load once
-_model_cache = {"model": None, "tok": None, "base": None, "adapter": None, "fourbit": None}
+_scheduler_cache: Dict[int, BatchScheduler] = {}  # id(model) -> scheduler
+_scheduler_lock = threading.Lock()
+_prefix_cache: Dict[Tuple[int, str], PrefixCache] = {}  # (id(model), adapter) -> cache
+_static_engines = weakref.WeakKeyDictionary()  # model -> static cache pool + compiled step
+_static_lock = threading.Lock()
+_tok_info = {}  # base_id -> tokenizer / context window, available before the model loads
+MERGED_CHECK_S = 300.0  # a merged artifact's freshness (Hub revision) is re-checked this often
+_admission = AdmissionController(max_concurrency=8, max_queue=32)
+_cpu = {"profile": None}  # CPU inference profile (cpu_profile.py) once configure_cpu() ran on a GPU-less box
+_cpu_units: Dict[str, Tuple[str, str]] = {}  # registry id -> (base_id, adapter_path) merged at load (int8)
+_last = {"trace": None}  # most recently finished request, for get_last_metrics()
+_chat_tokens: "OrderedDict[Tuple[str, int], chat_tokens.ChatTokens]" = OrderedDict()  # (session, id(tok)) -> ids
+_chat_tokens_cfg = {"check": False, "sessions": 256}
+_chat_tokens_lock = threading.Lock()
+_letter_ids = weakref.WeakKeyDictionary()  # tok -> A/B/C/D token ids; dropped with an evicted tokenizer
+_message_overhead = weakref.WeakKeyDictionary()  # tok -> chat-template tokens per message
 
-def load_hf(base_id: str, adapter_path: str, load_in_4bit: bool):
-    """Load base + LoRA once and cache."""
-    if (_model_cache["model"] is not None and
-        _model_cache["base"] == base_id and
-        _model_cache["adapter"] == adapter_path and
-        _model_cache["fourbit"] == load_in_4bit):
-        return _model_cache["model"], _model_cache["tok"]
+def _is_tiny(base_id: str) -> bool:
+    return base_id == TINY_MODEL_ID or base_id.startswith(TINY_MODEL_ID + ":")
 
-    dtype = torch.float16 if torch.cuda.is_available() else torch.float32
+def _load_base(base_id: str, load_in_4bit: bool):
+    """Base model + tokenizer; adapters are attached by the registry (or merged here for CPU int8)."""
+    base_id, merge_path = _cpu_units.get(base_id, (base_id, None))
+    model, tok = _load_weights(base_id, load_in_4bit)
+    if merge_path:
+        model = cpu_profile.merge_adapter(model, merge_path)
+    if _cpu["profile"]:
+        model = cpu_profile.prepare(model, _cpu["profile"])
+    return model, tok
+
+def _load_weights(base_id: str, load_in_4bit: bool):
+    if _is_tiny(base_id):
+        # random CPU model for load tests; "tiny-random:3" picks seed 3
+        seed = base_id.partition(":")[2]
+        return build_tiny_model(seed=int(seed or 0))
+    if os.path.isfile(os.path.join(base_id, MANIFEST)):
+        return load_merged(base_id, load_in_4bit)  # merge_export.py artifact
+
+    if torch.cuda.is_available():
+        dtype = torch.float16
+    else:
+        dtype = cpu_profile.load_dtype(_cpu["profile"])
     kwargs = dict(device_map="auto", torch_dtype=dtype)
 
     if load_in_4bit:
@@ -30,7 +79,6 @@ def load_hf(base_id: str, adapter_path: str, load_in_4bit: bool):
 
     tok = AutoTokenizer.from_pretrained(base_id, use_fast=True)
     model = AutoModelForCausalLM.from_pretrained(base_id, **kwargs)
-    model = PeftModel.from_pretrained(model, adapter_path)
 
     # decoder-only best practices
     tok.padding_side = "left"
@@ -38,66 +86,612 @@ def load_hf(base_id: str, adapter_path: str, load_in_4bit: bool):
         tok.pad_token = tok.eos_token
     model.config.pad_token_id = tok.pad_token_id
     model.eval()
-
-    _model_cache.update({"model": model, "tok": tok, "base": base_id, "adapter": adapter_path, "fourbit": load_in_4bit})
     return model, tok
 
+def _estimate_bytes(base_id: str, load_in_4bit: bool) -> int:
+    """Registry size estimate before a first load: checkpoint *.safetensors bytes, rescaled
+    from the stored dtype to the load dtype. Only local files are read (a local dir, merged
+    artifact or the Hub cache); without them the registry makes room after the load."""
+    base_id = _cpu_units.get(base_id, (base_id, None))[0]
+    if _is_tiny(base_id):
+        return 0
+    if os.path.isdir(base_id):
+        path = base_id
+    else:
+        from huggingface_hub import snapshot_download
+
+        path = snapshot_download(base_id, local_files_only=True, allow_patterns=["*.json", "*.safetensors"])
+    files = [f for f in os.listdir(path) if f.endswith(".safetensors")]
+    if not files:
+        return 0
+    with open(os.path.join(path, "config.json"), encoding="utf-8") as f:
+        cfg = json.load(f)
+    stored = 4 if str(cfg.get("torch_dtype") or cfg.get("dtype")) == "float32" else 2
+    if load_in_4bit:
+        per_param = 0.6  # nf4 + double-quant constants, embeddings / norms stay 16-bit
+    elif torch.cuda.is_available():
+        per_param = 2
+    else:
+        per_param = {"int8": 1.2, "bf16": 2}.get(_cpu["profile"], 4)
+    return int(sum(os.path.getsize(os.path.join(path, f)) for f in files) / stored * per_param)
+
+def _forget_model(model):
+    """Registry eviction hook: let the model's scheduler drain, drop its KV caches."""
+    with _scheduler_lock:
+        sched = _scheduler_cache.pop(id(model), None)
+        for key in [k for k in _prefix_cache if k[0] == id(model)]:
+            del _prefix_cache[key]
+        _static_engines.pop(model, None)
+    if sched is not None:
+        sched.retire()
+
+_registry = ModelRegistry(budget_bytes=24 * 2 ** 30, load_base=_load_base, on_evict=_forget_model,
+                          estimate=_estimate_bytes)
+
+def load_hf(base_id: str, adapter_path: str, load_in_4bit: bool, memory_budget_gb: float = None,
+            merged_dir: str = None):
+    """
+    Base + LoRA from the model registry (loaded on first use, least recently used
+    base evicted over the memory budget). Returns (model, tok, adapter); when adapter
+    is not None pass adapter_names=[adapter] to forward()/generate().
+    A fresh merge_export.py artifact under merged_dir replaces base + adapter.
+    Under the CPU profile (configure_cpu) 4-bit is off, and with int8 each
+    base + adapter pair is merged and quantized as its own registry entry.
+    """
+    if memory_budget_gb is not None:
+        _registry.budget_bytes = int(memory_budget_gb * 2 ** 30)
+    if _cpu["profile"]:
+        load_in_4bit = False  # bitsandbytes 4-bit needs CUDA
+    if _is_tiny(base_id) and adapter_path and not os.path.isdir(adapter_path):
+        adapter_path = None  # tiny bases only take local adapters (tiny_model.save_tiny_adapter)
+    merged = _merged_path(merged_dir, base_id, adapter_path)
+    if merged:
+        return _registry.get(merged, None, load_in_4bit)
+    if _cpu["profile"] == "int8" and adapter_path:
+        unit = f"{base_id}+{adapter_path}"
+        _cpu_units[unit] = (base_id, adapter_path)
+        return _registry.get(unit, None, load_in_4bit)
+    return _registry.get(base_id, adapter_path, load_in_4bit)
+
+def _merged_path(merged_dir: str, base_id: str, adapter_path: str):
+    key = ("merged", merged_dir, base_id, adapter_path)
+    hit = _tok_info.get(key)
+    if hit is None or time.monotonic() - hit[0] > MERGED_CHECK_S:
+        hit = _tok_info[key] = (time.monotonic(), find_merged(merged_dir, base_id, adapter_path))
+    return hit[1]
+
+_WEIGHT_FILES = ["*.json", "*.safetensors", "*.model", "*.tiktoken", "*.txt", "*.jinja"]
+
+def download_weights(base_id: str, adapter_path: str = None, merged_dir: str = None) -> bool:
+    """
+    Fetch base + adapter files into the Hub cache without loading them (cold-start report:
+    download vs load). Nothing to do for tiny models, local folders or a fresh merged
+    artifact; returns whether the Hub was asked for anything.
+    """
+    if _is_tiny(base_id) or _merged_path(merged_dir, base_id, adapter_path):
+        return False
+    from huggingface_hub import snapshot_download
+
+    repos = [r for r in (base_id, adapter_path) if r and not os.path.isdir(r)]
+    for repo in repos:
+        snapshot_download(repo, allow_patterns=_WEIGHT_FILES)
+    return bool(repos)
+
+@torch.no_grad()
+def warm_up(model, tok, adapter: str = None, new_tokens: int = 2):
+    """Dummy prefill + a few decode steps: kernels, allocator pools and PEFT paths are ready for the first user."""
+    chat_tokens.usable(tok)  # template probe for incremental prompts, off the first request's path
+    text = _build_chat_text(tok, [{"role": "user", "content": "Warm-up: which nerve supplies the lateral rectus?"}])
+    ids = tok([text], return_tensors="pt").input_ids.to(model.device)
+    model.generate(ids, max_new_tokens=new_tokens, min_new_tokens=new_tokens, do_sample=False,
+                   pad_token_id=tok.pad_token_id, **_adapter_kwargs(adapter))
+
+def configure_cpu(profile: str = "auto", threads: int = None, interop_threads: int = None, cores=None):
+    """
+    Select the CPU inference profile ("auto" | "int8" | "bf16" | "fp32") and apply thread
+    settings; does nothing when a GPU is present. Call before the first model loads.
+    """
+    if torch.cuda.is_available() or not profile:
+        return None
+    _cpu["profile"] = cpu_profile.resolve(profile)
+    settings = cpu_profile.configure_threads(threads, interop_threads, cores)
+    print(f"[cpu] profile {_cpu['profile']}, {settings['intra_threads']} intra-op / "
+          f"{settings['interop_threads']} inter-op threads")
+    return _cpu["profile"]
+
+def _adapter_kwargs(adapter: str) -> Dict:
+    return {"adapter_names": [adapter]} if adapter else {}
+
+def get_registry_stats() -> Dict:
+    return _registry.snapshot()
+
+def get_tokenizer(base_id: str):
+    """Tokenizer only (cheap); reuses a resident model's tokenizer when there is one."""
+    entry = _registry.peek(base_id)
+    if entry is not None:
+        return entry.tok
+    key = ("tok", base_id)
+    if key not in _tok_info:
+        _tok_info[key] = build_tiny_tokenizer() if _is_tiny(base_id) else \
+            AutoTokenizer.from_pretrained(base_id, use_fast=True)
+    return _tok_info[key]
+
+def context_window(base_id: str, default: int = 8192) -> int:
+    """Model context length from its config (max_position_embeddings)."""
+    key = ("ctx", base_id)
+    if key not in _tok_info:
+        entry = _registry.peek(base_id)
+        if entry is not None:
+            cfg = entry.model.config
+        elif _is_tiny(base_id):
+            cfg = None
+        else:
+            cfg = AutoConfig.from_pretrained(base_id)
+        _tok_info[key] = int(getattr(cfg, "max_position_embeddings", 0) or (2048 if cfg is None else default))
+    return _tok_info[key]
+
+def message_overhead(tok) -> int:
+    """Chat-template tokens added around one message (role header, end-of-turn)."""
+    if tok not in _message_overhead:
+        one = [{"role": "user", "content": "x"}]
+        two = one + [{"role": "assistant", "content": "x"}]
+        n1 = len(tok(tok.apply_chat_template(one, tokenize=False), add_special_tokens=False).input_ids)
+        n2 = len(tok(tok.apply_chat_template(two, tokenize=False), add_special_tokens=False).input_ids)
+        _message_overhead[tok] = max(n2 - n1 - 1, 0)
+    return _message_overhead[tok]
+
+def get_prefix_cache(model, budget_mb: int, adapter: str = None) -> PrefixCache:
+    """One prefix KV-cache per (model, adapter): KV computed under another model or LoRA is useless."""
+    with _scheduler_lock:
+        key = (id(model), adapter or "")
+        cache = _prefix_cache.get(key)
+        if cache is None:
+            cache = _prefix_cache[key] = PrefixCache(budget_bytes=budget_mb * 1024 * 1024)
+        cache.budget_bytes = budget_mb * 1024 * 1024
+        return cache
+
+def get_prefix_cache_stats() -> Dict[str, int]:
+    """Counters summed over all (model, adapter) prefix caches."""
+    total: Dict[str, int] = {}
+    for cache in list(_prefix_cache.values()):
+        for k, v in cache.snapshot().items():
+            total[k] = total.get(k, 0) + v
+    return total
+
+def static_len(base_id: str, context_tokens: int, max_new_tokens: int) -> int:
+    """Largest static cache a request needs: a prompt of the context budget
+    (min(model context, context_tokens)) + max_new_tokens."""
+    window = context_window(base_id)
+    return min(context_tokens or window, window) + max_new_tokens
+
+def get_static_engine(model, max_len: int, min_bucket: int = 512, compile: bool = True,
+                      adapter: str = None) -> StaticDecodeEngine:
+    """Static-cache decoder for this model, built on first use and warmed up (compiled)
+    on the first use of each adapter (startup.Warmup does the default one at load).
+    The compile runs outside _static_lock: only requests on this engine wait for it."""
+    with _static_lock:
+        engine = _static_engines.get(model)
+        if engine is None:
+            engine = _static_engines[model] = StaticDecodeEngine(model, max_len, min_bucket, compile)
+    engine.warmup(**_adapter_kwargs(adapter))
+    return engine
+
+def get_scheduler(model, tok, max_batch_size: int = 8) -> BatchScheduler:
+    """One continuous-batching scheduler per resident model, shared by all sessions and adapters."""
+    with _scheduler_lock:
+        sched = _scheduler_cache.get(id(model))
+        if sched is None:
+            sched = _scheduler_cache[id(model)] = BatchScheduler(model, tok, max_batch_size=max_batch_size)
+        return sched
+
+def configure_admission(max_concurrency: int, max_queue: int, timeout_s: float = None):
+    """Process-wide limits for concurrent generations (see admission.py)."""
+    _admission.max_concurrency = max_concurrency
+    _admission.max_queue = max_queue
+    _admission.timeout_s = timeout_s
+
+def configure_chat_tokens(check: bool = False, max_sessions: int = 256):
+    """Per-session prompt token buffers (chat_tokens.py): check=True compares every
+    prompt with the full render; max_sessions conversations are kept (LRU)."""
+    _chat_tokens_cfg.update(check=check, sessions=max_sessions)
+
+def _session_tokens(tok, session: str = None) -> chat_tokens.ChatTokens:
+    """The conversation's token buffer; without a session id a throwaway one (full build)."""
+    if session is None:
+        return chat_tokens.ChatTokens(tok, check=_chat_tokens_cfg["check"])
+    key = (session, id(tok))
+    with _chat_tokens_lock:
+        ct = _chat_tokens.get(key)
+        if ct is None or ct.tok is not tok:
+            ct = _chat_tokens[key] = chat_tokens.ChatTokens(tok, check=_chat_tokens_cfg["check"])
+        _chat_tokens.move_to_end(key)
+        while len(_chat_tokens) > _chat_tokens_cfg["sessions"]:
+            _chat_tokens.popitem(last=False)
+    return ct
+
+def get_admission_stats() -> Dict:
+    return _admission.snapshot()
+
+class _Cleanup:
+    """
+    What a request releases once it no longer runs on the model (admission slot,
+    plain-model leases).
+    Run by _admitted after the request's generator closed; a request handed to the
+    batch scheduler hold()s it instead and its row runs it when it leaves the batch.
+    """
+    def __init__(self):
+        self._fns = []
+        self._held = False
+        self._lock = threading.Lock()
+
+    def add(self, fn):
+        self._fns.append(fn)
+
+    def hold(self):
+        self._held = True
+        return self._run
+
+    def run(self):
+        if not self._held:
+            self._run()
+
+    def _run(self):
+        with self._lock:
+            fns, self._fns = self._fns, []
+        for fn in fns:
+            fn()
+
+def _admitted(gen_fn):
+    """
+    Run a generator function under an admission slot with a cancel token.
+    The token is cancelled when the consumer closes the stream (rerun, client gone),
+    which stops decoding within one token. Raises admission.Rejected when saturated.
+    The slot is freed once the request stops using the model: when its generator
+    closes, or for a batch-scheduler request when its row retires.
+    Metrics and spans go to `trace` (tracing.Trace); without one the request gets its
+    own, finished here. admit=False skips the slot: the caller gates requests itself
+    (server.py), so they are not queued twice.
+    """
+    @functools.wraps(gen_fn)
+    def wrapper(*args, cancel: CancelToken = None, trace: Trace = None, admit: bool = True, **kwargs):
+        token = cancel if cancel is not None else CancelToken()
+        own = trace is None
+        trace = Trace("hf") if own else trace
+        t = time.perf_counter()
+        try:
+            queue_ms = _admission.acquire(token) if admit else 0.0
+        finally:
+            trace.add_span("queue", t, time.perf_counter())
+        if queue_ms is None:
+            trace.metrics.update({"stop_reason": "cancelled", "gen_tokens": 0, "ttft_ms": None, "queue_ms": None})
+            _done(trace, own)
+            return
+        done = _Cleanup()
+        if admit:
+            done.add(_admission.release)  # on the batching path: when the scheduler row retires
+        gen = gen_fn(*args, cancel=token, trace=trace, done=done, **kwargs)
+        try:
+            for chunk in gen:
+                yield chunk
+        except GeneratorExit:
+            token.cancel("consumer_closed")
+            raise
+        finally:
+            gen.close()  # returns once the request's decode thread has stopped
+            done.run()
+            trace.metrics["queue_ms"] = queue_ms + (trace.metrics.get("queue_ms") or 0.0)
+            _done(trace, own)
+    return wrapper
+
+def _done(trace: Trace, own: bool):
+    _last["trace"] = trace
+    if own:
+        trace.finish()
+
+class TracingStreamer(TextIteratorStreamer):
+    """TextIteratorStreamer that counts generated tokens and timestamps every decode step."""
+    def __init__(self, tok, **kwargs):
+        super().__init__(tok, **kwargs)
+        self.step_times, self.step_tokens = [], []
+        self.ids = []  # generated token ids, for the session's prompt buffer
+        self.detok_s = 0.0
+        self._prompt_done = False
+
+    def put(self, value):
+        if not self._prompt_done:  # the first put is always the prompt
+            self._prompt_done = True
+            return super().put(value)
+        t = time.perf_counter()
+        self.step_times.append(t)
+        self.step_tokens.append(int(value.numel()))
+        self.ids += value.reshape(-1).tolist()
+        super().put(value)
+        self.detok_s += time.perf_counter() - t
+
+    @property
+    def tokens(self) -> int:
+        return sum(self.step_tokens)
+
+class CancelOnToken(StoppingCriteria):
+    """Ends generate() at the next token once the request's CancelToken fires."""
+    def __init__(self, token: CancelToken):
+        self.token = token
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.token.cancelled, dtype=torch.bool, device=input_ids.device)
+
+class StopOnMatch(StoppingCriteria):
+    """Feeds each new token to a StopMatcher inside generate() (batch of 1) so a match halts decoding at once."""
+    def __init__(self, tok, prompt_len: int, matcher: StopMatcher):
+        self.matcher = matcher
+        self._decoder = IncrementalDecoder(tok)
+        self._seen = prompt_len
+
+    def __call__(self, input_ids, scores, **kwargs):
+        for t in input_ids[0, self._seen:].tolist():
+            self.matcher.feed(self._decoder.push(t))
+        self._seen = input_ids.shape[1]
+        return torch.full((input_ids.shape[0],), self.matcher.stopped, dtype=torch.bool, device=input_ids.device)
+
+def _drafter(tok, mode: str, draft_model_id: str, ngram: int, load_in_4bit: bool, memory_budget_gb: float):
+    """Drafter for speculative decoding; a draft model must share the target's tokenizer."""
+    if mode == "prompt_lookup":
+        return PromptLookupDrafter(max_ngram=ngram)
+    if mode != "draft":
+        raise ValueError(f"unknown speculative mode {mode!r}")
+    if not draft_model_id:
+        raise ValueError("speculative='draft' needs draft_model_id")
+    draft_model, draft_tok, _ = load_hf(draft_model_id, None, load_in_4bit, memory_budget_gb)
+    key = ("same_vocab", tok.name_or_path, draft_model_id)
+    if key not in _tok_info:
+        _tok_info[key] = draft_tok.get_vocab() == tok.get_vocab()
+    if not _tok_info[key]:
+        raise ValueError(f"draft model {draft_model_id} uses a different tokenizer")
+    return DraftModelDrafter(draft_model)
+
+def _log_cpu_rate(metrics: Dict):
+    """One line per generation under the CPU profile, to compare profiles (HF_CPU_PROFILE="fp32" is the baseline)."""
+    if _cpu["profile"] and metrics.get("tok_per_s"):
+        print(f"[cpu] {_cpu['profile']}: {metrics.get('gen_tokens')} tokens, {metrics['tok_per_s']:.1f} tok/s")
+
 def _build_chat_text(tok, messages):
     """Use the model chat template."""
     return tok.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
 
+@_admitted
 def stream_generate(messages, *, base_id: str, adapter_path: str,
-                    load_in_4bit: bool, max_new_tokens: int) -> Iterator[str]:
+                    load_in_4bit: bool, max_new_tokens: int,
+                    batching: bool = False, max_batch_size: int = 8,
+                    prefix_cache_mb: int = 0, stop_strings=(), stop_regexes=(),
+                    max_sentences: int = None, memory_budget_gb: float = None,
+                    merged_dir: str = None, speculative: str = None, draft_model_id: str = None,
+                    num_draft_tokens: int = 4, max_draft_tokens: int = 10, spec_ngram: int = 3,
+                    static_cache: bool = False, static_max_len: int = None, static_min_bucket: int = 512,
+                    compile_decode: bool = True, session: str = None,
+                    cancel: CancelToken = None, trace: Trace = None, done: _Cleanup = None) -> Iterator[str]:
     """
     Stream tokens using HF TextIteratorStreamer. Yields text chunks.
-    Stores simple metrics in a dict returned by get_last_metrics().
+    With batching=True the request goes through the shared BatchScheduler
+    instead of a private generate() thread.
+    With prefix_cache_mb > 0, KV for the longest previously seen token prefix
+    (shared system prompt, earlier turns) is reused and only new tokens are prefilled.
+    stop_strings / stop_regexes / max_sentences end generation early (see stopping.py);
+    metrics["stop_reason"] records why decoding ended.
+    Models come from the registry (model_registry.py); memory_budget_gb caps resident bases,
+    merged_dir is where merge_export.py artifacts are looked up.
+    speculative="prompt_lookup" | "draft" decodes with draft-and-verify steps (speculative.py):
+    same greedy text, fewer target forwards; it runs on a private thread, so it takes
+    precedence over batching. Acceptance stats land in the metrics.
+    static_cache=True decodes on a preallocated, length-bucketed StaticCache with a
+    compiled step (static_decode.py), sized for a static_max_len prompt (default: the model's
+    context window) + max_new_tokens; also a private thread, after speculative, before batching.
+    Falls back to generate() if the static cache is unusable or the prompt doesn't fit.
+    Runs under the admission controller; cancel (or closing the stream) aborts mid-decode.
+    Metrics and spans go to `trace` (tracing.Trace, see _admitted); token counts and
+    per-step timings come from the streamer.
+    session (a conversation id) keeps the prompt's token ids between turns, so only new
+    messages are rendered and tokenized and the reply's generated ids are reused
+    (chat_tokens.py; concurrent requests of one session share the buffer under its lock).
     """
-    model, tok = load_hf(base_id, adapter_path, load_in_4bit)
+    model, tok, adapter = load_hf(base_id, adapter_path, load_in_4bit, memory_budget_gb, merged_dir)
+    if adapter is None:
+        done.add(_registry.lease(model))
+    cache = get_prefix_cache(model, prefix_cache_mb, adapter) if prefix_cache_mb > 0 else None
+    use_stop = bool(stop_strings or stop_regexes or max_sentences)
+
+    def _matcher():
+        return StopMatcher(stop_strings, stop_regexes, max_sentences) if use_stop else None
+
+    buffer = _session_tokens(tok, session)
+    with trace.span("chat_template"):
+        prompt_ids = buffer.prompt_ids(messages)
+    if batching and not (speculative or static_cache):
+        req = get_scheduler(model, tok, max_batch_size).submit(
+            prompt_ids, max_new_tokens, stop=_matcher(), adapter=adapter, prefix_cache=cache, cancel=cancel,
+            on_finish=done.hold())
+        for chunk in req:
+            yield chunk
+        queued = trace.metrics.get("queue_ms") or 0.0  # set by the caller (server.py's own queue)
+        trace.metrics.update(req.metrics, queue_ms=req.metrics["queue_ms"] + queued)
+        if req.t_start is not None:
+            trace.add_span("batch_queue", req.t_submit, req.t_start)
+            trace.decode_timeline(req.t_start, req.token_times)
+        trace.accumulate("detokenize", req.detok_s, len(req.token_times))
+        buffer.record_reply(req.generated)
+        _log_cpu_rate(req.metrics)
+        return
+
+    with trace.span("tokenize"):
+        input_ids = torch.tensor([prompt_ids], device=model.device)
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    streamer = TracingStreamer(tok, skip_prompt=True, skip_special_tokens=True)
+
+    past, cached = None, 0
+    if cache is not None:
+        with trace.span("prefix_lookup"):
+            cached, layers = cache.lookup(prompt_ids)
+        if cached:
+            past = kv_cache.layers_to_cache(layers)
 
-    prompt_text = _build_chat_text(tok, messages)
-    inputs = tok([prompt_text], return_tensors="pt").to(model.device)
-    streamer = TextIteratorStreamer(tok, skip_prompt=True, skip_special_tokens=True)
+    # the generate thread stops on a match; the consumer side trims the streamed text identically
+    prompt_len = len(prompt_ids)
+    gen_matcher, out_matcher = _matcher(), _matcher()
+    criteria = StoppingCriteriaList([CancelOnToken(cancel)])
+    if use_stop:
+        criteria.append(StopOnMatch(tok, prompt_len, gen_matcher))
 
     # metrics we’ll fill
-    metrics = {"prompt_tokens": int(inputs["input_ids"].shape[1]),
-               "gen_tokens": 0, "ttft_ms": None, "gen_ms": None, "wall_s": None}
+    metrics = trace.metrics
+    metrics.update({"prompt_tokens": prompt_len, "cached_tokens": cached,
+               "gen_tokens": 0, "ttft_ms": None, "gen_ms": None, "wall_s": None, "stop_reason": None,
+               "tok_per_s": None, "tpot_ms": None, "static_bucket": None, "compiled": None,
+               "speculative": speculative, "spec_drafted": None, "spec_accepted": None,
+               "acceptance_rate": None, "spec_steps": None})
+    drafter, engine = None, None
+    if speculative:
+        drafter = _drafter(tok, speculative, draft_model_id, spec_ngram, load_in_4bit, memory_budget_gb)
+    elif static_cache:
+        max_len = static_len(base_id, static_max_len, max_new_tokens)
+        engine = get_static_engine(model, max_len, static_min_bucket, compile_decode, adapter)
+        if not engine.usable or engine.bucket(prompt_len + max_new_tokens) is None:
+            engine = None
     t0 = time.perf_counter()
     first_token_time = [None]
+    result = {}
 
     def _gen():
+        if drafter is not None:
+            result["out"] = speculative_generate(
+                model, inputs["input_ids"], drafter,
+                max_new_tokens=max_new_tokens,
+                eos_token_id=tok.eos_token_id,
+                past_key_values=past,
+                stopping_criteria=criteria,
+                streamer=streamer,
+                num_draft=num_draft_tokens, max_draft=max_draft_tokens,
+                **_adapter_kwargs(adapter),
+            )
+            return
+        if engine is not None:
+            result["out"] = engine.generate(
+                inputs["input_ids"],
+                max_new_tokens=max_new_tokens,
+                eos_token_id=tok.eos_token_id,
+                past_key_values=past,
+                stopping_criteria=criteria,
+                streamer=streamer,
+                return_kv=cache is not None,
+                **_adapter_kwargs(adapter),
+            )
+            return
         with torch.no_grad():
-            model.generate(
+            result["out"] = model.generate(
                 **inputs,
                 streamer=streamer,
                 max_new_tokens=max_new_tokens,
                 do_sample=False, temperature=0.0, top_p=1.0,
                 pad_token_id=tok.pad_token_id,
                 eos_token_id=tok.eos_token_id,
+                past_key_values=past,
+                stopping_criteria=criteria,
+                return_dict_in_generate=cache is not None,
+                **_adapter_kwargs(adapter),
             )
 
     thread = threading.Thread(target=_gen)
     thread.start()
 
-    produced = []
-    for chunk in streamer:
-        if first_token_time[0] is None:
-            first_token_time[0] = time.perf_counter()
-        produced.append(chunk)
-        yield chunk
+    streamed = False
+    try:
+        for chunk in streamer:
+            if first_token_time[0] is None:
+                first_token_time[0] = time.perf_counter()
+            if out_matcher is not None:
+                chunk = out_matcher.feed(chunk)
+            if chunk:
+                yield chunk
+        streamed = True
+    finally:
+        if not streamed:  # consumer left mid-stream: stop decoding before the admission slot is freed
+            cancel.cancel("consumer_closed")
+            thread.join()
+    if out_matcher is not None:
+        tail = out_matcher.flush()
+        if tail:
+            yield tail
 
     thread.join()
     t1 = time.perf_counter()
+    out = result.get("out")
+    n_new = streamer.tokens
+    buffer.record_reply(streamer.ids)
+    trace.decode_timeline(t0, streamer.step_times, streamer.step_tokens)
+    trace.accumulate("detokenize", streamer.detok_s, len(streamer.step_times))
+    if out is not None:
+        if cancel.cancelled:
+            metrics["stop_reason"] = "cancelled"
+        elif gen_matcher is not None and gen_matcher.stopped:
+            metrics["stop_reason"] = gen_matcher.reason
+        else:
+            metrics["stop_reason"] = "max_new_tokens" if n_new >= max_new_tokens else "eos"
+        if first_token_time[0] is not None and n_new > 1 and t1 > first_token_time[0]:
+            metrics["tok_per_s"] = (n_new - 1) / (t1 - first_token_time[0])  # decode rate after the first token
+            metrics["tpot_ms"] = 1000.0 / metrics["tok_per_s"]
+        if engine is not None:
+            metrics.update({"static_bucket": out.stats["bucket"], "compiled": out.stats["compiled"]})
+        elif drafter is not None:
+            s = out.stats
+            metrics.update({"spec_drafted": s["drafted"], "spec_accepted": s["accepted"],
+                            "acceptance_rate": s["acceptance_rate"], "spec_steps": s["steps"]})
+    if cache is not None and out is not None:
+        # keep prompt + reply KV so the next turn only prefills the new message
+        layers = kv_cache.cache_to_layers(out.past_key_values)
+        n = kv_cache.seq_len(layers)
+        cache.insert(out.sequences[0, :n].tolist(), kv_cache.clone(layers))
     if first_token_time[0] is not None:
         metrics["ttft_ms"] = (first_token_time[0] - t0) * 1000.0
         metrics["gen_ms"]  = (t1 - first_token_time[0]) * 1000.0
     metrics["wall_s"] = t1 - t0
+    metrics["gen_tokens"] = n_new
+    _log_cpu_rate(metrics)
 
-    # rough output token count from final text
-    final_text = "".join(produced)
-    metrics["gen_tokens"] = len(tok(final_text, add_special_tokens=False).input_ids)
-
-    _last_metrics.update(metrics)
+@_admitted
+def score_answer(messages, *, base_id: str, adapter_path: str, load_in_4bit: bool,
+                 temperature: float = 1.0, memory_budget_gb: float = None,
+                 merged_dir: str = None, session: str = None,
+                 cancel: CancelToken = None, trace: Trace = None, done: _Cleanup = None) -> Iterator[str]:
+    """
+    Answer-only mode: one prefill over the prompt + "Answer:" and a pick among the
+    A/B/C/D letter logits instead of decoding. Yields a single chunk so callers can
+    treat it like stream_generate. session: as for stream_generate.
+    """
+    model, tok, adapter = load_hf(base_id, adapter_path, load_in_4bit, memory_budget_gb, merged_dir)
+    if adapter is None:
+        done.add(_registry.lease(model))
+    if cancel.cancelled:
+        trace.metrics.update({"stop_reason": "cancelled", "gen_tokens": 0, "ttft_ms": None})
+        return
+    t0 = time.perf_counter()
+    with trace.span("chat_template"):
+        prompt_ids = _session_tokens(tok, session).prompt_ids(messages, ANSWER_PREFIX)
+    if tok not in _letter_ids:
+        _letter_ids[tok] = letter_token_ids(tok)
+    input_ids = torch.tensor([prompt_ids])
+    with trace.span("prefill"):
+        letters, probs, _ = score_inputs(model, input_ids, torch.ones_like(input_ids), _letter_ids[tok],
+                                         temperature, **_adapter_kwargs(adapter))
+    t1 = time.perf_counter()
+    trace.first_token(t1)
+    p = probs[0].tolist()
+    trace.metrics.update({
+        "prompt_tokens": len(prompt_ids),
+        "gen_tokens": 1, "ttft_ms": (t1 - t0) * 1000.0, "gen_ms": 0.0, "wall_s": t1 - t0,
+        "cached_tokens": 0, "stop_reason": "letter_score", "letter_probs": dict(zip(LETTERS, p)),
+    })
+    yield format_answer(letters[0], p)
 
-_last_metrics: Dict[str, float] = {}
 def get_last_metrics() -> Dict[str, float]:
-    return dict(_last_metrics)
+    """Metrics of the most recently finished request in this process (single-user scripts);
+    concurrent callers should pass their own tracing.Trace and read trace.metrics."""
+    trace = _last["trace"]
+    return dict(trace.metrics) if trace is not None else {}
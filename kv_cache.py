@@ -0,0 +1,75 @@
+# kv_cache.py
+"""
+Small helpers for moving past_key_values between HF Cache objects and plain
+per-layer (key, value) tuples, so caches can be split, padded and stored.
+Tensors are shaped (batch, kv_heads, seq_len, head_dim).
+"""
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+
+Layers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+def cache_to_layers(cache) -> Layers:
+    """Cache object (or legacy tuple) -> list of (key, value) per layer."""
+    if cache is None:
+        return []
+    if hasattr(cache, "layers"):          # transformers >= 4.56
+        return [(l.keys, l.values) for l in cache.layers]
+    if hasattr(cache, "to_legacy_cache"):  # older DynamicCache
+        return [tuple(kv) for kv in cache.to_legacy_cache()]
+    return [tuple(kv) for kv in cache]
+
+def layers_to_cache(layers: Sequence[Tuple[torch.Tensor, torch.Tensor]]):
+    """List of (key, value) per layer -> fresh DynamicCache the model can extend."""
+    from transformers import DynamicCache
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(layers))
+    return DynamicCache(list(layers))
+
+def seq_len(layers: Layers) -> int:
+    return int(layers[0][0].shape[-2]) if layers else 0
+
+def nbytes(layers: Layers) -> int:
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+def crop(layers: Layers, length: int) -> Layers:
+    """Keep the first `length` positions (views, no copy)."""
+    return [(k[..., :length, :], v[..., :length, :]) for k, v in layers]
+
+def clone(layers: Layers) -> Layers:
+    """Detach from any larger batched tensor so the storage can be freed."""
+    return [(k.clone(), v.clone()) for k, v in layers]
+
+def select(layers: Layers, row: int, start: int = 0, end: Optional[int] = None) -> Layers:
+    """Take one batch row, positions [start:end) (drops left-pad positions)."""
+    return [(k[row:row + 1, :, start:end, :], v[row:row + 1, :, start:end, :]) for k, v in layers]
+
+def concat(a: Layers, b: Layers) -> Layers:
+    """Join two caches along the sequence axis."""
+    return [(torch.cat([ka, kb], dim=-2), torch.cat([va, vb], dim=-2)) for (ka, va), (kb, vb) in zip(a, b)]
+
+def empty_like(layers: Layers) -> Layers:
+    """Zero-length single-row cache with the same heads/dims/dtype/device."""
+    return [(k[:1, :, :0, :], v[:1, :, :0, :]) for k, v in layers]
+
+def left_pad_stack(per_seq: Sequence[Layers]) -> Tuple[Layers, List[int]]:
+    """
+    Stack single-row caches of different lengths into one batch, left-padding
+    with zeros. Returns (batched_layers, pad_per_row); callers mask the pads.
+    """
+    lengths = [seq_len(s) for s in per_seq]
+    longest = max(lengths)
+    pads = [longest - n for n in lengths]
+    batched = []
+    for layer_idx in range(len(per_seq[0])):
+        ks, vs = [], []
+        for s, pad in zip(per_seq, pads):
+            k, v = s[layer_idx]
+            if pad:
+                k = torch.nn.functional.pad(k, (0, 0, pad, 0))
+                v = torch.nn.functional.pad(v, (0, 0, pad, 0))
+            ks.append(k)
+            vs.append(v)
+        batched.append((torch.cat(ks, dim=0), torch.cat(vs, dim=0)))
+    return batched, pads
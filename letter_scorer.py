@@ -0,0 +1,94 @@
+# letter_scorer.py
+"""
+Decode-free A/B/C/D scoring for answer-only MCQs.
+
+One forward pass over (chat prompt + "Answer:") and a comparison of the
+next-token logits of the four option letters. Tokenizers spell a letter after
+"Answer:" differently ("A", " A", "▁A"), so every single-token variant of a
+letter is pooled with logsumexp before the 4-way softmax. Probabilities are
+temperature-scaled; fit_temperature() picks T on labelled data.
+"""
+import math
+from typing import Dict, List, Sequence, Tuple
+
+import torch
+
+LETTERS = "ABCD"
+ANSWER_PREFIX = "Answer:"
+
+def letter_token_ids(tok) -> Dict[str, List[int]]:
+    """Single-token spellings of each letter ("A", " A", ...) for this tokenizer."""
+    ids: Dict[str, List[int]] = {}
+    for letter in LETTERS:
+        variants = set()
+        for spelling in (letter, " " + letter):
+            enc = tok.encode(spelling, add_special_tokens=False)
+            if len(enc) == 1:
+                variants.add(enc[0])
+            elif len(enc) == 2 and tok.decode(enc[:1]).strip() == "":
+                variants.add(enc[1])  # sentencepiece: lone "▁" + "A"
+        if not variants:
+            raise ValueError(f"tokenizer has no single-token spelling for {letter!r}")
+        ids[letter] = sorted(variants)
+    return ids
+
+def _letter_logits(last_logits: torch.Tensor, letter_ids: Dict[str, List[int]]) -> torch.Tensor:
+    """(batch, vocab) -> (batch, 4), pooling the spelling variants of each letter."""
+    cols = [torch.logsumexp(last_logits[:, letter_ids[l]].float(), dim=-1) for l in LETTERS]
+    return torch.stack(cols, dim=-1)
+
+def score_texts(model, tok, texts: Sequence[str], temperature: float = 1.0,
+                letter_ids: Dict[str, List[int]] = None,
+                adapter_names: List[str] = None) -> Tuple[List[str], torch.Tensor, torch.Tensor]:
+    """
+    texts: fully rendered prompts ending in ANSWER_PREFIX.
+    adapter_names: PEFT adapter per call (one name is broadcast over the batch).
+    Returns (letters, probs (batch, 4), raw letter logits (batch, 4)).
+    """
+    letter_ids = letter_ids or letter_token_ids(tok)
+    inputs = tok(list(texts), return_tensors="pt", padding=True, add_special_tokens=False)
+    return score_inputs(model, inputs["input_ids"], inputs["attention_mask"], letter_ids, temperature, adapter_names)
+
+def score_inputs(model, input_ids: torch.Tensor, attention_mask: torch.Tensor, letter_ids: Dict[str, List[int]],
+                 temperature: float = 1.0, adapter_names: List[str] = None) -> Tuple[List[str], torch.Tensor, torch.Tensor]:
+    """score_texts on already tokenized, left-padded prompts (e.g. dataset_cache.TokenizedSet.collate)."""
+    input_ids, attention_mask = input_ids.to(model.device), attention_mask.to(model.device)
+    pos = (attention_mask.cumsum(-1) - 1).clamp(min=0)  # left padding: real tokens start at 0
+    extra = {}
+    if adapter_names:
+        extra["adapter_names"] = list(adapter_names) * (len(input_ids) // len(adapter_names))
+    with torch.no_grad():
+        logits = model(input_ids=input_ids, attention_mask=attention_mask, position_ids=pos,
+                       use_cache=False, **extra).logits[:, -1, :]
+    raw = _letter_logits(logits, letter_ids).cpu()
+    probs = torch.softmax(raw / temperature, dim=-1)
+    letters = [LETTERS[i] for i in probs.argmax(-1).tolist()]
+    return letters, probs, raw
+
+def fit_temperature(raw_logits: torch.Tensor, gold: Sequence[int]) -> float:
+    """Temperature minimising NLL on labelled rows (coarse-to-fine grid, no optimiser deps)."""
+    target = torch.tensor(list(gold), dtype=torch.long)
+
+    def nll(t):
+        return torch.nn.functional.cross_entropy(raw_logits / t, target).item()
+
+    grid = [math.exp(x / 10.0) for x in range(-30, 31)]  # ~0.05 .. 20
+    best = min(grid, key=nll)
+    fine = [best * math.exp(x / 100.0) for x in range(-10, 11)]
+    return min(fine, key=nll)
+
+def expected_calibration_error(probs: torch.Tensor, gold: Sequence[int], bins: int = 10) -> float:
+    conf, pred = probs.max(-1)
+    correct = (pred == torch.tensor(list(gold))).float()
+    ece = 0.0
+    for b in range(bins):
+        lo, hi = b / bins, (b + 1) / bins
+        in_bin = (conf > lo) & (conf <= hi)
+        if in_bin.any():
+            ece += in_bin.float().mean().item() * abs(conf[in_bin].mean().item() - correct[in_bin].mean().item())
+    return ece
+
+def format_answer(letter: str, probs: Sequence[float]) -> str:
+    """Chat-friendly rendering: the letter plus the 4-way distribution."""
+    dist = " · ".join(f"{l} {p * 100:.0f}%" for l, p in zip(LETTERS, probs))
+    return f"Answer: {letter}\n\n_{dist}_"
@@ -0,0 +1,327 @@
+# loadgen.py
+"""
+Load generator: replays a prompt corpus against the HF or Ollama backend under
+concurrency and reports latency percentiles, throughput and peak memory.
+
+    python loadgen.py --backend hf --tiny --concurrency 4 --requests 32          # CPU, tiny random model
+    python loadgen.py --backend ollama --mock-ollama --arrival poisson --rate 8  # local mock server
+    python loadgen.py --backend hf --data medmcqa_val.jsonl --arrival poisson --rate 2 \\
+        --max-new 256 --out bench/qwen_rate2.json
+
+Requests are built the way chat_core sends them: HF goes through
+hf_backend.stream_generate / score_answer with the config.py settings
+(admission, batching, prefix cache, speculative, static decode), and Ollama
+through ollama.chat with the same options.
+
+Corpus rows (JSONL or CSV): MedMCQA rows (question, opa..opd) become the
+explanation or answer-only prompt; rows with "messages" are sent as is; rows
+with "prompt" / "body" / "content" / "text" become one user message. The rows
+cycle until --requests have been sent.
+
+Arrivals:
+  closed   --concurrency clients send back to back (throughput at a fixed load)
+  poisson  open loop at --rate requests/s (exponential gaps); at most
+           --concurrency are in flight and latency counts from the arrival time,
+           so client-side waiting shows up in TTFT
+
+Per request: TTFT (arrival -> first chunk), TPOT ((last - first chunk) / (tokens - 1),
+with token counts from the backend), e2e. The report has p50/p95/p99 and the mean of
+each, plus requests/s and output tokens/s over the run and peak RSS (and CUDA)
+memory. --out writes it all as JSON (config, summary, per-request rows), so runs can
+be compared.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from config import MODEL, MODEL_CHOICES, OLLAMA_NUM_CTX, HF_LOAD_IN_4BIT, HF_MAX_NEW_TOKENS
+from config import HF_CONTINUOUS_BATCHING, HF_MAX_BATCH_SIZE, HF_PREFIX_CACHE_MB, HF_MODEL_MEMORY_GB, HF_MERGED_DIR
+from config import HF_MAX_CONCURRENCY, HF_MAX_QUEUE, HF_QUEUE_TIMEOUT_S
+from config import HF_CPU_PROFILE, HF_CPU_THREADS, HF_CPU_INTEROP_THREADS, HF_CPU_PIN_CORES
+from config import HF_STATIC_DECODE, HF_STATIC_MIN_BUCKET, HF_COMPILE_DECODE, CONTEXT_TOKENS
+from config import HF_SPECULATIVE, HF_DRAFT_MODEL_ID, HF_SPEC_NUM_DRAFT, HF_SPEC_MAX_DRAFT, HF_SPEC_NGRAM
+from config import STOP_STRINGS, STOP_REGEXES, EXPLANATION_MAX_SENTENCES
+from config import LETTER_SCORE_TEMPERATURE, ANSWER_ONLY_MAX_TOKENS
+from batch_eval import read_rows
+from test_adapter import ANSWER_ONLY_PROMPT, EXPLAIN_PROMPT
+
+SYSTEM = "You are a medical expert."
+_BUILTIN = [
+    {"question": "Which nerve supplies the lateral rectus muscle?",
+     "opa": "Oculomotor", "opb": "Trochlear", "opc": "Abducens", "opd": "Facial"},
+    {"question": "Which enzyme is deficient in classic phenylketonuria?",
+     "opa": "Tyrosinase", "opb": "Phenylalanine hydroxylase", "opc": "Homogentisate oxidase",
+     "opd": "Fumarylacetoacetate hydrolase"},
+    {"question": "The main site of erythropoietin production in adults is",
+     "opa": "Liver", "opb": "Bone marrow", "opc": "Peritubular cells of the kidney", "opd": "Spleen"},
+    {"question": "Which of the following shifts the oxygen dissociation curve to the left? "
+                 "Consider the effects of temperature, pH, 2,3-BPG and carbon monoxide on haemoglobin affinity.",
+     "opa": "Increased 2,3-BPG", "opb": "Fever", "opc": "Acidosis", "opd": "Carbon monoxide"},
+]
+
+# ---- corpus ----
+def row_messages(row: Dict, answer_only: bool = False) -> Optional[List[Dict]]:
+    if isinstance(row.get("messages"), list):
+        return row["messages"]
+    if row.get("question"):
+        template = ANSWER_ONLY_PROMPT if answer_only else EXPLAIN_PROMPT
+        prompt = template.format(**{k: row.get(k, "") for k in ("question", "opa", "opb", "opc", "opd")})
+        return [{"role": "system", "content": SYSTEM}, {"role": "user", "content": prompt.strip()}]
+    for key in ("prompt", "body", "content", "text"):
+        if row.get(key):
+            return [{"role": "user", "content": str(row[key])}]
+    return None
+
+def load_corpus(path: Optional[str], answer_only: bool, limit: int = 0) -> List[List[Dict]]:
+    rows = read_rows(path) if path else iter(_BUILTIN)
+    corpus = []
+    for row in rows:
+        messages = row_messages(row, answer_only)
+        if messages:
+            corpus.append(messages)
+        if limit and len(corpus) >= limit:
+            break
+    if not corpus:
+        raise SystemExit(f"no usable prompts in {path}")
+    return corpus
+
+# ---- one request ----
+def _drive(chunks, arrival: float) -> Dict:
+    """Consume a chunk iterator, timing it from the request's arrival."""
+    rec = {"ok": True, "error": None, "chunks": 0, "chars": 0}
+    first = last = None
+    try:
+        for chunk in chunks:
+            last = time.perf_counter()
+            first = first or last
+            rec["chunks"] += 1
+            rec["chars"] += len(chunk)
+    except Exception as e:
+        rec.update(ok=False, error=f"{type(e).__name__}: {e}"[:300])
+    end = time.perf_counter()
+    rec["ttft_ms"] = (first - arrival) * 1000.0 if first else None
+    rec["e2e_ms"] = (end - arrival) * 1000.0
+    rec["_first"], rec["_last"] = first, last
+    return rec
+
+def _finish(rec: Dict, tokens: Optional[int], **extra) -> Dict:
+    first, last = rec.pop("_first"), rec.pop("_last")
+    rec["tokens"] = tokens if tokens is not None else rec["chunks"]
+    rec["tpot_ms"] = (last - first) * 1000.0 / (rec["tokens"] - 1) if first and rec["tokens"] > 1 else None
+    rec.update(extra)
+    return rec
+
+def hf_runner(args) -> Callable[[List[Dict], float], Dict]:
+    from hf_backend import configure_admission, configure_cpu, score_answer, stream_generate
+    from tracing import Trace
+
+    configure_admission(HF_MAX_CONCURRENCY, HF_MAX_QUEUE, HF_QUEUE_TIMEOUT_S)
+    configure_cpu(HF_CPU_PROFILE, HF_CPU_THREADS, HF_CPU_INTEROP_THREADS, HF_CPU_PIN_CORES)
+    common = dict(base_id=args.base, adapter_path=args.adapter, load_in_4bit=HF_LOAD_IN_4BIT,
+                  memory_budget_gb=HF_MODEL_MEMORY_GB, merged_dir=HF_MERGED_DIR)
+    if args.answer_only:
+        fn, kwargs = score_answer, dict(common, temperature=LETTER_SCORE_TEMPERATURE)
+    else:
+        fn, kwargs = stream_generate, dict(
+            common, max_new_tokens=args.max_new,
+            batching=HF_CONTINUOUS_BATCHING if args.batching is None else args.batching,
+            max_batch_size=HF_MAX_BATCH_SIZE, prefix_cache_mb=HF_PREFIX_CACHE_MB,
+            speculative=HF_SPECULATIVE, draft_model_id=HF_DRAFT_MODEL_ID, num_draft_tokens=HF_SPEC_NUM_DRAFT,
+            max_draft_tokens=HF_SPEC_MAX_DRAFT, spec_ngram=HF_SPEC_NGRAM,
+            static_cache=HF_STATIC_DECODE, static_max_len=CONTEXT_TOKENS, static_min_bucket=HF_STATIC_MIN_BUCKET,
+            compile_decode=HF_COMPILE_DECODE, stop_strings=list(STOP_STRINGS), stop_regexes=list(STOP_REGEXES),
+            max_sentences=EXPLANATION_MAX_SENTENCES)
+
+    def run(messages, arrival):
+        trace = Trace("hf", model=args.base)
+        rec = _drive(fn(messages, trace=trace, **kwargs), arrival)
+        trace.finish()
+        m = trace.metrics
+        return _finish(rec, m.get("gen_tokens"), prompt_tokens=m.get("prompt_tokens"),
+                       cached_tokens=m.get("cached_tokens"), queue_ms=m.get("queue_ms"),
+                       stop_reason=m.get("stop_reason"))
+    return run
+
+def ollama_runner(args) -> Callable[[List[Dict], float], Dict]:
+    import ollama
+
+    client = ollama.Client(host=args.ollama_host) if args.ollama_host else ollama.Client()
+    options = {"num_ctx": OLLAMA_NUM_CTX, "num_predict": ANSWER_ONLY_MAX_TOKENS if args.answer_only else args.max_new}
+    if STOP_STRINGS:
+        options["stop"] = list(STOP_STRINGS)
+
+    def run(messages, arrival):
+        final = {}
+
+        def chunks():
+            for chunk in client.chat(model=args.model, messages=messages, stream=True, options=options):
+                if chunk.done:
+                    final.update(prompt_tokens=chunk.prompt_eval_count, tokens=chunk.eval_count,
+                                 stop_reason=chunk.done_reason)
+                content = chunk.message.content if chunk.message is not None else ""
+                if content:
+                    yield content
+
+        rec = _drive(chunks(), arrival)
+        return _finish(rec, final.pop("tokens", None), **final)
+    return run
+
+# ---- arrivals ----
+def run_load(run: Callable, corpus: List[List[Dict]], n: int, concurrency: int, arrival: str,
+             rate: float = 1.0, seed: int = 0) -> List[Dict]:
+    results: List[Optional[Dict]] = [None] * n
+
+    def task(i, t_arrival):
+        t = time.perf_counter() if t_arrival is None else t_arrival  # closed loop: arrives when a client is free
+        rec = run(corpus[i % len(corpus)], t)
+        rec.update(index=i, start_s=t - t0)
+        results[i] = rec
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="loadgen") as pool:
+        if arrival == "closed":
+            for i in range(n):
+                pool.submit(task, i, None)
+        else:
+            rng, t_next = random.Random(seed), t0
+            for i in range(n):
+                t_next += rng.expovariate(rate)
+                time.sleep(max(0.0, t_next - time.perf_counter()))
+                pool.submit(task, i, t_next)
+    return [r for r in results if r is not None]
+
+# ---- report ----
+def percentiles(values: List[float]) -> Optional[Dict[str, float]]:
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+
+    def pct(q):
+        k = (len(values) - 1) * q
+        lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+        return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+    return {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99), "mean": sum(values) / len(values), "n": len(values)}
+
+def peak_memory() -> Dict[str, Optional[float]]:
+    out = {"peak_rss_mb": None, "peak_cuda_mb": None}
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        out["peak_rss_mb"] = rss / 2 ** 20 if sys.platform == "darwin" else rss / 1024  # bytes on macOS, KiB on Linux
+    except ImportError:
+        pass
+    torch = sys.modules.get("torch")  # only the HF backend imports it
+    if torch is not None and torch.cuda.is_available():
+        out["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+    return out
+
+def summarize(results: List[Dict], wall_s: float) -> Dict:
+    ok = [r for r in results if r["ok"]]
+    tokens = sum(r["tokens"] or 0 for r in ok)
+    return {
+        "requests": len(results), "ok": len(ok), "errors": len(results) - len(ok),
+        "wall_s": wall_s, "req_per_s": len(ok) / wall_s if wall_s else None,
+        "output_tok_per_s": tokens / wall_s if wall_s else None, "output_tokens": tokens,
+        "ttft_ms": percentiles([r["ttft_ms"] for r in ok]),
+        "tpot_ms": percentiles([r["tpot_ms"] for r in ok]),
+        "e2e_ms": percentiles([r["e2e_ms"] for r in ok]),
+        "queue_ms": percentiles([r.get("queue_ms") for r in ok]),
+        **peak_memory(),
+    }
+
+def print_report(config: Dict, s: Dict):
+    print(f"{config['backend']} • {config['target']} • {config['arrival']}"
+          f"{' @ %.2f req/s' % config['rate'] if config['arrival'] == 'poisson' else ''} • "
+          f"concurrency {config['concurrency']} • {s['ok']}/{s['requests']} ok")
+    print(f"{'':10s}{'p50':>10s}{'p95':>10s}{'p99':>10s}{'mean':>10s}")
+    for key in ("ttft_ms", "tpot_ms", "e2e_ms", "queue_ms"):
+        p = s[key]
+        if p:
+            print(f"{key:10s}" + "".join(f"{p[q]:10.1f}" for q in ("p50", "p95", "p99", "mean")))
+    mem = f" • peak RSS {s['peak_rss_mb']:.0f} MB" if s["peak_rss_mb"] else ""
+    mem += f" • peak CUDA {s['peak_cuda_mb']:.0f} MB" if s["peak_cuda_mb"] else ""
+    print(f"throughput {s['req_per_s']:.2f} req/s • {s['output_tok_per_s']:.1f} tok/s{mem}")
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay a prompt corpus against the HF or Ollama backend under load")
+    ap.add_argument("--backend", choices=["hf", "ollama"], default="hf")
+    ap.add_argument("--data", default=None, help="JSONL/CSV corpus (default: a few built-in MedMCQA questions)")
+    ap.add_argument("--limit", type=int, default=0, help="use at most this many corpus rows")
+    ap.add_argument("--requests", type=int, default=32, help="requests to send (the corpus cycles)")
+    ap.add_argument("--warmup", type=int, default=1, help="requests sent first and left out of the stats")
+    ap.add_argument("--concurrency", type=int, default=4, help="clients (closed) / max in flight (poisson)")
+    ap.add_argument("--arrival", choices=["closed", "poisson"], default="closed")
+    ap.add_argument("--rate", type=float, default=1.0, help="poisson: mean requests per second")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--max-new", type=int, default=HF_MAX_NEW_TOKENS, help="output length budget")
+    ap.add_argument("--answer-only", action="store_true", help="HF letter scoring / short Ollama answers")
+    ap.add_argument("--out", default=None, help="write config + summary + per-request rows as JSON")
+    hf = ap.add_argument_group("hf")
+    hf.add_argument("--base", default=MODEL_CHOICES[MODEL]["base"])
+    hf.add_argument("--adapter", default=MODEL_CHOICES[MODEL]["adapter"])
+    hf.add_argument("--tiny", action="store_true", help="tiny random model on CPU (no download)")
+    hf.add_argument("--batching", action=argparse.BooleanOptionalAction, default=None,
+                    help="override HF_CONTINUOUS_BATCHING")
+    ol = ap.add_argument_group("ollama")
+    ol.add_argument("--model", default=MODEL, help="Ollama model name")
+    ol.add_argument("--ollama-host", default=None, help="default: OLLAMA_HOST or http://127.0.0.1:11434")
+    ol.add_argument("--mock-ollama", action="store_true", help="start mock_ollama.py in-process and use it")
+    ol.add_argument("--mock-prefill-ms", type=float, default=30.0)
+    ol.add_argument("--mock-tpot-ms", type=float, default=10.0)
+    ol.add_argument("--mock-parallel", type=int, default=4)
+    args = ap.parse_args()
+
+    if args.tiny:
+        from tiny_model import TINY_MODEL_ID
+        args.base, args.adapter = TINY_MODEL_ID, None
+    if args.mock_ollama:
+        import mock_ollama
+        server = mock_ollama.start(prefill_ms=args.mock_prefill_ms, tpot_ms=args.mock_tpot_ms,
+                                   parallel=args.mock_parallel)
+        args.ollama_host = server.url
+        print(f"[loadgen] mock Ollama on {server.url}")
+
+    corpus = load_corpus(args.data, args.answer_only, args.limit)
+    run = hf_runner(args) if args.backend == "hf" else ollama_runner(args)
+    if args.warmup:
+        run_load(run, corpus, args.warmup, 1, "closed")  # loads the model, compiles, fills caches
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+
+    t0 = time.perf_counter()
+    results = run_load(run, corpus, args.requests, args.concurrency, args.arrival, args.rate, args.seed)
+    summary = summarize(results, time.perf_counter() - t0)
+    config = {"backend": args.backend, "target": args.base if args.backend == "hf" else args.model,
+              "adapter": args.adapter if args.backend == "hf" else None, "data": args.data,
+              "corpus_size": len(corpus), "requests": args.requests, "warmup": args.warmup,
+              "concurrency": args.concurrency, "arrival": args.arrival, "rate": args.rate, "seed": args.seed,
+              "max_new": args.max_new, "answer_only": args.answer_only, "mock_ollama": args.mock_ollama,
+              "git": _git_rev(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    print_report(config, summary)
+    for r in results:
+        if r["error"]:
+            print(f"[loadgen] first error: {r['error']}")
+            break
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "summary": summary, "requests": results}, f, indent=2)
+        print(f"[loadgen] wrote {args.out}")
+
+if __name__ == "__main__":
+    main()
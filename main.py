@@ -1,9 +1,9 @@
 # main.py
 import time
 import streamlit as st
-from config import PAGE_TITLE, PAGE_ICON
-from ui import render_header, render_sidebar, render_chat_history
-from chat_core import generate_response, chat_once_fallback
+from config import PAGE_TITLE, PAGE_ICON, WARMUP_ON_START, STREAM_FLUSH_MS, STREAM_FLUSH_CHARS
+from ui import render_header, render_sidebar, render_chat_history, coalesce_stream
+from chat_core import generate_response, chat_once_fallback, start_warmup, streamed_text
 
 # ---- Page config ----
 st.set_page_config(page_title=PAGE_TITLE, page_icon=PAGE_ICON, layout="wide")
@@ -13,7 +13,23 @@ render_header()
 
 # ---- Sidebar controls ----
 with st.sidebar:
-    use_system, system_prompt_text = render_sidebar()
+    use_system, system_prompt_text, answer_only = render_sidebar()
+
+# ---- Background model warm-up (once per process) ----
+@st.fragment(run_every=1.0)
+def warmup_progress():
+    job = start_warmup()
+    if job.done:
+        st.rerun()  # full rerun: the finished job is shown in the sidebar and this poller goes away
+    st.progress(job.progress, text=f"Loading {job.target['label']}… {job.stage or 'starting'}")
+
+if WARMUP_ON_START:
+    job = start_warmup()
+    if job.done:
+        with st.sidebar:
+            st.caption(f"Cold start: {job.summary()}")
+    else:
+        warmup_progress()
 
 # ---- Chat state ----
 if "messages" not in st.session_state:
@@ -32,25 +48,26 @@ if prompt:
 
     # Assistant turn
     t0 = time.perf_counter()
-    st.session_state["full_message"] = ""
     with st.chat_message("assistant"):
         # Trim indicator (from any previous prep; will refresh during generate)
-        before_after = st.session_state.get("__last_trim_info")
-        if before_after and before_after[0] > before_after[1]:
-            st.caption(f"Context trimmed: {before_after[0]} → {before_after[1]} chars")
+        trim = st.session_state.get("__last_trim_info")
+        if trim and trim[0] > trim[1]:
+            st.caption(f"Context trimmed: {trim[0]} → {trim[1]} tokens ({trim[2]} → {trim[3]} chars)")
 
         # Stream
-        stream = generate_response(use_system=use_system, system_prompt_text=system_prompt_text)
-        streamed = st.write_stream(stream)  # may return None/[]
+        stream = generate_response(use_system=use_system, system_prompt_text=system_prompt_text,
+                                   answer_only=answer_only)
+        streamed = st.write_stream(coalesce_stream(stream, STREAM_FLUSH_MS, STREAM_FLUSH_CHARS))  # may return None/[]
 
-        assistant_text = streamed if isinstance(streamed, str) and streamed.strip() \
-                         else st.session_state.get("full_message", "").strip()
+        assistant_text = streamed if isinstance(streamed, str) and streamed.strip() else streamed_text().strip()
 
-        # Fallback if stream produced nothing
-        if not assistant_text:
-            txt, _ = chat_once_fallback(use_system=use_system, system_prompt_text=system_prompt_text)
-            assistant_text = txt or "_(no response)_"
-            st.markdown(assistant_text)
+        # Fallback if the stream produced nothing, or broke off (Ollama continues the partial reply)
+        if not assistant_text or (st.session_state.get("__last_metrics") or {}).get("interrupted"):
+            txt, _ = chat_once_fallback(use_system=use_system, system_prompt_text=system_prompt_text,
+                                        answer_only=answer_only, partial=assistant_text)
+            shown = assistant_text if txt and txt.startswith(assistant_text) else ""
+            assistant_text = txt or assistant_text or "_(no response)_"
+            st.markdown(assistant_text[len(shown):])
 
         # Elapsed
         elapsed = time.perf_counter() - t0
@@ -65,6 +82,14 @@ if prompt:
             extra = []
             if pe_ms is not None:  extra.append(f"TTFT {pe_ms:.0f} ms")
             if gen_ms is not None: extra.append(f"gen {gen_ms:.0f} ms")
+            if m.get("cached_tokens"): extra.append(f"{m['cached_tokens']} cached")
+            if (m.get("queue_ms") or 0) >= 1: extra.append(f"queued {m['queue_ms']:.0f} ms")
+            if (m.get("load_ms") or 0) >= 1: extra.append(f"model load {m['load_ms']:.0f} ms")
+            if m.get("tpot_ms"): extra.append(f"TPOT {m['tpot_ms']:.1f} ms")
+            if m.get("tok_per_s"): extra.append(f"{m['tok_per_s']:.1f} tok/s")
+            if m.get("acceptance_rate") is not None: extra.append(f"draft accept {m['acceptance_rate']:.0%}")
+            if (m.get("ui_flush_ms") or 0) >= 1: extra.append(f"render {m['ui_flush_ms']:.0f} ms")
+            if m.get("stop_reason"): extra.append(f"stop: {m['stop_reason']}")
             tail = f" • {' • '.join(extra)}" if extra else ""
             st.caption(f"{toks_in}/{toks_out} tokens{tail}")
 
@@ -0,0 +1,211 @@
+# merge_export.py
+"""
+Merge a LoRA adapter into its base model and export it as sharded safetensors.
+
+    python merge_export.py --base Qwen/Qwen2.5-7B-Instruct \
+        --adapter Pk3112/medmcqa-lora-qwen2.5-7b-instruct --quantize bnb4
+
+writes merged/<base>__<adapter>/ with the merged weights, the tokenizer, an
+optional pre-quantized 4-bit copy (bnb4/, needs CUDA + bitsandbytes) and
+merged_manifest.json recording the base/adapter revisions it was built from.
+
+load_hf / load_base_and_adapter call find_merged() first: a fresh artifact is
+loaded straight from the memory-mapped safetensors (no PEFT wrapper, no per-token
+LoRA matmuls, no separate adapter download). If the base or adapter revision
+changed since export the artifact is reported stale and ignored.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Dict, Optional
+
+import torch
+
+MANIFEST = "merged_manifest.json"
+QUANT_DIR = "bnb4"
+_SMALL_FILE = 16 * 2 ** 20  # content-hash files below this size, stat the rest
+
+def artifact_dir(root: str, base_id: str, adapter_path: str) -> str:
+    slug = lambda s: re.sub(r"[^\w.-]", "_", s.rstrip("/").split("/")[-1])
+    tag = hashlib.blake2b(f"{base_id}\n{adapter_path}".encode("utf-8"), digest_size=4).hexdigest()
+    return os.path.join(root, f"{slug(base_id)}__{slug(adapter_path)}_{tag}")
+
+def _dir_fingerprint(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for name in sorted(os.listdir(path)):
+        full = os.path.join(path, name)
+        if not os.path.isfile(full):
+            continue
+        st = os.stat(full)
+        h.update(f"{name}\0{st.st_size}\0".encode("utf-8"))
+        if st.st_size < _SMALL_FILE:
+            with open(full, "rb") as f:
+                h.update(f.read())
+        else:
+            h.update(str(st.st_mtime_ns).encode("utf-8"))
+    return "dir:" + h.hexdigest()
+
+def revision(path_or_id: str, allow_network: bool = True) -> Optional[str]:
+    """Revision of a local folder (fingerprint) or Hub repo (current commit sha, asked from the
+    Hub). Offline it is the locally cached snapshot's sha, which may be behind upstream, and
+    a line says so. None if unknown."""
+    if os.path.isdir(path_or_id):
+        return _dir_fingerprint(path_or_id)
+    if allow_network:
+        try:
+            from huggingface_hub import HfApi
+            return "hub:" + HfApi().model_info(path_or_id, timeout=10).sha
+        except Exception as e:
+            print(f"[merge] {path_or_id}: Hub unreachable ({type(e).__name__}); "
+                  f"comparing against the locally cached revision, upstream changes go unnoticed")
+    try:
+        from huggingface_hub import snapshot_download
+        # the cached snapshot folder is named after the commit sha
+        return "hub:" + os.path.basename(snapshot_download(path_or_id, local_files_only=True))
+    except Exception:
+        return None
+
+def read_manifest(path: str) -> Optional[Dict]:
+    try:
+        with open(os.path.join(path, MANIFEST), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def check_manifest(path: str, base_id: str = None, adapter_path: str = None) -> Optional[str]:
+    """Reason the artifact at `path` can't be used, or None if it is fresh."""
+    manifest = read_manifest(path)
+    if manifest is None:
+        return "no manifest"
+    for name, size in manifest.get("files", {}).items():
+        full = os.path.join(path, name)
+        if not os.path.isfile(full) or os.path.getsize(full) != size:
+            return f"missing or truncated {name}"
+    for key, src in (("base", base_id or manifest["base_id"]), ("adapter", adapter_path or manifest["adapter_path"])):
+        recorded = manifest.get(f"{key}_revision")
+        current = revision(src)
+        if not recorded or not current:
+            return f"unknown {key} revision ({recorded or 'not recorded'} -> {current or 'not found'})"
+        if recorded != current:
+            return f"{key} changed ({recorded} -> {current})"
+    return None
+
+def find_merged(root: Optional[str], base_id: str, adapter_path: Optional[str]) -> Optional[str]:
+    """Fresh merged artifact for (base, adapter) under root, else None (stale ones are reported)."""
+    if not root or not adapter_path:
+        return None
+    path = artifact_dir(root, base_id, adapter_path)
+    if not os.path.isdir(path):
+        return None
+    problem = check_manifest(path, base_id, adapter_path)
+    if problem:
+        print(f"[merge] ignoring {path}: {problem}; re-run merge_export.py")
+        return None
+    return path
+
+def load_merged(path: str, load_in_4bit: bool):
+    """(model, tok) from a merged artifact; uses the pre-quantized copy for 4-bit when present."""
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    quant = os.path.join(path, QUANT_DIR)
+    kwargs = dict(device_map="auto", low_cpu_mem_usage=True)  # safetensors are mmapped, not copied
+    if load_in_4bit and os.path.isdir(quant):
+        src = quant  # quantization config is stored with the weights
+    else:
+        src = path
+        kwargs["torch_dtype"] = torch.float16 if torch.cuda.is_available() else torch.float32
+        if load_in_4bit:
+            kwargs.update(dict(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_compute_dtype=torch.bfloat16 if torch.cuda.is_available() else torch.float32,
+            ))
+    tok = AutoTokenizer.from_pretrained(path, use_fast=True)
+    model = AutoModelForCausalLM.from_pretrained(src, **kwargs)
+
+    tok.padding_side = "left"
+    if tok.pad_token is None:
+        tok.pad_token = tok.eos_token
+    model.config.pad_token_id = tok.pad_token_id
+    model.eval()
+    return model, tok
+
+def export(base_id: str, adapter_path: str, out: str, dtype: str = "bfloat16",
+           max_shard_size: str = "2GB", quantize: Optional[str] = None) -> str:
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    import peft
+    import transformers
+    from peft import PeftModel
+
+    os.makedirs(out, exist_ok=True)
+    if os.path.exists(os.path.join(out, MANIFEST)):
+        os.remove(os.path.join(out, MANIFEST))  # half-written exports must not look fresh
+
+    t0 = time.perf_counter()
+    tok = AutoTokenizer.from_pretrained(base_id, use_fast=True)
+    model = AutoModelForCausalLM.from_pretrained(base_id, torch_dtype=getattr(torch, dtype), low_cpu_mem_usage=True)
+    model = PeftModel.from_pretrained(model, adapter_path).merge_and_unload()
+    model.save_pretrained(out, safe_serialization=True, max_shard_size=max_shard_size)
+    tok.save_pretrained(out)
+    print(f"[merge] merged weights -> {out} ({time.perf_counter() - t0:.1f}s)")
+
+    variants = {}
+    if quantize == "bnb4":
+        from transformers import BitsAndBytesConfig
+        del model
+        qcfg = BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_use_double_quant=True,
+                                  bnb_4bit_compute_dtype=torch.bfloat16)
+        qmodel = AutoModelForCausalLM.from_pretrained(out, quantization_config=qcfg, device_map="auto")
+        qmodel.save_pretrained(os.path.join(out, QUANT_DIR), safe_serialization=True, max_shard_size=max_shard_size)
+        variants[QUANT_DIR] = {"quantization": "bitsandbytes nf4, double quant"}
+        print(f"[merge] 4-bit variant -> {os.path.join(out, QUANT_DIR)}")
+
+    files = {}
+    for dirpath, _, names in os.walk(out):
+        for name in names:
+            rel = os.path.relpath(os.path.join(dirpath, name), out)
+            if rel != MANIFEST:
+                files[rel] = os.path.getsize(os.path.join(dirpath, name))
+    manifest = {
+        "format": 1,
+        "base_id": base_id,
+        "adapter_path": adapter_path,
+        "base_revision": revision(base_id),
+        "adapter_revision": revision(adapter_path),
+        "dtype": dtype,
+        "variants": variants,
+        "files": files,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "versions": {"torch": torch.__version__, "transformers": transformers.__version__, "peft": peft.__version__},
+    }
+    tmp = os.path.join(out, MANIFEST + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, os.path.join(out, MANIFEST))  # written last: its presence means complete
+    return out
+
+def main():
+    ap = argparse.ArgumentParser(description="Merge a LoRA adapter into its base and export safetensors")
+    ap.add_argument("--base", required=True)
+    ap.add_argument("--adapter", required=True)
+    ap.add_argument("--root", default="merged", help="artifacts go to <root>/<base>__<adapter>_<hash>/")
+    ap.add_argument("--out", default=None, help="explicit output folder (overrides --root)")
+    ap.add_argument("--dtype", choices=["bfloat16", "float16", "float32"], default="bfloat16")
+    ap.add_argument("--max-shard-size", default="2GB")
+    ap.add_argument("--quantize", choices=["bnb4"], default=None,
+                    help="also write a pre-quantized 4-bit copy (CUDA + bitsandbytes)")
+    ap.add_argument("--check", action="store_true", help="only report whether the artifact is fresh")
+    args = ap.parse_args()
+
+    out = args.out or artifact_dir(args.root, args.base, args.adapter)
+    if args.check:
+        problem = check_manifest(out, args.base, args.adapter)
+        print(f"{out}: {problem or 'fresh'}")
+        raise SystemExit(1 if problem else 0)
+    export(args.base, args.adapter, out, args.dtype, args.max_shard_size, args.quantize)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+# mock_ollama.py
+"""
+Stand-in for a local Ollama server, for benchmarks and smoke tests without a
+GPU, a model download or network.
+
+    python mock_ollama.py --port 11434 --prefill-ms 40 --tpot-ms 15 --parallel 2
+
+    POST /api/chat      NDJSON stream ("stream": true, the default) or one JSON object
+    GET  /api/tags      the served model names
+    GET  /api/ps        the models currently loaded
+    GET  /api/version
+
+Replies are canned MCQ explanations, repeated up to options.num_predict, one
+word per streamed chunk. A conversation ending in an assistant message is
+continued: the reply skips the words that message already holds.
+A model not in memory first sleeps load_ms (reported as load_duration) and then
+stays loaded for the request's keep_alive ("5m", seconds, 0 = unload, negative
+= forever; default 5m). An empty messages list only loads, like Ollama.
+fail_after > 0 drops the connection after that many streamed words, for
+testing how clients survive a daemon that dies mid-reply. Prefill sleeps prefill_ms plus prefill_ms_per_token per
+prompt word, then every word sleeps tpot_ms, so latency has a realistic shape.
+`parallel` requests decode at once, the rest wait (like OLLAMA_NUM_PARALLEL).
+The final chunk carries Ollama's counters and durations (nanoseconds).
+Streams use chunked transfer encoding on HTTP/1.1 keep-alive connections.
+A closed client connection stops the reply.
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+REPLY = ("Answer: C\nExplanation: The lateral rectus is supplied by the abducens nerve (cranial nerve VI). "
+         "The oculomotor nerve supplies most other extraocular muscles, the trochlear nerve supplies the "
+         "superior oblique, and the facial nerve has no role in eye movement. A sixth nerve palsy therefore "
+         "causes a convergent squint with horizontal diplopia on looking to the affected side.")
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+class MockOllama(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, addr, prefill_ms: float = 30.0, tpot_ms: float = 10.0, prefill_ms_per_token: float = 0.05,
+                 parallel: int = 4, models: Optional[List[str]] = None, load_ms: float = 0.0, fail_after: int = 0):
+        super().__init__(addr, _Handler)
+        self.prefill_ms = prefill_ms
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.tpot_ms = tpot_ms
+        self.models = models  # None = accept any model name
+        self.load_ms = load_ms
+        self.fail_after = fail_after
+        self.slots = threading.Semaphore(parallel)
+        self.loaded: Dict[str, float] = {}  # model -> unload time (time.monotonic(); inf = pinned)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "aborted": 0, "connections": 0, "loads": 0}
+
+    def load(self, model: str, keep_alive) -> float:
+        """Seconds spent loading (0 if resident); then keep the model for keep_alive."""
+        now, waited = time.monotonic(), 0.0
+        with self.lock:
+            cold = self.loaded.get(model, 0.0) <= now
+            if cold:
+                self.stats["loads"] += 1
+        if cold and self.load_ms:
+            waited = self.load_ms / 1000.0
+            time.sleep(waited)
+        ttl = _seconds(keep_alive)
+        with self.lock:
+            if ttl == 0:
+                self.loaded.pop(model, None)
+            else:
+                self.loaded[model] = float("inf") if ttl < 0 else time.monotonic() + ttl
+        return waited
+
+    def resident(self) -> List[str]:
+        now = time.monotonic()
+        with self.lock:
+            return [m for m, until in self.loaded.items() if until > now]
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+def _seconds(keep_alive) -> float:
+    """Ollama's keep_alive: a number of seconds or a duration string ("30s", "5m", "1h"); default 5m."""
+    if keep_alive is None or keep_alive == "":
+        return 300.0
+    if isinstance(keep_alive, (int, float)):
+        return float(keep_alive)
+    text = str(keep_alive).strip()
+    unit = {"s": 1, "m": 60, "h": 3600}.get(text[-1:])
+    return float(text[:-1]) * unit if unit else float(text)
+
+def start(host: str = "127.0.0.1", port: int = 0, **kwargs) -> MockOllama:
+    """Serve from a daemon thread; port=0 picks a free port (see .url). Stop with .shutdown()."""
+    server = MockOllama((host, port), **kwargs)
+    threading.Thread(target=server.serve_forever, name="mock-ollama", daemon=True).start()
+    return server
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockOllama
+
+    def setup(self):
+        super().setup()
+        self.server.stats["connections"] += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, status: int, payload: Dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/version":
+            self._json(200, {"version": "0.0.0-mock"})
+        elif self.path == "/api/tags":
+            self._json(200, {"models": [{"name": m, "model": m} for m in (self.server.models or [])]})
+        elif self.path == "/api/ps":
+            self._json(200, {"models": [{"name": m, "model": m} for m in self.server.resident()]})
+        else:
+            self._json(404, {"error": f"no route {self.path}"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.path != "/api/chat":
+            self._json(404, {"error": f"no route {self.path}"})
+            return
+        try:
+            req = json.loads(body or b"{}")
+        except ValueError:
+            self._json(400, {"error": "invalid JSON"})
+            return
+        model = req.get("model") or ""
+        if self.server.models is not None and model not in self.server.models:
+            self._json(404, {"error": f"model '{model}' not found"})
+            return
+        self.server.stats["requests"] += 1
+        with self.server.slots:
+            self._chat(req, model)
+
+    def _chat(self, req: Dict, model: str):
+        s = self.server
+        options = req.get("options") or {}
+        messages = req.get("messages") or []
+        t0 = time.perf_counter()
+        load_s = s.load(model, req.get("keep_alive"))
+        if not messages:  # load only
+            self._json(200, {"model": model, "created_at": _now(), "done": True, "done_reason": "load",
+                             "message": {"role": "assistant", "content": ""},
+                             "total_duration": int((time.perf_counter() - t0) * 1e9),
+                             "load_duration": int(load_s * 1e9)})
+            return
+        prompt_words = sum(len(str(m.get("content", "")).split()) for m in messages)
+        words = REPLY.split(" ")
+        if messages[-1].get("role") == "assistant":  # continue the partial reply
+            words = words[len(str(messages[-1].get("content", "")).split(" ")):]
+        limit = int(options.get("num_predict") or 0)
+        if limit > 0 and words:  # budget set: fill it exactly (the canned reply repeats), like a model that never stops
+            words = (words * (limit // len(words) + 1))[:limit]
+        pieces = [w if i == 0 and messages[-1].get("role") != "assistant" else " " + w for i, w in enumerate(words)]
+        done_reason = "length" if limit > 0 else "stop"
+
+        t_load = time.perf_counter()
+        time.sleep((s.prefill_ms + s.prefill_ms_per_token * prompt_words) / 1000.0)
+        t_prefill = time.perf_counter()
+        stream = req.get("stream", True)
+        if stream:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+        try:
+            for i, piece in enumerate(pieces):
+                if i:
+                    time.sleep(s.tpot_ms / 1000.0)
+                if stream and s.fail_after and i == s.fail_after:
+                    s.stats["aborted"] += 1
+                    self.close_connection = True  # no terminating chunk: the client sees a cut stream
+                    return
+                if stream:
+                    self._chunk({"model": model, "created_at": _now(), "done": False,
+                                 "message": {"role": "assistant", "content": piece}})
+            t_end = time.perf_counter()
+            final = {"model": model, "created_at": _now(), "done": True, "done_reason": done_reason,
+                     "message": {"role": "assistant", "content": "" if stream else "".join(pieces)},
+                     "total_duration": int((t_end - t0) * 1e9), "load_duration": int(load_s * 1e9),
+                     "prompt_eval_count": prompt_words, "prompt_eval_duration": int((t_prefill - t_load) * 1e9),
+                     "eval_count": len(pieces), "eval_duration": int((t_end - t_prefill) * 1e9)}
+            if stream:
+                self._chunk(final)
+                self.wfile.write(b"0\r\n\r\n")
+            else:
+                self._json(200, final)
+        except (BrokenPipeError, ConnectionResetError):
+            s.stats["aborted"] += 1
+            self.close_connection = True
+
+    def _chunk(self, obj: Dict):
+        data = json.dumps(obj).encode("utf-8") + b"\n"
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+def main():
+    ap = argparse.ArgumentParser(description="Mock Ollama server (canned replies, simulated latency)")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=11434)
+    ap.add_argument("--prefill-ms", type=float, default=30.0)
+    ap.add_argument("--prefill-ms-per-token", type=float, default=0.05)
+    ap.add_argument("--tpot-ms", type=float, default=10.0)
+    ap.add_argument("--parallel", type=int, default=4, help="requests decoding at once")
+    ap.add_argument("--model", action="append", default=None, help="only serve these names (repeatable)")
+    ap.add_argument("--load-ms", type=float, default=0.0, help="model load time when not resident")
+    ap.add_argument("--fail-after", type=int, default=0, help="drop streams after this many words (0 = never)")
+    args = ap.parse_args()
+    server = MockOllama((args.host, args.port), args.prefill_ms, args.tpot_ms, args.prefill_ms_per_token,
+                        args.parallel, args.model, args.load_ms, args.fail_after)
+    print(f"[mock-ollama] listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# model_registry.py
+"""
+Resident models for the HF backend.
+
+Several base models stay loaded up to a memory budget; when a new one would not
+fit, the least recently used base is evicted first. Each base carries any number
+of LoRA adapters, loaded once through PEFT (from_pretrained, then load_adapter)
+and addressed by name.
+
+Adapters are selected per forward pass with PEFT's `adapter_names=` argument
+rather than set_adapter(), so switching adapters is free and requests on the
+same base never flip each other's adapter mid-generation (rows of one batch may
+even use different adapters). BASE_ADAPTER means "this base, no LoRA".
+
+Loading is injected (`load_base(base_id, load_in_4bit) -> (model, tok)`), so the
+registry can be exercised with tiny random models; see `python model_registry.py`.
+"""
+import gc
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+
+BASE_ADAPTER = "__base__"  # PEFT's reserved adapter name for "no adapter"
+
+def model_nbytes(model) -> int:
+    """Bytes held by parameters + buffers (shared tensors counted once)."""
+    seen, total = set(), 0
+    for t in list(model.parameters()) + list(model.buffers()):
+        if t.data_ptr() in seen:
+            continue
+        seen.add(t.data_ptr())
+        total += t.numel() * t.element_size()
+    for m in model.modules():
+        if isinstance(m, torch.ao.nn.quantized.dynamic.Linear):  # int8 weight lives outside parameters()
+            w = m.weight()
+            total += w.numel() * w.element_size()
+    return total
+
+def adapter_name(adapter_path: str) -> str:
+    """Stable PEFT-safe adapter name for a path / Hub id: last component + short hash."""
+    tail = re.sub(r"\W", "_", adapter_path.rstrip("/").split("/")[-1])
+    return f"{tail}_{hashlib.blake2b(adapter_path.encode('utf-8'), digest_size=3).hexdigest()}"
+
+def attach_adapter(model, adapter_path: str, name: str):
+    """Wrap in PeftModel on the first adapter, load_adapter() for the rest."""
+    from peft import PeftModel
+
+    if isinstance(model, PeftModel):
+        model.load_adapter(adapter_path, adapter_name=name)
+        return model
+    return PeftModel.from_pretrained(model, adapter_path, adapter_name=name)
+
+class ResidentModel:
+    """One loaded base (+ its adapters) and its bookkeeping."""
+    def __init__(self, base_id: str, load_in_4bit: bool, model, tok, load_s: float):
+        self.base_id = base_id
+        self.load_in_4bit = load_in_4bit
+        self.model = model
+        self.tok = tok
+        self.load_s = load_s
+        self.bytes = model_nbytes(model)
+        self.adapters: Dict[str, Dict] = {}  # adapter_path -> {"name", "load_s", "bytes"}
+        self.uses = 0
+        self.plain_users = 0  # running requests that use the model without adapter_names
+        self.last_used = time.time()
+
+    def info(self) -> Dict:
+        return {
+            "base": self.base_id, "fourbit": self.load_in_4bit,
+            "load_s": round(self.load_s, 3), "mb": round(self.bytes / 2 ** 20, 1),
+            "uses": self.uses, "last_used": self.last_used,
+            "adapters": {p: {"name": a["name"], "load_s": round(a["load_s"], 3),
+                             "mb": round(a["bytes"] / 2 ** 20, 1)} for p, a in self.adapters.items()},
+        }
+
+class ModelRegistry:
+    def __init__(self, budget_bytes: int, load_base: Callable, load_adapter: Callable = attach_adapter,
+                 on_evict: Optional[Callable] = None, estimate: Optional[Callable] = None):
+        self.budget_bytes = budget_bytes
+        self.load_base = load_base
+        self.estimate = estimate  # (base_id, load_in_4bit) -> bytes, to make room before the first load
+        self.load_adapter = load_adapter
+        self.on_evict = on_evict  # called with the evicted model (drop schedulers, KV caches, ...)
+        self.stats = {"loads": 0, "adapter_loads": 0, "hits": 0, "evictions": 0}
+        self._entries: "OrderedDict[Tuple[str, bool], ResidentModel]" = OrderedDict()
+        self._sizes: Dict[Tuple[str, bool], int] = {}  # last measured size, to make room before a reload
+        self._lock = threading.Lock()
+        self._loading: Dict[Tuple, Future] = {}  # ((base_id, 4bit), "base" | "adapter") -> load in progress
+        self._reserved: Dict[Tuple, int] = {}  # base load in progress -> bytes it is expected to take
+        self._drained = threading.Condition(self._lock)  # a plain-model lease ended
+
+    # ---- public ----
+    def get(self, base_id: str, adapter_path: Optional[str], load_in_4bit: bool):
+        """Return (model, tok, adapter) for this combination, loading what is missing.
+        adapter is the name to pass as adapter_names=[...], or None for a plain (non-PEFT) model.
+        Loads run outside the registry lock, so requests for resident models never wait on them;
+        concurrent requests for the same missing base (or adapters of one base) wait for one load."""
+        key = (base_id, bool(load_in_4bit))
+        loaded = False
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                wrapping = entry is not None and not entry.adapters and (key, "adapter") in self._loading
+                if entry is not None and (not adapter_path or adapter_path in entry.adapters) and not wrapping:
+                    if not loaded:
+                        self.stats["hits"] += 1
+                    return self._use(key, entry, adapter_path)
+                job = (key, "base" if entry is None else "adapter")  # one adapter load at a time per base
+                future = self._loading.get(job)  # plain-model requests wait for the first adapter too
+                if future is None:
+                    future = self._loading[job] = Future()
+                    if entry is None:
+                        self._reserved[job] = self._sizes.get(key) or self._estimate(key)
+                        self._make_room(0, keep=None)
+                    owner = True
+                else:
+                    owner = False
+            if not owner:
+                future.result()  # re-raises the loader's error
+                continue  # loaded now (or already evicted again): look again
+            try:
+                if entry is None:
+                    self._load_base(key)
+                    loaded = True
+                else:
+                    self._load_adapter(key, entry, adapter_path)
+            except BaseException as e:
+                with self._lock:
+                    del self._loading[job]
+                    self._reserved.pop(job, None)
+                future.set_exception(e)
+                raise
+            with self._lock:
+                del self._loading[job]
+                self._reserved.pop(job, None)
+            future.set_result(None)
+
+    def lease(self, model) -> Callable[[], None]:
+        """Record a request running on `model` as a plain model (adapter None); call the returned
+        function when it is done. PEFT injects the first adapter into a plain model in place,
+        so that load waits until no such request is running."""
+        with self._lock:
+            entry = next((e for e in self._entries.values() if e.model is model and not e.adapters), None)
+            if entry is None:
+                return lambda: None
+            entry.plain_users += 1
+
+        def release():
+            with self._lock:
+                entry.plain_users -= 1
+                self._drained.notify_all()
+        return release
+
+    def peek(self, base_id: str) -> Optional[ResidentModel]:
+        """A resident entry for base_id (any precision) without touching LRU order."""
+        with self._lock:
+            for (b, _), entry in self._entries.items():
+                if b == base_id:
+                    return entry
+        return None
+
+    def evict(self, base_id: str, load_in_4bit: bool) -> bool:
+        with self._lock:
+            return self._evict((base_id, bool(load_in_4bit)))
+
+    def resident_bytes(self) -> int:
+        return sum(e.bytes for e in self._entries.values()) + sum(self._reserved.values())
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "budget_mb": round(self.budget_bytes / 2 ** 20, 1),
+                "resident_mb": round(self.resident_bytes() / 2 ** 20, 1),
+                **self.stats,
+                "models": [e.info() for e in reversed(self._entries.values())],  # most recent first
+            }
+
+    # ---- internals ----
+    def _estimate(self, key) -> int:
+        if self.estimate is None:
+            return 0
+        try:
+            return int(self.estimate(key[0], key[1]) or 0)
+        except Exception as e:  # no local files, gated repo, ...: load first, evict after
+            print(f"[registry] no size estimate for {key[0]}: {type(e).__name__}: {e}")
+            return 0
+
+    def _load_base(self, key):
+        t0 = time.perf_counter()
+        model, tok = self.load_base(key[0], key[1])
+        entry = ResidentModel(key[0], key[1], model, tok, time.perf_counter() - t0)
+        with self._lock:
+            self._reserved.pop((key, "base"), None)  # measured from here on
+            self._entries[key] = entry
+            self._sizes[key] = entry.bytes
+            self.stats["loads"] += 1
+
+    def _load_adapter(self, key, entry: ResidentModel, adapter_path: str):
+        name = adapter_name(adapter_path)
+        with self._lock:
+            if entry.plain_users:
+                print(f"[registry] {key[0]}: waiting for {entry.plain_users} plain-model request(s) "
+                      f"before injecting the first adapter")
+            while entry.plain_users:
+                self._drained.wait()
+        old = entry.model
+        before, t0 = model_nbytes(old), time.perf_counter()
+        model = self.load_adapter(old, adapter_path, name)
+        model.eval()
+        added = model_nbytes(model) - before
+        with self._lock:
+            if self._entries.get(key) is not entry:
+                return  # evicted meanwhile; the caller loads it again
+            entry.model = model
+            entry.adapters[adapter_path] = {"name": name, "load_s": time.perf_counter() - t0, "bytes": added}
+            entry.bytes += added
+            self.stats["adapter_loads"] += 1
+            if model is not old and self.on_evict is not None:
+                self.on_evict(old)  # now wrapped in a PeftModel; drop state keyed on the bare handle
+
+    def _use(self, key, entry: ResidentModel, adapter_path: Optional[str]):
+        self._entries.move_to_end(key)
+        entry.uses += 1
+        entry.last_used = time.time()
+        self._sizes[key] = entry.bytes
+        self._make_room(0, keep=key)
+        if adapter_path:
+            adapter = entry.adapters[adapter_path]["name"]
+        else:
+            adapter = BASE_ADAPTER if entry.adapters else None
+        return entry.model, entry.tok, adapter
+
+    def _make_room(self, incoming: int, keep):
+        """Evict LRU bases until resident + incoming fits the budget (never `keep`)."""
+        for key in list(self._entries):
+            if self.resident_bytes() + incoming <= self.budget_bytes:
+                break
+            if key != keep:
+                self._evict(key)
+
+    def _evict(self, key) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self.stats["evictions"] += 1
+        if self.on_evict is not None:
+            self.on_evict(entry.model)
+        # requests still running keep their own reference; memory is freed when they finish
+        entry.model = entry.tok = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return True
+
+# ---- CPU demo with tiny random models ----
+def _demo():
+    import tempfile
+    from tiny_model import build_tiny_model, save_tiny_adapter
+
+    def _load(base_id, load_in_4bit):
+        return build_tiny_model(seed=int(base_id.split(":")[1]))
+
+    tmp = tempfile.mkdtemp()
+    lora = [save_tiny_adapter(f"{tmp}/lora{i}", seed=i + 1) for i in range(2)]
+    one = model_nbytes(build_tiny_model()[0])
+    reg = ModelRegistry(budget_bytes=int(2.5 * one), load_base=_load)
+
+    prompt = torch.tensor([[60, 61, 62, 63]])
+    for base, adapter in [("tiny:0", lora[0]), ("tiny:0", lora[1]), ("tiny:0", None),
+                          ("tiny:1", lora[0]), ("tiny:2", None), ("tiny:0", lora[0])]:
+        t0 = time.perf_counter()
+        model, tok, name = reg.get(base, adapter, False)
+        kw = {"adapter_names": [name]} if name else {}
+        with torch.no_grad():
+            top = model(input_ids=prompt, **kw).logits[0, -1].argmax().item()
+        print(f"{base:7s} {name or '-':28s} {(time.perf_counter() - t0) * 1000:7.1f} ms  next={top}")
+    snap = reg.snapshot()
+    print({k: v for k, v in snap.items() if k != "models"})
+    for m in snap["models"]:
+        print(" ", m["base"], m["mb"], "MB", {a["name"]: a["mb"] for a in m["adapters"].values()})
+
+if __name__ == "__main__":
+    _demo()
@@ -0,0 +1,152 @@
+# ollama_backend.py
+"""
+Shared Ollama client for the app.
+
+The module-level ollama.chat() builds its client once per import with httpx's
+defaults and sends no keep_alive, so the daemon unloads a model five minutes
+after its last request and the next one pays the load again. Here:
+
+    client(host)     one ollama.Client per host over a pooled keep-alive httpx client
+    chat(...)        every request carries keep_alive: -1 for pinned models, else
+                     the configured duration (config.OLLAMA_KEEP_ALIVE)
+    pin(model)       load a model now and keep it resident until the daemon restarts
+    stream(...)      chat(stream=True); with use_async the request runs on
+                     ollama.AsyncClient in one shared event-loop thread and the
+                     caller iterates a queue, so a slow session holds no connection
+                     slot or thread of its own while it waits between tokens
+    metrics(...)     a final chunk's counters / durations (ns) in hf_backend's metrics
+                     shape (prompt_tokens, gen_tokens, ttft_ms, gen_ms, tpot_ms, ...)
+
+configure() is called once by startup.load_ollama_backend().
+"""
+import asyncio
+import queue
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import httpx
+import ollama
+
+_settings = {"host": None, "keep_alive": "30m", "connections": 8, "timeout_s": 120.0}
+_clients: Dict = {}     # (host, "sync" | "async") -> client
+_pinned = set()         # (host, model) kept loaded with keep_alive=-1
+_loop = {"loop": None}  # event loop thread shared by all async streams
+_lock = threading.Lock()
+_END = object()
+
+DONE_REASONS = {"stop": "eos", "length": "max_new_tokens"}
+ERRORS = (ollama.ResponseError, httpx.HTTPError, ConnectionError)  # daemon down, model missing, stream cut
+
+def configure(host: Optional[str] = None, keep_alive="30m", connections: int = 8, timeout_s: float = 120.0):
+    _settings.update(host=host, keep_alive=keep_alive, connections=connections, timeout_s=timeout_s)
+
+def _client_kwargs() -> Dict:
+    return {"timeout": httpx.Timeout(_settings["timeout_s"], connect=5.0),
+            "limits": httpx.Limits(max_connections=4 * _settings["connections"],
+                                   max_keepalive_connections=_settings["connections"])}
+
+def client(host: Optional[str] = None) -> "ollama.Client":
+    host = host or _settings["host"]
+    with _lock:
+        if (host, "sync") not in _clients:
+            _clients[(host, "sync")] = ollama.Client(host=host, **_client_kwargs())
+        return _clients[(host, "sync")]
+
+def _async_client(host: Optional[str]) -> "ollama.AsyncClient":
+    # created and used on the loop thread only (httpx.AsyncClient is bound to one loop)
+    if (host, "async") not in _clients:
+        _clients[(host, "async")] = ollama.AsyncClient(host=host, **_client_kwargs())
+    return _clients[(host, "async")]
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    with _lock:
+        if _loop["loop"] is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="ollama-async", daemon=True).start()
+            _loop["loop"] = loop
+        return _loop["loop"]
+
+def keep_alive(model: str, host: Optional[str] = None):
+    return -1 if (host or _settings["host"], model) in _pinned else _settings["keep_alive"]
+
+def chat(model: str, messages: Sequence[Dict], options: Optional[Dict] = None, host: Optional[str] = None):
+    """One non-streamed request."""
+    return client(host).chat(model=model, messages=list(messages), stream=False, options=options,
+                             keep_alive=keep_alive(model, host))
+
+def stream(model: str, messages: Sequence[Dict], options: Optional[Dict] = None, host: Optional[str] = None,
+           use_async: bool = False) -> Iterator:
+    """Streamed chunks. Closing the iterator drops the HTTP stream, which stops generation server-side."""
+    if not use_async:
+        return client(host).chat(model=model, messages=list(messages), stream=True, options=options,
+                                 keep_alive=keep_alive(model, host))
+    return _stream_async(model, list(messages), options, host or _settings["host"], keep_alive(model, host))
+
+def _stream_async(model, messages, options, host, alive):
+    q: "queue.Queue" = queue.Queue()
+
+    async def pump():
+        try:
+            parts = await _async_client(host).chat(model=model, messages=messages, stream=True,
+                                                   options=options, keep_alive=alive)
+            async for part in parts:
+                q.put(part)
+            q.put(_END)
+        except Exception as e:
+            q.put(e)
+
+    task = asyncio.run_coroutine_threadsafe(pump(), _event_loop())
+    try:
+        while True:
+            item = q.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        task.cancel()  # consumer left early: cancelling the task closes the stream
+
+def load(model: str, host: Optional[str] = None):
+    """Load a model without generating (an empty chat), under its usual keep_alive."""
+    return chat(model, [], host=host)
+
+def pin(model: str, host: Optional[str] = None):
+    """Load a model and keep it resident: this and every later request send keep_alive=-1."""
+    _pinned.add((host or _settings["host"], model))
+    return load(model, host)
+
+def loaded(host: Optional[str] = None) -> List[str]:
+    """Models the daemon currently holds in memory (GET /api/ps)."""
+    return [m.model for m in client(host).ps().models]
+
+def field(obj, key: str, default=None):
+    """Chunks are ollama response objects or plain dicts."""
+    if isinstance(obj, dict):
+        return obj.get(key, default)
+    return getattr(obj, key, default)
+
+def text(chunk) -> str:
+    msg = field(chunk, "message")
+    return (field(msg, "content") if msg is not None else None) or field(chunk, "response") or ""
+
+def metrics(final, t0: Optional[float] = None, times: Sequence[float] = ()) -> Dict:
+    """hf_backend-style metrics from the final (done) chunk. With t0 / times (perf_counter
+    at request start and per streamed token) TTFT and wall time are measured here, as
+    the client saw them; otherwise they come from the daemon's own durations."""
+    final = final or {}
+    ns = lambda key: (field(final, key) or 0) / 1e6  # noqa: E731  nanoseconds -> ms
+    n = field(final, "eval_count")
+    gen_ms = ns("eval_duration") or ((times[-1] - times[0]) * 1000.0 if len(times) > 1 else None)
+    m = {"prompt_tokens": field(final, "prompt_eval_count"), "gen_tokens": n if n is not None else len(times),
+         "cached_tokens": None, "queue_ms": None, "load_ms": ns("load_duration"),
+         "ttft_ms": (times[0] - t0) * 1000.0 if times and t0 is not None
+         else (ns("load_duration") + ns("prompt_eval_duration")) or None,
+         "gen_ms": gen_ms,
+         "wall_s": time.perf_counter() - t0 if t0 is not None else ns("total_duration") / 1000.0,
+         "stop_reason": DONE_REASONS.get(field(final, "done_reason"), field(final, "done_reason"))}
+    if n and gen_ms:
+        m["tok_per_s"] = n / (gen_ms / 1000.0)
+        m["tpot_ms"] = gen_ms / n
+    return m
@@ -0,0 +1,146 @@
+# prefix_cache.py
+"""
+Prefix KV-cache keyed on token-id prefixes (compressed radix tree).
+
+Each entry stores the past_key_values for one token sequence (e.g. a whole
+rendered conversation up to the last generated token). A lookup returns the
+longest prefix of the query that any entry covers, with that entry's KV cropped
+to the match, so only the new tokens need a prefill. The shared MCQ system
+prompt and every session's earlier turns hit naturally because they are
+prefixes of later prompts.
+
+Entries are evicted least-recently-used once their tensors exceed the byte budget.
+"""
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import kv_cache
+
+class _Node:
+    __slots__ = ("edge", "children", "entries")
+
+    def __init__(self, edge: Tuple[int, ...] = ()):
+        self.edge = edge                         # token ids on the edge from the parent
+        self.children: Dict[int, "_Node"] = {}   # first token of child edge -> child
+        self.entries = set()                     # ids of entries whose key runs through here
+
+def _common(a: Sequence[int], a_off: int, b: Tuple[int, ...]) -> int:
+    n = min(len(a) - a_off, len(b))
+    i = 0
+    while i < n and a[a_off + i] == b[i]:
+        i += 1
+    return i
+
+class PrefixCache:
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._root = _Node()
+        self._entries: "OrderedDict[int, Tuple[Tuple[int, ...], kv_cache.Layers, int]]" = OrderedDict()
+        self._by_key: Dict[Tuple[int, ...], int] = {}
+        self._ids = itertools.count()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "hit_tokens": 0, "miss_tokens": 0, "evictions": 0}
+
+    # ---- public ----
+    def lookup(self, ids: Sequence[int]) -> Tuple[int, Optional[kv_cache.Layers]]:
+        """
+        Return (matched_tokens, layers) for the longest cached prefix of `ids`.
+        At least one token is always left uncached so the caller has logits to sample from.
+        """
+        limit = len(ids) - 1
+        with self._lock:
+            best_len, best_id = 0, None
+            node, depth = self._root, 0
+            while depth < limit:
+                child = node.children.get(ids[depth])
+                if child is None:
+                    break
+                c = _common(ids, depth, child.edge)
+                if child.entries:
+                    best_len, best_id = min(depth + c, limit), next(iter(child.entries))
+                if c < len(child.edge):
+                    break
+                node, depth = child, depth + c
+
+            if best_id is None:
+                self.stats["misses"] += 1
+                self.stats["miss_tokens"] += len(ids)
+                return 0, None
+            self._entries.move_to_end(best_id)
+            layers = kv_cache.crop(self._entries[best_id][1], best_len)
+            self.stats["hits"] += 1
+            self.stats["hit_tokens"] += best_len
+            self.stats["miss_tokens"] += len(ids) - best_len
+            return best_len, layers
+
+    def insert(self, ids: Sequence[int], layers: kv_cache.Layers):
+        """Store KV for `ids` (len(ids) must equal the cache length). Caller passes owned tensors."""
+        key = tuple(ids)
+        size = kv_cache.nbytes(layers)
+        if not key or size > self.budget_bytes:
+            return
+        with self._lock:
+            old = self._by_key.get(key)
+            if old is not None:
+                self._remove(old)
+            eid = next(self._ids)
+            self._entries[eid] = (key, layers, size)
+            self._by_key[key] = eid
+            self._bytes += size
+            self._link(key, eid)
+            while self._bytes > self.budget_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._root = _Node()
+            self._entries.clear()
+            self._by_key.clear()
+            self._bytes = 0
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stats, entries=len(self._entries), bytes=self._bytes)
+
+    # ---- tree maintenance (lock held) ----
+    def _link(self, key: Tuple[int, ...], eid: int):
+        node, depth = self._root, 0
+        while depth < len(key):
+            child = node.children.get(key[depth])
+            if child is None:
+                leaf = _Node(key[depth:])
+                leaf.entries.add(eid)
+                node.children[key[depth]] = leaf
+                return
+            c = _common(key, depth, child.edge)
+            if c < len(child.edge):
+                # split the edge: node -> mid -> child
+                mid = _Node(child.edge[:c])
+                mid.entries = set(child.entries)
+                child.edge = child.edge[c:]
+                mid.children[child.edge[0]] = child
+                node.children[key[depth]] = mid
+                child = mid
+            child.entries.add(eid)
+            node, depth = child, depth + c
+
+    def _remove(self, eid: int):
+        key, _, size = self._entries.pop(eid)
+        self._by_key.pop(key, None)
+        self._bytes -= size
+        path: List[Tuple[_Node, _Node]] = []
+        node, depth = self._root, 0
+        while depth < len(key):
+            child = node.children.get(key[depth])
+            if child is None:
+                break
+            child.entries.discard(eid)
+            path.append((node, child))
+            node, depth = child, depth + len(child.edge)
+        for parent, child in reversed(path):
+            if not child.entries:
+                parent.children.pop(child.edge[0], None)
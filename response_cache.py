@@ -0,0 +1,102 @@
+# response_cache.py
+"""
+Exact-match response cache for repeated prompts.
+
+Two tiers: an in-memory LRU (per process) in front of a SQLite file shared by
+all sessions and restarts. Entries expire after `ttl_s`; the disk tier keeps at
+most `max_items` rows, dropping the least recently used.
+
+The key is a hash of the normalised prepared message list plus everything that
+changes the output (backend, model, adapter, generation parameters).
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+def normalize_messages(messages: List[Dict]) -> List[List[str]]:
+    """Role + whitespace-collapsed content; formatting noise shouldn't miss the cache."""
+    return [[m.get("role", ""), " ".join(str(m.get("content", "")).split())] for m in messages]
+
+def make_key(messages: List[Dict], **params) -> str:
+    payload = json.dumps({"messages": normalize_messages(messages), "params": params},
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    def __init__(self, path: Optional[str], memory_items: int = 256, max_items: int = 10000,
+                 ttl_s: float = 7 * 24 * 3600):
+        self.memory_items = memory_items
+        self.max_items = max_items
+        self.ttl_s = ttl_s
+        self.stats = {"hits": 0, "memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self._mem: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, text TEXT NOT NULL, metrics TEXT,"
+                " created REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return {"text", "metrics", "created"} or None."""
+        now = time.time()
+        with self._lock:
+            entry = self._mem.get(key)
+            if entry is not None and now - entry["created"] <= self.ttl_s:
+                self._mem.move_to_end(key)
+                self.stats["hits"] += 1
+                self.stats["memory_hits"] += 1
+                return entry
+            if entry is not None:
+                del self._mem[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT text, metrics, created FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[2] <= self.ttl_s:
+                    self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    entry = {"text": row[0], "metrics": json.loads(row[1] or "{}"), "created": row[2]}
+                    self._remember(key, entry)
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                    return entry
+                if row is not None:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key: str, text: str, metrics: Optional[Dict] = None):
+        now = time.time()
+        entry = {"text": text, "metrics": dict(metrics or {}), "created": now}
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, text, metrics, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, text, json.dumps(entry["metrics"], default=str), now, now))
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_s,))
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_items,))
+            self._db.commit()
+
+    def _remember(self, key: str, entry: Dict):
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.memory_items:
+            self._mem.popitem(last=False)
@@ -0,0 +1,382 @@
+# scheduler.py
+"""
+Continuous-batching scheduler.
+
+One background thread owns the model. Callers submit token ids and get back a
+GenRequest they can iterate for text chunks. Each loop iteration the thread
+prefills any newly queued requests, then runs ONE batched decode step over all
+active sequences, so requests join and leave at token granularity.
+
+Every sequence keeps its own KV cache (see kv_cache.py). The decode steps run
+on one left-padded batched cache that the model extends in place; it is only
+re-stacked from the per-sequence caches when requests join or leave, and
+between those each sequence's cache is a view into it.
+Decoding is greedy, matching stream_generate's do_sample=False.
+"""
+import queue
+import threading
+import time
+from typing import List, Optional
+
+import torch
+
+import kv_cache
+
+_DONE = object()
+
+class IncrementalDecoder:
+    """Token ids in, text deltas out (same idea as TextIteratorStreamer)."""
+    def __init__(self, tok):
+        self.tok = tok
+        self.ids: List[int] = []
+        self.printed = 0
+
+    def push(self, token_id: int) -> str:
+        self.ids.append(token_id)
+        text = self.tok.decode(self.ids, skip_special_tokens=True)
+        if text.endswith("\n"):
+            # line finished: flush and restart so decode cost stays bounded
+            delta = text[self.printed:]
+            self.ids, self.printed = [], 0
+            return delta
+        if text.endswith("�"):
+            return ""  # partial multi-byte char; wait for the next token
+        delta = text[self.printed:]
+        self.printed = len(text)
+        return delta
+
+    def flush(self) -> str:
+        text = self.tok.decode(self.ids, skip_special_tokens=True) if self.ids else ""
+        delta = text[self.printed:]
+        self.ids, self.printed = [], 0
+        return delta
+
+class GenRequest:
+    """One caller's sequence. Iterate it to receive text chunks."""
+    def __init__(self, input_ids: List[int], max_new_tokens: int, tok, stop=None,
+                 adapter: Optional[str] = None, prefix_cache=None, cancel=None, on_finish=None):
+        self.input_ids = list(input_ids)
+        self.max_new_tokens = max_new_tokens
+        self.stop = stop  # optional stopping.StopMatcher, checked after every token
+        self.adapter = adapter  # PEFT adapter name for this row (model_registry), None for plain models
+        self.prefix_cache = prefix_cache  # optional prefix_cache.PrefixCache for this (model, adapter)
+        self.cancel = cancel  # optional admission.CancelToken; checked after every token
+        self.on_finish = on_finish  # optional callable, run once the row has left the batch
+        self.generated: List[int] = []
+        self.layers: Optional[kv_cache.Layers] = None  # this row's KV between steps
+        self.cached_tokens = 0  # prompt tokens served from the prefix cache
+        self.finished = False
+        self.error: Optional[BaseException] = None
+        self.metrics = {}
+        self._out: "queue.Queue" = queue.Queue()
+        self._decoder = IncrementalDecoder(tok)
+        self._batch_sizes: List[int] = []
+        self.t_submit = time.perf_counter()
+        self.t_start = self.t_first = None
+        self.token_times: List[float] = []  # perf_counter() at each accepted token (tracing.Trace.decode_timeline)
+        self.detok_s = 0.0
+
+    def __iter__(self):
+        while True:
+            item = self._out.get()
+            if item is _DONE:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.cancelled
+
+    def _emit(self, token_id: int):
+        t = time.perf_counter()
+        piece = self._decoder.push(token_id)
+        self.detok_s += time.perf_counter() - t
+        if self.stop is not None:
+            piece = self.stop.feed(piece)
+        if piece:
+            self._out.put(piece)
+
+    def _finish(self, error: Optional[BaseException] = None, reason: Optional[str] = None):
+        if self.finished:
+            return
+        self.finished = True
+        self.error = error
+        self.layers = None
+        tail = self._decoder.flush()
+        if self.stop is not None:
+            tail = self.stop.feed(tail) + self.stop.flush()
+        if tail:
+            self._out.put(tail)
+        t_end = time.perf_counter()
+        self.metrics = {
+            "prompt_tokens": len(self.input_ids),
+            "cached_tokens": self.cached_tokens,
+            "gen_tokens": len(self.generated),
+            "queue_ms": ((self.t_start or t_end) - self.t_submit) * 1000.0,
+            "ttft_ms": (self.t_first - self.t_submit) * 1000.0 if self.t_first else None,
+            "gen_ms": (t_end - self.t_first) * 1000.0 if self.t_first else None,
+            "wall_s": t_end - self.t_submit,
+            "tok_per_s": (len(self.generated) - 1) / (t_end - self.t_first)
+                         if self.t_first and len(self.generated) > 1 and t_end > self.t_first else None,
+            "tpot_ms": (t_end - self.t_first) * 1000.0 / (len(self.generated) - 1)
+                       if self.t_first and len(self.generated) > 1 else None,
+            "mean_batch": (sum(self._batch_sizes) / len(self._batch_sizes)) if self._batch_sizes else 1.0,
+            "stop_reason": reason if error is None else "error",
+        }
+        self._out.put(_DONE)
+        if self.on_finish is not None:
+            self.on_finish()
+
+def _eos_ids(model, tok):
+    ids = set()
+    for src in (getattr(model, "generation_config", None), tok):
+        eos = getattr(src, "eos_token_id", None)
+        if isinstance(eos, int):
+            ids.add(eos)
+        elif eos:
+            ids.update(eos)
+    return ids
+
+class BatchScheduler:
+    """Owns (model, tok) and a decode loop thread; see module docstring."""
+    def __init__(self, model, tok, max_batch_size: int = 8, prefix_cache=None):
+        self.model = model
+        self.tok = tok
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache  # default prefix_cache.PrefixCache for requests that bring none
+        self.eos_ids = _eos_ids(model, tok)
+        self.pad_id = tok.pad_token_id if tok.pad_token_id is not None else 0
+        self.stats = {"requests": 0, "steps": 0, "tokens": 0}
+        self._pending: "queue.Queue[GenRequest]" = queue.Queue()
+        self._active: List[GenRequest] = []
+        self._rows: List[GenRequest] = []  # the requests in self._past, in row order
+        self._past = None                  # batched cache of the last decode step
+        self._pads: List[int] = []         # left padding per row of self._past
+        self._stop = threading.Event()
+        self._draining = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="hf-scheduler", daemon=True)
+        self._thread.start()
+
+    # ---- public ----
+    def submit(self, input_ids: List[int], max_new_tokens: int, stop=None,
+               adapter: Optional[str] = None, prefix_cache=None, cancel=None, on_finish=None) -> GenRequest:
+        req = GenRequest(input_ids, max_new_tokens, self.tok, stop=stop, adapter=adapter,
+                         prefix_cache=prefix_cache if prefix_cache is not None else self.prefix_cache,
+                         cancel=cancel, on_finish=on_finish)
+        self._pending.put(req)
+        return req
+
+    def retire(self):
+        """Finish what is queued or running, then exit the loop (model evicted)."""
+        self._draining.set()
+
+    def shutdown(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+        error = RuntimeError("scheduler shut down")
+        for req in self._active:
+            req._finish(error)
+        self._active, self._rows, self._past = [], [], None
+        while True:  # queued, never admitted: their callers are blocked on the output queue too
+            try:
+                self._pending.get_nowait()._finish(error)
+            except queue.Empty:
+                break
+
+    # ---- loop ----
+    def _loop(self):
+        while not self._stop.is_set():
+            if self._draining.is_set() and not self._active and self._pending.empty():
+                break
+            joiners = self._admit()
+            try:
+                if joiners:
+                    self._prefill(joiners)
+                if self._active:
+                    self._decode_step()
+            except Exception as e:  # fail everyone in flight, keep the loop alive
+                for req in joiners + self._active:
+                    req._finish(e)
+                self._active, self._rows, self._past = [], [], None
+
+    def _admit(self) -> List[GenRequest]:
+        joiners: List[GenRequest] = []
+        while len(self._active) + len(joiners) < self.max_batch_size:
+            idle = not self._active and not joiners
+            try:
+                req = self._pending.get(timeout=0.1) if idle else self._pending.get_nowait()
+            except queue.Empty:
+                break
+            if req.cancelled:
+                req._finish(reason="cancelled")  # consumer left while queued: never prefill it
+                continue
+            joiners.append(req)
+        return joiners
+
+    def _device(self):
+        return self.model.device
+
+    @staticmethod
+    def _adapter_kwargs(rows: List[GenRequest]):
+        """Per-row LoRA selection (PEFT mixed-adapter batch); nothing for plain models."""
+        names = [r.adapter for r in rows]
+        return {"adapter_names": names} if any(names) else {}
+
+    def _prefill(self, joiners: List[GenRequest]):
+        """
+        Batched prefill for new arrivals. Rows that hit the prefix cache only feed
+        their uncached suffix; each row's layout is [pad][cached past][pad][suffix].
+        """
+        pasts = []
+        for r in joiners:
+            r.t_start = time.perf_counter()
+            hit, layers = r.prefix_cache.lookup(r.input_ids) if r.prefix_cache else (0, None)
+            r.cached_tokens = hit
+            pasts.append(layers)
+        p_lens = [r.cached_tokens for r in joiners]
+        s_lens = [len(r.input_ids) - p for r, p in zip(joiners, p_lens)]
+        p_max, s_max = max(p_lens), max(s_lens)
+
+        ids = torch.full((len(joiners), s_max), self.pad_id, dtype=torch.long)
+        mask = torch.zeros((len(joiners), p_max + s_max), dtype=torch.long)
+        pos = torch.zeros((len(joiners), s_max), dtype=torch.long)
+        for i, r in enumerate(joiners):
+            p, n = p_lens[i], s_lens[i]
+            ids[i, s_max - n:] = torch.tensor(r.input_ids[p:], dtype=torch.long)
+            mask[i, p_max - p:p_max] = 1
+            mask[i, p_max + s_max - n:] = 1
+            pos[i, s_max - n:] = torch.arange(p, p + n)
+
+        past = None
+        if p_max:
+            template = next(l for l in pasts if l)
+            filled = [l if l else kv_cache.empty_like(template) for l in pasts]
+            past = kv_cache.layers_to_cache(kv_cache.left_pad_stack(filled)[0])
+
+        dev = self._device()
+        with torch.no_grad():
+            out = self.model(input_ids=ids.to(dev), attention_mask=mask.to(dev),
+                             position_ids=pos.to(dev), past_key_values=past, use_cache=True,
+                             **self._adapter_kwargs(joiners))
+        layers = kv_cache.cache_to_layers(out.past_key_values)
+        next_tokens = out.logits[:, -1, :].argmax(-1).tolist()
+
+        for i, r in enumerate(joiners):
+            suffix = kv_cache.select(layers, i, p_max + s_max - s_lens[i])
+            if p_max:
+                r.layers = kv_cache.concat(kv_cache.select(layers, i, p_max - p_lens[i], p_max), suffix)
+            else:
+                r.layers = suffix
+            self._accept(r, next_tokens[i])
+        self._active.extend(r for r in joiners if not r.finished)
+        self.stats["requests"] += len(joiners)
+
+    def _decode_step(self):
+        active = self._active
+        if self._rows != active:  # a request joined or left: re-stack once, not every step
+            batched, self._pads = kv_cache.left_pad_stack([r.layers for r in active])
+            self._past, self._rows = kv_cache.layers_to_cache(batched), list(active)
+        pads = self._pads
+        past_len = kv_cache.seq_len(kv_cache.cache_to_layers(self._past))
+
+        mask = torch.ones((len(active), past_len + 1), dtype=torch.long)
+        for i, pad in enumerate(pads):
+            mask[i, :pad] = 0
+        pos = torch.tensor([[past_len - pad] for pad in pads], dtype=torch.long)
+        ids = torch.tensor([[r.generated[-1]] for r in active], dtype=torch.long)
+
+        dev = self._device()
+        with torch.no_grad():
+            out = self.model(input_ids=ids.to(dev), attention_mask=mask.to(dev), position_ids=pos.to(dev),
+                             past_key_values=self._past, use_cache=True,
+                             **self._adapter_kwargs(active))
+        self._past = out.past_key_values
+        layers = kv_cache.cache_to_layers(self._past)
+        next_tokens = out.logits[:, -1, :].argmax(-1).tolist()
+
+        for i, r in enumerate(active):
+            r.layers = kv_cache.select(layers, i, pads[i])  # a view; copied only when re-stacked / cached
+            r._batch_sizes.append(len(active))
+            self._accept(r, next_tokens[i])
+        self._active = [r for r in active if not r.finished]
+        if not self._active:
+            self._rows, self._past = [], None
+        self.stats["steps"] += 1
+
+    def _accept(self, req: GenRequest, token_id: int):
+        req.generated.append(token_id)
+        self.stats["tokens"] += 1
+        req.token_times.append(time.perf_counter())
+        if req.t_first is None:
+            req.t_first = req.token_times[-1]
+        if token_id in self.eos_ids:
+            self._retire(req, "eos")
+            return
+        req._emit(token_id)
+        if req.cancelled:
+            self._retire(req, "cancelled")
+        elif req.stop is not None and req.stop.stopped:
+            self._retire(req, req.stop.reason)
+        elif len(req.generated) >= req.max_new_tokens:
+            self._retire(req, "max_new_tokens")
+
+    def _retire(self, req: GenRequest, reason: str):
+        """Finish a request, keeping its KV (prompt + reply so far) for the next turn."""
+        if req.prefix_cache is not None and req.layers:
+            n = kv_cache.seq_len(req.layers)
+            req.prefix_cache.insert((req.input_ids + req.generated)[:n], kv_cache.clone(req.layers))
+        req._finish(reason=reason)
+
+# ---- CPU load test with a tiny random model ----
+def _load_test(clients: int, max_new: int, max_batch: int):
+    from tiny_model import build_tiny_model
+
+    model, tok = build_tiny_model()
+    prompts = [tok.apply_chat_template([{"role": "user", "content": f"Question {i}: " + "x" * (5 * i)}],
+                                       tokenize=False, add_generation_prompt=True) for i in range(clients)]
+    encoded = [tok(p, add_special_tokens=False).input_ids for p in prompts]
+
+    # baseline: one model.generate per request, one after another
+    t0 = time.perf_counter()
+    for ids in encoded:
+        with torch.no_grad():
+            model.generate(torch.tensor([ids]), max_new_tokens=max_new, do_sample=False,
+                           min_new_tokens=max_new, pad_token_id=tok.pad_token_id)
+    seq_s = time.perf_counter() - t0
+
+    sched = BatchScheduler(model, tok, max_batch_size=max_batch)
+    sched.eos_ids = set()  # random weights: force full-length outputs for a fair comparison
+    results = [None] * clients
+
+    def _client(i):
+        time.sleep(0.005 * i)  # staggered arrivals exercise join-at-token-granularity
+        req = sched.submit(encoded[i], max_new)
+        "".join(req)
+        results[i] = req.metrics
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=_client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batch_s = time.perf_counter() - t0
+    sched.shutdown()
+
+    total = clients * max_new
+    print(f"sequential generate: {seq_s:.2f}s ({total / seq_s:.1f} tok/s)")
+    print(f"continuous batching: {batch_s:.2f}s ({total / batch_s:.1f} tok/s) • "
+          f"steps={sched.stats['steps']} • mean batch={total / max(sched.stats['steps'], 1):.1f}")
+    ttfts = sorted(m["ttft_ms"] for m in results)
+    print(f"TTFT ms p50={ttfts[len(ttfts) // 2]:.1f} max={ttfts[-1]:.1f}")
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser(description="Load-test the scheduler on CPU with a tiny random model")
+    ap.add_argument("--clients", type=int, default=16)
+    ap.add_argument("--max-new", type=int, default=32)
+    ap.add_argument("--max-batch", type=int, default=8)
+    args = ap.parse_args()
+    _load_test(args.clients, args.max_new, args.max_batch)
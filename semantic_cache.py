@@ -0,0 +1,195 @@
+# semantic_cache.py
+"""
+Semantic near-duplicate cache for MCQ questions.
+
+Questions are embedded with a cheap hashed n-gram vectorizer (word 1-2 grams +
+char 3-5 grams, signed feature hashing, L2-normalised), so no model download is
+needed. The option texts are embedded sorted, which makes the vector invariant
+to option order. Vectors live in a float32 memory-mapped matrix on disk (plus a
+JSONL sidecar with the answers) so the index survives restarts; a lookup is one
+matrix-vector product + top-k.
+
+A hit must have the same option texts and the same negation words ("NOT",
+"EXCEPT", "least", ...) as the query: "Which is NOT a feature of X" is a near
+duplicate of "Which is a feature of X" by similarity, but has the opposite
+answer. When the options are in a different order, every option-letter
+reference ("Answer: B", "option B", "(B)") is remapped to the new position; a
+cached reply with a letter it can't place is not served.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+LETTERS = "ABCD"
+_OPTION_RE = re.compile(r"(?:^|\s)\(?([A-D])[\.\):]\s+")
+_LETTER_REF_RE = re.compile(r"(Answer:\s*\(?|\b(?:[Oo]ptions?|[Cc]hoices?|[Aa]nswers?)\s+\(?|\()([A-D])\b")
+_STRAY_LETTER_RE = re.compile(r"\b[B-D]\b|\bA\b(?!\s+[a-z])")  # "A" before a lowercase word is the article
+_NEGATION_RE = re.compile(r"\b(?:not|no|never|none|neither|nor|except|least|false|incorrect|untrue|"
+                          r"cannot|without|unlikely)\b|n't\b", re.IGNORECASE)
+_WORD_RE = re.compile(r"[a-z0-9]+")
+
+def _norm(text: str) -> str:
+    return " ".join(_WORD_RE.findall(text.lower()))
+
+def negations(text: str) -> List[str]:
+    """Negation words of a question, sorted ("n't" counted as "not")."""
+    return sorted("not" if w.lower() == "n't" else w.lower() for w in _NEGATION_RE.findall(text))
+
+def parse_mcq(text: str) -> Tuple[str, Optional[List[str]]]:
+    """Split 'question ... A. x B. y C. z D. w' into (question, [x, y, z, w]); options None if not an MCQ."""
+    marks = []
+    want = 0
+    for m in _OPTION_RE.finditer(text):
+        if want < 4 and m.group(1) == LETTERS[want]:
+            marks.append(m)
+            want += 1
+    if len(marks) < 4:
+        return text.strip(), None
+    question = text[:marks[0].start()].strip()
+    question = re.sub(r"\s*Options:\s*$", "", question)
+    options = []
+    for i, m in enumerate(marks):
+        end = marks[i + 1].start() if i + 1 < 4 else len(text)
+        options.append(text[m.end():end].strip())
+    return question, options
+
+class HashedNgramVectorizer:
+    def __init__(self, dim: int = 4096):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        norm = _norm(text)
+        words = norm.split()
+        feats = ["w:" + w for w in words]
+        feats += ["b:" + a + " " + b for a, b in zip(words, words[1:])]
+        padded = f" {norm} "
+        for n in (3, 4, 5):
+            feats += ["c:" + padded[i:i + n] for i in range(len(padded) - n + 1)]
+        return feats
+
+    def embed(self, question: str, options: Optional[List[str]]) -> np.ndarray:
+        text = question + " || " + " | ".join(sorted(_norm(o) for o in options)) if options else question
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for f in self._features(text):
+            h = int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+            vec[h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+        n = np.linalg.norm(vec)
+        return vec / n if n else vec
+
+def remap_answer(text: str, cached_options: Optional[List[str]], options: Optional[List[str]]) -> Optional[str]:
+    """Rewrite every option-letter reference for the new option order; None if the option
+    sets differ or the reply names a letter outside a recognised reference."""
+    if not cached_options or not options:
+        return text
+    old = [_norm(o) for o in cached_options]
+    new = [_norm(o) for o in options]
+    if sorted(old) != sorted(new):
+        return None
+    if old == new:
+        return text
+    if _STRAY_LETTER_RE.search(_LETTER_REF_RE.sub(" ", text)):
+        return None  # e.g. "A and C are both wrong": can't tell which letters to move
+
+    def _swap(m):
+        idx = LETTERS.index(m.group(2))
+        return m.group(1) + LETTERS[new.index(old[idx])]
+
+    return _LETTER_REF_RE.sub(_swap, text)
+
+class SemanticCache:
+    def __init__(self, path: str, dim: int = 4096, threshold: float = 0.92, top_k: int = 5):
+        self.path = path
+        self.dim = dim
+        self.threshold = threshold
+        self.top_k = top_k
+        self.vectorizer = HashedNgramVectorizer(dim)
+        self.stats = {"lookups": 0, "hits": 0, "lookup_ms_total": 0.0}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self._vec_path = os.path.join(path, f"vectors_{dim}.f32")
+        self._meta_path = os.path.join(path, f"meta_{dim}.jsonl")
+        self._meta: List[Dict] = []
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, encoding="utf-8") as f:
+                self._meta = [json.loads(l) for l in f if l.strip()]
+        self._open(max(1024, len(self._meta)))
+        self._meta = self._meta[:self._capacity]
+
+    # ---- storage ----
+    def _open(self, min_rows: int):
+        existing = os.path.getsize(self._vec_path) // (4 * self.dim) if os.path.exists(self._vec_path) else 0
+        rows = max(existing, min_rows)
+        if rows > existing:
+            with open(self._vec_path, "ab") as f:
+                f.truncate(rows * 4 * self.dim)
+        self._capacity = rows
+        self._mat = np.memmap(self._vec_path, dtype=np.float32, mode="r+", shape=(rows, self.dim))
+
+    # ---- public ----
+    def lookup(self, user_text: str, namespace: str) -> Optional[Dict]:
+        """Best cached answer above the threshold (answer letter remapped), else None."""
+        t0 = time.perf_counter()
+        question, options = parse_mcq(user_text)
+        if options is None:
+            return None  # free text: too little to tell a paraphrase from a different question
+        q = self.vectorizer.embed(question, options)
+        result = None
+        with self._lock:
+            n = len(self._meta)
+            if n:
+                sims = self._mat[:n] @ q
+                k = min(self.top_k, n)
+                top = np.argpartition(-sims, k - 1)[:k]
+                for i in top[np.argsort(-sims[top])]:
+                    if sims[i] < self.threshold:
+                        break
+                    meta = self._meta[i]
+                    if meta["namespace"] != namespace or negations(meta["question"]) != negations(question):
+                        continue
+                    text = remap_answer(meta["text"], meta.get("options"), options)
+                    if text is not None:
+                        result = {"text": text, "metrics": meta.get("metrics") or {}, "similarity": float(sims[i])}
+                        break
+            self.stats["lookups"] += 1
+            self.stats["hits"] += int(result is not None)
+            elapsed_ms = (time.perf_counter() - t0) * 1000.0
+            self.stats["lookup_ms_total"] += elapsed_ms
+        if result is not None:
+            result["lookup_ms"] = elapsed_ms
+        return result
+
+    def add(self, user_text: str, answer_text: str, namespace: str, metrics: Optional[Dict] = None):
+        question, options = parse_mcq(user_text)
+        if options is None:
+            return
+        vec = self.vectorizer.embed(question, options)
+        meta = {"namespace": namespace, "question": question, "options": options,
+                "text": answer_text, "metrics": metrics or {}}
+        with self._lock:
+            n = len(self._meta)
+            if n >= self._capacity:
+                self._mat.flush()
+                del self._mat
+                self._open(self._capacity * 2)
+            self._mat[n] = vec
+            self._mat.flush()
+            with open(self._meta_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(meta, ensure_ascii=False, default=str) + "\n")
+            self._meta.append(meta)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            lookups = self.stats["lookups"]
+            return {
+                "entries": len(self._meta),
+                "lookups": lookups,
+                "hits": self.stats["hits"],
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+                "mean_lookup_ms": self.stats["lookup_ms_total"] / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,389 @@
+# server.py
+"""
+OpenAI-compatible HTTP server in front of hf_backend.
+
+    python server.py --port 8000                  # models from config.MODEL_CHOICES
+    python server.py --base tiny-random           # CPU smoke test, no download
+
+    POST /v1/chat/completions   OpenAI request/response shape; "stream": true -> SSE
+    GET  /health                in-flight / queued requests, resident models
+    GET  /metrics               Prometheus text: TTFT / TPOT / e2e / queue histograms, token counters
+
+Plain asyncio, no web framework: HTTP/1.1 keep-alive, SSE sent with chunked
+transfer encoding so pooled client connections are reused. stream_generate is a
+blocking iterator, so each admitted request runs in a worker thread; with
+HF_CONTINUOUS_BATCHING the shared scheduler batches them on the GPU.
+
+Admission: at most `max_concurrency` requests generate at once and `max_queue`
+more may wait for a slot; anything beyond gets 429 + Retry-After. Every request
+has a deadline (`timeout_s`, queue wait included): 504 before the first byte,
+an error event in the stream after it.
+
+Extensions to the OpenAI body: "answer_only": true uses letter scoring; the last
+stream chunk / the response carries "metrics" (TTFT, cached tokens, stop reason).
+The standard "user" field is taken as a conversation id: that conversation's
+prompt token ids are kept between requests (chat_tokens.py).
+Every request is traced (tracing.py); its id is the completion id, and with
+config.TRACE_PATH set the spans are appended there as JSON lines.
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from config import MODEL, MODEL_CHOICES, HF_LOAD_IN_4BIT, HF_MAX_NEW_TOKENS
+from config import HF_CONTINUOUS_BATCHING, HF_MAX_BATCH_SIZE, HF_PREFIX_CACHE_MB, HF_MODEL_MEMORY_GB, HF_MERGED_DIR
+from config import STOP_STRINGS, STOP_REGEXES, EXPLANATION_MAX_SENTENCES, LETTER_SCORE_TEMPERATURE
+from config import HF_CPU_PROFILE, HF_CPU_THREADS, HF_CPU_INTEROP_THREADS, HF_CPU_PIN_CORES
+from config import SERVER_HOST, SERVER_PORT, SERVER_MAX_CONCURRENCY, SERVER_MAX_QUEUE, SERVER_REQUEST_TIMEOUT_S
+from config import TRACE_PATH, HF_CHAT_TOKENS_CHECK, HF_CHAT_TOKEN_SESSIONS
+import tracing
+from admission import Rejected
+from hf_backend import stream_generate, score_answer, get_registry_stats
+from hf_backend import configure_cpu, configure_chat_tokens
+from tracing import Trace
+
+MAX_BODY = 4 * 2 ** 20
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error",
+            504: "Gateway Timeout"}
+_FINISH = {"max_new_tokens": "length", "error": "error"}
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[Dict] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+# ---- HTTP/1.1 plumbing ----
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict, bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = h.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    n = int(headers.get("content-length") or 0)
+    if n > MAX_BODY:
+        raise HTTPError(413, "request body too large")
+    body = await reader.readexactly(n) if n else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+def _head(status: int, headers: Dict) -> bytes:
+    lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}"] + [f"{k}: {v}" for k, v in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+async def _send(writer, status: int, body: bytes, content_type: str, keep_alive: bool = True,
+                headers: Optional[Dict] = None):
+    head = {"Content-Type": content_type, "Content-Length": str(len(body)),
+            "Connection": "keep-alive" if keep_alive else "close", **(headers or {})}
+    writer.write(_head(status, head) + body)
+    await writer.drain()
+
+async def _send_json(writer, status: int, payload: Dict, keep_alive: bool = True, headers: Optional[Dict] = None):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    await _send(writer, status, body, "application/json", keep_alive, headers)
+
+def _error(message: str, kind: str = "invalid_request_error") -> Dict:
+    return {"error": {"message": message, "type": kind}}
+
+# ---- server ----
+class ChatServer:
+    def __init__(self, models: Dict[str, Dict], default_model: str, max_concurrency: int = 8,
+                 max_queue: int = 32, timeout_s: float = 120.0):
+        self.models = models
+        self.default_model = default_model
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout_s = timeout_s
+        self.stats = {"requests": 0, "rejected": 0, "timeouts": 0, "errors": 0}
+        self.active = 0   # holding a generation slot (worker thread busy)
+        self.waiting = 0  # admitted, waiting for a slot
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="gen")
+
+    async def serve(self, host: str, port: int):
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self._connection, host, port)
+        print(f"[server] listening on http://{host}:{port} • models: {', '.join(self.models)}")
+        async with server:
+            await server.serve_forever()
+
+    async def _connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    req = await _read_request(reader)
+                except HTTPError as e:
+                    await _send_json(writer, e.status, _error(str(e)), keep_alive=False)
+                    break
+                if req is None:
+                    break
+                method, path, headers, body = req
+                keep_alive = headers.get("connection", "").lower() != "close"
+                if not await self._dispatch(method, path, body, writer, keep_alive):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, body, writer, keep_alive) -> bool:
+        """Handle one request; False closes the connection."""
+        try:
+            if path == "/health":
+                if method != "GET":
+                    raise HTTPError(405, "use GET")
+                await _send_json(writer, 200, self.health(), keep_alive)
+                return keep_alive
+            if path == "/metrics":
+                if method != "GET":
+                    raise HTTPError(405, "use GET")
+                await _send(writer, 200, tracing.render().encode("utf-8"),
+                            "text/plain; version=0.0.4; charset=utf-8", keep_alive)
+                return keep_alive
+            if path == "/v1/chat/completions":
+                if method != "POST":
+                    raise HTTPError(405, "use POST")
+                return await self._chat(body, writer, keep_alive)
+            raise HTTPError(404, f"no route {path}")
+        except HTTPError as e:
+            kind = {429: "rate_limit_error", 504: "timeout"}.get(e.status, "invalid_request_error")
+            await _send_json(writer, e.status, _error(str(e), kind), keep_alive, e.headers)
+            return keep_alive
+        except (ConnectionError, asyncio.IncompleteReadError):
+            raise
+        except Exception as e:  # a bug, not the client's fault: answer 500 instead of dropping the socket
+            self.stats["errors"] += 1
+            print(f"[server] {method} {path}: {type(e).__name__}: {e}")
+            await _send_json(writer, 500, _error(f"{type(e).__name__}: {e}", "server_error"), keep_alive=False)
+            return False
+
+    def health(self) -> Dict:
+        reg = get_registry_stats()
+        return {
+            "status": "ok", "in_flight": self.active, "queued": self.waiting,
+            "max_concurrency": self.max_concurrency, "max_queue": self.max_queue, **self.stats,
+            "models": list(self.models),
+            "resident": [m["base"] for m in reg["models"]], "resident_mb": reg["resident_mb"],
+        }
+
+    # ---- /v1/chat/completions ----
+    def _parse(self, body: bytes) -> Dict:
+        try:
+            req = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "body is not valid JSON")
+        if not isinstance(req, dict):
+            raise HTTPError(400, "body must be a JSON object")
+        messages = req.get("messages")
+        if not isinstance(messages, list) or not messages:
+            raise HTTPError(400, "'messages' must be a non-empty list")
+        for i, m in enumerate(messages):
+            if not isinstance(m, dict) or m.get("role") not in ("system", "user", "assistant"):
+                raise HTTPError(400, f"messages[{i}] must be an object with role system, user or assistant")
+            if not isinstance(m.get("content", ""), str):
+                raise HTTPError(400, f"messages[{i}].content must be a string")
+        name = req.get("model") or self.default_model
+        if not isinstance(name, str) or name not in self.models:
+            raise HTTPError(404, f"model {name!r} not served; have {sorted(self.models)}")
+        stop = req.get("stop") or []
+        if isinstance(stop, str):
+            stop = [stop]
+        if not isinstance(stop, list) or not all(isinstance(s, str) for s in stop):
+            raise HTTPError(400, "'stop' must be a string or a list of strings")
+        max_tokens = req.get("max_completion_tokens") or req.get("max_tokens") or HF_MAX_NEW_TOKENS
+        if isinstance(max_tokens, bool) or not isinstance(max_tokens, int):
+            raise HTTPError(400, "'max_tokens' must be an integer")
+        user = req.get("user")
+        if user is not None and not isinstance(user, str):
+            raise HTTPError(400, "'user' must be a string")
+        return {
+            "model": name, "messages": [{"role": m["role"], "content": m.get("content", "")} for m in messages],
+            "stream": bool(req.get("stream")), "answer_only": bool(req.get("answer_only")),
+            "max_tokens": min(max(max_tokens, 1), HF_MAX_NEW_TOKENS),  # HF_MAX_NEW_TOKENS is the ceiling
+            "stop": stop, "user": user,
+        }
+
+    def _generator(self, req: Dict, trace: Trace):
+        target = self.models[req["model"]]
+        common = dict(base_id=target["base"], adapter_path=target.get("adapter"), load_in_4bit=HF_LOAD_IN_4BIT,
+                      memory_budget_gb=HF_MODEL_MEMORY_GB, merged_dir=HF_MERGED_DIR, session=req["user"], trace=trace,
+                      admit=False)  # _admit() is the only gate
+        if req["answer_only"]:
+            return score_answer(req["messages"], temperature=LETTER_SCORE_TEMPERATURE, **common)
+        return stream_generate(
+            req["messages"], max_new_tokens=req["max_tokens"],
+            batching=HF_CONTINUOUS_BATCHING, max_batch_size=HF_MAX_BATCH_SIZE, prefix_cache_mb=HF_PREFIX_CACHE_MB,
+            stop_strings=list(STOP_STRINGS) + req["stop"], stop_regexes=list(STOP_REGEXES),
+            max_sentences=EXPLANATION_MAX_SENTENCES, **common)
+
+    async def _admit(self, deadline: float):
+        if self.active + self.waiting >= self.max_concurrency + self.max_queue:
+            self.stats["rejected"] += 1
+            raise HTTPError(429, "server saturated, retry later", {"Retry-After": "1"})
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), max(deadline - time.monotonic(), 0.001))
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            raise HTTPError(504, "timed out waiting in queue")
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def _start(self, req: Dict, trace: Trace) -> Tuple[asyncio.Queue, threading.Event]:
+        """Run the blocking generator in a worker; chunks arrive on an asyncio queue.
+        The slot is released when the worker is done, not when the client leaves."""
+        loop = asyncio.get_running_loop()
+        out: asyncio.Queue = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def _put(item):
+            loop.call_soon_threadsafe(out.put_nowait, item)
+
+        def _work():
+            gen = self._generator(req, trace)
+            try:
+                for chunk in gen:
+                    if cancelled.is_set():
+                        break
+                    _put(("chunk", chunk))
+                else:
+                    _put(("done", dict(trace.metrics)))
+            except Exception as e:
+                trace.metrics["stop_reason"] = "error"
+                _put(("error", e))
+            finally:
+                gen.close()
+                trace.finish()
+
+        def _release(_):
+            self.active -= 1
+            self._slots.release()
+
+        fut = loop.run_in_executor(self._pool, _work)
+        fut.add_done_callback(_release)
+        return out, cancelled
+
+    async def _chat(self, body: bytes, writer, keep_alive: bool) -> bool:
+        deadline = time.monotonic() + self.timeout_s
+        req = self._parse(body)
+        self.stats["requests"] += 1
+        rid, created = f"chatcmpl-{uuid.uuid4().hex[:24]}", int(time.time())
+        trace = Trace("hf", model=req["model"], request_id=rid)
+        t = time.perf_counter()
+        await self._admit(deadline)
+        trace.add_span("server_queue", t, time.perf_counter())
+        trace.metrics["queue_ms"] = (time.perf_counter() - t) * 1000.0  # the backend adds its own wait
+        out, cancelled = self._start(req, trace)
+        base = {"id": rid, "created": created, "model": req["model"]}
+
+        async def _next():
+            try:
+                return await asyncio.wait_for(out.get(), max(deadline - time.monotonic(), 0.001))
+            except asyncio.TimeoutError:
+                self.stats["timeouts"] += 1
+                return ("timeout", None)
+
+        if not req["stream"]:
+            parts = []
+            try:
+                while True:
+                    kind, item = await _next()
+                    if kind == "chunk":
+                        parts.append(item)
+                        continue
+                    break
+            finally:
+                cancelled.set()
+            if kind == "timeout":
+                raise HTTPError(504, "generation timed out")
+            if kind == "error" and isinstance(item, Rejected):
+                raise HTTPError(429, str(item), {"Retry-After": "1"})
+            if kind == "error":
+                self.stats["errors"] += 1
+                await _send_json(writer, 500, _error(str(item), "server_error"), keep_alive)
+                return keep_alive
+            payload = dict(base, object="chat.completion", choices=[{
+                "index": 0, "message": {"role": "assistant", "content": "".join(parts)},
+                "finish_reason": _FINISH.get(item.get("stop_reason"), "stop")}],
+                usage=_usage(item), metrics=item)
+            await _send_json(writer, 200, payload, keep_alive)
+            return keep_alive
+
+        head = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                "Transfer-Encoding": "chunked", "Connection": "keep-alive" if keep_alive else "close"}
+        writer.write(_head(200, head))
+
+        async def _event(obj):
+            data = b"data: " + (obj if isinstance(obj, bytes) else json.dumps(obj, ensure_ascii=False).encode("utf-8")) + b"\n\n"
+            writer.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+            await writer.drain()
+
+        chunk_base = dict(base, object="chat.completion.chunk")
+        try:
+            await _event(dict(chunk_base, choices=[{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}]))
+            while True:
+                kind, item = await _next()
+                if kind == "chunk":
+                    await _event(dict(chunk_base, choices=[{"index": 0, "delta": {"content": item}, "finish_reason": None}]))
+                    continue
+                if kind == "done":
+                    await _event(dict(chunk_base, choices=[{"index": 0, "delta": {},
+                                 "finish_reason": _FINISH.get(item.get("stop_reason"), "stop")}],
+                                 usage=_usage(item), metrics=item))
+                else:
+                    self.stats["errors"] += int(kind == "error")
+                    msg = "generation timed out" if kind == "timeout" else str(item)
+                    await _event(_error(msg, "timeout" if kind == "timeout" else "server_error"))
+                break
+            await _event(b"[DONE]")
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            cancelled.set()  # client gone or finished: the worker stops forwarding chunks
+        return keep_alive
+
+def _usage(metrics: Dict) -> Dict:
+    p, c = int(metrics.get("prompt_tokens") or 0), int(metrics.get("gen_tokens") or 0)
+    return {"prompt_tokens": p, "completion_tokens": c, "total_tokens": p + c}
+
+def main():
+    ap = argparse.ArgumentParser(description="OpenAI-compatible chat server on top of hf_backend")
+    ap.add_argument("--host", default=SERVER_HOST)
+    ap.add_argument("--port", type=int, default=SERVER_PORT)
+    ap.add_argument("--base", default=None, help="serve only this base (e.g. tiny-random) instead of MODEL_CHOICES")
+    ap.add_argument("--adapter", default=None)
+    ap.add_argument("--max-concurrency", type=int, default=SERVER_MAX_CONCURRENCY)
+    ap.add_argument("--max-queue", type=int, default=SERVER_MAX_QUEUE)
+    ap.add_argument("--timeout", type=float, default=SERVER_REQUEST_TIMEOUT_S)
+    args = ap.parse_args()
+
+    if args.base:
+        models, default = {args.base: {"base": args.base, "adapter": args.adapter}}, args.base
+    else:
+        models, default = dict(MODEL_CHOICES), MODEL
+    configure_cpu(HF_CPU_PROFILE, HF_CPU_THREADS, HF_CPU_INTEROP_THREADS, HF_CPU_PIN_CORES)
+    configure_chat_tokens(HF_CHAT_TOKENS_CHECK, HF_CHAT_TOKEN_SESSIONS)
+    tracing.configure(TRACE_PATH)
+    server = ChatServer(models, default, args.max_concurrency, args.max_queue, args.timeout)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+# speculative.py
+"""
+Speculative decoding for one greedy stream (explanation mode).
+
+A cheap drafter proposes k tokens. The target model scores [last token + draft]
+in a single forward pass; the longest draft prefix that equals the target's own
+greedy choice is kept, plus the target's token at the first mismatch. Every
+emitted token is the target's greedy pick, so the text is identical to plain
+greedy generate(); the gain is fewer sequential target forwards.
+
+Drafters:
+  PromptLookupDrafter  n-gram lookup in prompt + generated ids, no extra model
+                       (explanations quote the question and options a lot)
+  DraftModelDrafter    a small model with the same tokenizer,
+                       e.g. Qwen/Qwen2.5-0.5B-Instruct for Qwen/Qwen2.5-7B-Instruct
+
+The draft length adapts to the acceptance rate: +2 after a fully accepted
+draft, -1 after a rejection (between 1 and max_draft).
+
+    python speculative.py                         # tiny CPU model, checks output == greedy
+    python speculative.py --model Qwen/Qwen2.5-0.5B-Instruct --mode draft --draft-model ...
+"""
+import argparse
+import time
+from typing import Dict, List, Optional
+
+import torch
+from transformers import DynamicCache
+
+MODES = ("prompt_lookup", "draft")
+
+def _truncate(cache, length: int):
+    extra = cache.get_seq_length() - length
+    if extra > 0:
+        cache.crop(-extra)  # negative = drop that many trailing positions
+
+class PromptLookupDrafter:
+    def __init__(self, max_ngram: int = 3, min_ngram: int = 1):
+        self.sizes = range(max_ngram, min_ngram - 1, -1)
+        self._index: Dict[int, Dict[tuple, int]] = {n: {} for n in self.sizes}  # n-gram -> position after its latest copy
+        self._indexed = 1
+
+    def draft(self, ids: List[int], k: int) -> List[int]:
+        # only n-grams followed by at least one token are indexed, so the trailing one finds an earlier copy
+        for end in range(self._indexed, len(ids)):
+            for n in self.sizes:
+                if end >= n:
+                    self._index[n][tuple(ids[end - n:end])] = end
+        self._indexed = max(self._indexed, len(ids))
+        for n in self.sizes:
+            start = self._index[n].get(tuple(ids[-n:])) if len(ids) >= n else None
+            if start is not None:
+                return ids[start:start + k]
+        return []
+
+class DraftModelDrafter:
+    def __init__(self, model):
+        self.model = model
+        self._cache = DynamicCache()
+        self._ids: List[int] = []  # tokens whose KV is in _cache
+
+    @torch.no_grad()
+    def draft(self, ids: List[int], k: int) -> List[int]:
+        keep = 0
+        for a, b in zip(self._ids, ids):
+            if a != b:
+                break
+            keep += 1
+        keep = min(keep, len(ids) - 1)  # re-feed at least one token to get logits
+        _truncate(self._cache, keep)
+        feed, out = ids[keep:], []
+        for _ in range(k):
+            x = torch.tensor([feed], device=self.model.device)
+            logits = self.model(input_ids=x, past_key_values=self._cache, use_cache=True, logits_to_keep=1).logits
+            feed = [int(logits[0, -1].argmax())]
+            out.append(feed[0])
+        self._ids = ids + out[:-1]
+        return out
+
+class SpecOutput:
+    """Shaped like generate(return_dict_in_generate=True) output."""
+    def __init__(self, sequences: torch.Tensor, past_key_values, stats: Dict):
+        self.sequences = sequences
+        self.past_key_values = past_key_values
+        self.stats = stats
+
+def pick_greedy(logits: torch.Tensor, ids: List[int], repetition_penalty: float) -> int:
+    """Greedy token, with generate()'s repetition penalty so the choice matches it exactly."""
+    if repetition_penalty != 1.0:
+        logits = logits.float()
+        idx = torch.tensor(ids, device=logits.device)
+        score = logits.gather(0, idx)
+        logits = logits.scatter(0, idx, torch.where(score < 0, score * repetition_penalty, score / repetition_penalty))
+    return int(logits.argmax())
+
+@torch.no_grad()
+def speculative_generate(model, input_ids: torch.Tensor, drafter, *, max_new_tokens: int,
+                         eos_token_id=None, past_key_values=None, stopping_criteria=None,
+                         streamer=None, num_draft: int = 4, max_draft: int = 10,
+                         repetition_penalty: Optional[float] = None, **forward_kwargs) -> SpecOutput:
+    """
+    Greedy decoding of a batch-of-one prompt with draft-and-verify steps.
+    past_key_values may hold KV for a prefix of input_ids (prefix cache);
+    forward_kwargs go to every target forward (e.g. PEFT adapter_names).
+    Stats: drafted / accepted tokens, acceptance_rate, target forward steps.
+    """
+    device = input_ids.device
+    eos = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]) - {None}
+    if repetition_penalty is None:
+        repetition_penalty = getattr(model.generation_config, "repetition_penalty", None) or 1.0
+    cache = past_key_values if past_key_values is not None else DynamicCache()
+    ids = input_ids[0].tolist()
+    prompt_len, k = len(ids), max(1, num_draft)
+    stats = {"drafted": 0, "accepted": 0, "steps": 1}
+
+    if streamer is not None:
+        streamer.put(input_ids.cpu())  # swallowed as the prompt, like generate()
+    try:
+        logits = model(input_ids=input_ids[:, cache.get_seq_length():], past_key_values=cache,
+                       use_cache=True, logits_to_keep=1, **forward_kwargs).logits
+        new = [pick_greedy(logits[0, -1], ids, repetition_penalty)]
+        while True:
+            # invariant: cache holds KV for ids[:-1] + accepted drafts; `new` are the tokens just decided
+            room = max_new_tokens - (len(ids) - prompt_len)
+            new = new[:room]
+            for i, t in enumerate(new):
+                if t in eos:
+                    new = new[:i + 1]
+                    break
+            ids.extend(new)
+            if streamer is not None:
+                streamer.put(torch.tensor(new))
+            if new[-1] in eos or len(ids) - prompt_len >= max_new_tokens:
+                break
+            if stopping_criteria is not None and bool(stopping_criteria(torch.tensor([ids], device=device), None).any()):
+                break
+
+            draft = drafter.draft(ids, min(k, max_new_tokens - (len(ids) - prompt_len) - 1))
+            x = torch.tensor([[ids[-1]] + draft], device=device)
+            logits = model(input_ids=x, past_key_values=cache, use_cache=True, **forward_kwargs).logits[0]
+            new = []
+            for i in range(len(draft) + 1):
+                new.append(pick_greedy(logits[i], ids + new, repetition_penalty))
+                if i == len(draft) or draft[i] != new[-1]:
+                    break
+            accepted = len(new) - 1
+            _truncate(cache, len(ids) + accepted)  # last token + accepted drafts; the correction is fed next step
+            stats["steps"] += 1
+            if draft:
+                stats["drafted"] += len(draft)
+                stats["accepted"] += accepted
+                k = min(k + 2, max_draft) if accepted == len(draft) else max(1, k - 1)
+    finally:
+        if streamer is not None:
+            streamer.end()
+
+    _truncate(cache, len(ids) - 1)  # drop KV past an EOS or budget cut
+    stats["acceptance_rate"] = stats["accepted"] / stats["drafted"] if stats["drafted"] else 0.0
+    return SpecOutput(torch.tensor([ids], device=device), cache, stats)
+
+def _bench():
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from tiny_model import TINY_MODEL_ID, build_tiny_model
+
+    ap = argparse.ArgumentParser(description="Greedy vs speculative decoding on one prompt")
+    ap.add_argument("--model", default=TINY_MODEL_ID)
+    ap.add_argument("--mode", choices=MODES, default="prompt_lookup")
+    ap.add_argument("--draft-model", default=None, help="for --mode draft (default: tiny-random:1 / the model itself)")
+    ap.add_argument("--max-new", type=int, default=128)
+    ap.add_argument("--num-draft", type=int, default=4)
+    ap.add_argument("--max-draft", type=int, default=10)
+    ap.add_argument("--ngram", type=int, default=3)
+    ap.add_argument("--runs", type=int, default=3)
+    args = ap.parse_args()
+
+    def load(model_id):
+        if model_id.startswith(TINY_MODEL_ID):
+            return build_tiny_model(seed=int(model_id.partition(":")[2] or 0))
+        tok = AutoTokenizer.from_pretrained(model_id)
+        return AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float32).eval(), tok
+
+    model, tok = load(args.model)
+    draft_model = None
+    if args.mode == "draft":
+        draft_id = args.draft_model or (TINY_MODEL_ID + ":1" if args.model == TINY_MODEL_ID else args.model)
+        draft_model = load(draft_id)[0]
+    question = ("Which nerve supplies the lateral rectus muscle?\nA. Oculomotor\nB. Trochlear\n"
+                "C. Abducens\nD. Facial\nExplain the answer, referring to each option.")
+    text = tok.apply_chat_template([{"role": "user", "content": question}], tokenize=False, add_generation_prompt=True)
+    input_ids = tok([text], return_tensors="pt").input_ids
+
+    def greedy():
+        return model.generate(input_ids, max_new_tokens=args.max_new, do_sample=False,
+                              pad_token_id=tok.pad_token_id, eos_token_id=tok.eos_token_id)[0].tolist()
+
+    def spec():
+        drafter = PromptLookupDrafter(args.ngram) if draft_model is None else DraftModelDrafter(draft_model)
+        out = speculative_generate(model, input_ids, drafter, max_new_tokens=args.max_new, eos_token_id=tok.eos_token_id,
+                                   num_draft=args.num_draft, max_draft=args.max_draft)
+        return out.sequences[0].tolist(), out.stats
+
+    for name, fn in (("greedy", greedy), ("speculative", spec)):
+        fn()  # warm-up
+        best, result = None, None
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            result = fn()
+            best = min(best or 1e9, time.perf_counter() - t0)
+        seq = result[0] if name == "speculative" else result
+        n_new = len(seq) - input_ids.shape[1]
+        extra = ""
+        if name == "speculative":
+            s = result[1]
+            extra = f"  acceptance {s['acceptance_rate']:.0%} ({s['accepted']}/{s['drafted']})  target steps {s['steps']}"
+        print(f"{name:12s} {n_new} tokens  {best * 1000:.0f} ms  {n_new / best:.1f} tok/s{extra}")
+        if name == "greedy":
+            reference = seq
+    print("identical to greedy:", seq == reference)
+
+if __name__ == "__main__":
+    _bench()
@@ -0,0 +1,156 @@
+# startup.py
+"""
+Cold start for the app.
+
+Heavy modules are imported on first use and only for the configured backend:
+hf_backend (torch, transformers, peft) for BACKEND "hf" (and "server" / "pool",
+which need the tokenizer to budget context), ollama_backend for "ollama".
+load_hf_backend() / load_ollama_backend() are that first use: they import the
+backend and apply the process-wide settings from config.py once. load_worker_pool() starts the model
+worker processes for "pool".
+
+Warmup runs the cold start on a background thread, stage by stage:
+
+    import    backend modules
+    download  weights into the Hub cache (0 when cached / local / merged artifact)
+    load      model + tokenizer into memory (the model registry keeps them resident)
+    warmup    dummy prefill + decode steps (and the static-cache compile, if enabled)
+
+main.py starts one per process (st.cache_resource) at the first page load and
+shows its progress; a message sent before it finishes simply waits for the load
+already under way. report() is the cold-start breakdown printed at the end.
+"""
+import importlib
+import threading
+import time
+from typing import Dict, Optional
+
+from config import BACKEND, CONTEXT_TOKENS, HF_LOAD_IN_4BIT, HF_MODEL_MEMORY_GB, HF_MERGED_DIR
+from config import HF_BASE_ID, HF_ADAPTER_PATH, POOL_WORKERS, POOL_DEVICES, POOL_CORES, POOL_MAX_INFLIGHT
+from config import POOL_REQUEST_TIMEOUT_S
+from config import HF_MAX_CONCURRENCY, HF_MAX_QUEUE, HF_QUEUE_TIMEOUT_S
+from config import HF_CPU_PROFILE, HF_CPU_THREADS, HF_CPU_INTEROP_THREADS, HF_CPU_PIN_CORES
+from config import HF_STATIC_DECODE, HF_STATIC_MIN_BUCKET, HF_COMPILE_DECODE, HF_SPECULATIVE, HF_MAX_NEW_TOKENS
+from config import HF_CHAT_TOKENS_CHECK, HF_CHAT_TOKEN_SESSIONS
+from config import OLLAMA_HOST, OLLAMA_KEEP_ALIVE, OLLAMA_PIN_MODELS, OLLAMA_POOL_CONNECTIONS, OLLAMA_TIMEOUT_S
+
+STAGES = ("import", "download", "load", "warmup")
+_lock = threading.Lock()
+_configured = {"hf": False, "ollama": False}
+_workers = {"pool": None}
+
+def load_hf_backend():
+    """hf_backend, imported on first use, with admission limits and the CPU profile applied once."""
+    import hf_backend
+
+    with _lock:
+        if not _configured["hf"]:
+            hf_backend.configure_admission(HF_MAX_CONCURRENCY, HF_MAX_QUEUE, HF_QUEUE_TIMEOUT_S)
+            hf_backend.configure_cpu(HF_CPU_PROFILE, HF_CPU_THREADS, HF_CPU_INTEROP_THREADS, HF_CPU_PIN_CORES)
+            hf_backend.configure_chat_tokens(HF_CHAT_TOKENS_CHECK, HF_CHAT_TOKEN_SESSIONS)
+            _configured["hf"] = True
+    return hf_backend
+
+def load_ollama_backend():
+    """ollama_backend, imported on first use, with the host / keep-alive / pool settings applied once."""
+    import ollama_backend
+
+    with _lock:
+        if not _configured["ollama"]:
+            ollama_backend.configure(OLLAMA_HOST, OLLAMA_KEEP_ALIVE, OLLAMA_POOL_CONNECTIONS, OLLAMA_TIMEOUT_S)
+            _configured["ollama"] = True
+    return ollama_backend
+
+def load_worker_pool():
+    """The model worker processes (worker_pool.py), started on first use; each loads the default model."""
+    from worker_pool import WorkerPool
+
+    with _lock:
+        if _workers["pool"] is None:
+            _workers["pool"] = WorkerPool(POOL_WORKERS, POOL_DEVICES, POOL_CORES, POOL_MAX_INFLIGHT,
+                                          warm={"base": HF_BASE_ID, "adapter": HF_ADAPTER_PATH},
+                                          timeout_s=POOL_REQUEST_TIMEOUT_S)
+    return _workers["pool"]
+
+class Warmup:
+    def __init__(self, target: Dict, backend: str = BACKEND):
+        self.target = target  # {"label", "base", "adapter"} as in config.MODEL_CHOICES
+        self.backend = backend
+        self.stage: Optional[str] = None
+        self.done = False
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+
+    def start(self) -> "Warmup":
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+        return self
+
+    @property
+    def progress(self) -> float:
+        return 1.0 if self.done else len(self.timings) / len(STAGES)
+
+    def _stage(self, name: str, fn):
+        self.stage = name
+        t0 = time.perf_counter()
+        result = fn()
+        self.timings[name] = time.perf_counter() - t0
+        return result
+
+    def run(self):
+        t0 = time.perf_counter()
+        try:
+            {"hf": self._hf, "server": self._server, "pool": self._pool, "ollama": self._ollama}[self.backend]()
+        except Exception as e:
+            self.error = f"{type(e).__name__}: {e}"[:300]
+            print(f"[startup] warm-up failed during {self.stage}: {self.error}")
+        self.timings["total"] = time.perf_counter() - t0
+        self.done = True
+        print(self.report())
+
+    def _hf(self):
+        hf = self._stage("import", load_hf_backend)
+        base, adapter = self.target["base"], self.target["adapter"]
+        self._stage("download", lambda: hf.download_weights(base, adapter, HF_MERGED_DIR))
+
+        def _load():
+            hf.get_tokenizer(base)  # the context-trimming tokenizer is separate from the model's
+            return hf.load_hf(base, adapter, HF_LOAD_IN_4BIT, HF_MODEL_MEMORY_GB, HF_MERGED_DIR)
+        model, tok, name = self._stage("load", _load)
+
+        def _warm():
+            hf.warm_up(model, tok, name)
+            if HF_STATIC_DECODE and not HF_SPECULATIVE:
+                hf.get_static_engine(model, hf.static_len(base, CONTEXT_TOKENS, HF_MAX_NEW_TOKENS),
+                                     HF_STATIC_MIN_BUCKET, HF_COMPILE_DECODE, name)  # compiles every bucket
+        self._stage("warmup", _warm)
+
+    def _server(self):
+        # the model lives in server.py; here only the tokenizer used for context trimming (no torch)
+        tb = self._stage("import", lambda: importlib.import_module("token_budget"))
+        self._stage("download", lambda: None)
+        self._stage("load", lambda: tb.counter(self.target["base"]))
+        self._stage("warmup", lambda: None)
+
+    def _pool(self):
+        # models live in the worker processes; here the tokenizer (no torch) and the pool. Workers
+        # download on their own; the Hub cache's file locks make that one download.
+        tb = self._stage("import", lambda: importlib.import_module("token_budget"))
+        self._stage("download", lambda: None)
+        self._stage("load", lambda: (tb.counter(self.target["base"]), load_worker_pool().wait_ready()))
+        self._stage("warmup", lambda: None)  # every worker warms up before it reports ready
+
+    def _ollama(self):
+        ob = self._stage("import", load_ollama_backend)
+        self._stage("download", lambda: None)  # `ollama pull` is the user's job
+        model = self.target["label"]
+        # empty chat = load into memory; pinned models stay there (keep_alive=-1 on every request)
+        self._stage("load", lambda: ob.pin(model) if model in OLLAMA_PIN_MODELS else ob.load(model))
+        self._stage("warmup", lambda: ob.chat(model, [{"role": "user", "content": "Hi"}], options={"num_predict": 1}))
+
+    def summary(self) -> str:
+        parts = [f"{s} {self.timings[s]:.1f}s" for s in STAGES if s in self.timings]
+        tail = f" (failed during {self.stage}: {self.error})" if self.error else ""
+        return " • ".join(parts + [f"total {self.timings.get('total', 0.0):.1f}s"]) + tail
+
+    def report(self) -> str:
+        return f"[startup] {self.backend} {self.target['label']}: {self.summary()}"
@@ -0,0 +1,215 @@
+# static_decode.py
+"""
+Static KV cache + compiled single-token decode step (opt-in, HF_STATIC_DECODE).
+
+The default path grows a DynamicCache by one position per token and runs every
+step eagerly, so each token pays Python dispatch plus new allocations. Here the
+KV cache is preallocated (StaticCache) and the decode forward, whose shapes are
+then fixed, goes through torch.compile. The prompt is prefilled eagerly.
+
+Cache lengths are bucketed (doubling sizes up to context budget + max new tokens),
+so there is one compiled graph per bucket and recompiles stay bounded; a request
+takes the smallest bucket that fits prompt + max_new_tokens. Up to max_idle
+idle caches per bucket are pooled for the next requests (extra ones, from a
+burst, are dropped), and concurrent requests never share one.
+
+Compilation happens in warmup() (once per model and adapter: adapter_names is
+part of the graph); each bucket keeps the cache it was warmed on. If the compiled
+step fails, the engine keeps the static caches and runs the step eagerly; if
+the model cannot use a static cache at all, `usable` is False and callers use
+generate().
+
+    python static_decode.py           # tiny CPU model: TPOT of eager generate() vs static eager vs compiled
+"""
+import argparse
+import threading
+import time
+from typing import Dict, List, Optional
+
+import torch
+from transformers import StaticCache
+
+import kv_cache
+from speculative import SpecOutput, pick_greedy
+
+def bucket_sizes(max_len: int, min_len: int = 512) -> List[int]:
+    """Cache lengths doubling from min_len, topped by max_len: log2(max/min) + 1 graphs at most."""
+    sizes, b = [], min_len
+    while b < max_len:
+        sizes.append(b)
+        b *= 2
+    return sizes + [max_len]
+
+class StaticDecodeEngine:
+    def __init__(self, model, max_len: int, min_bucket: int = 512, compile: bool = True, max_idle: int = 1):
+        self.model = model
+        self.buckets = bucket_sizes(max_len, min_bucket)
+        self.max_idle = max_idle
+        self.usable = True
+        self.compiled = False
+        self.error: Optional[str] = None
+        self.stats = {"requests": 0, "compile_s": 0.0, "warmup_s": 0.0}
+        self._free: Dict[int, List[StaticCache]] = {b: [] for b in self.buckets}
+        self._warmed = set()  # forward kwargs (adapter) the step was warmed up for
+        self._lock = threading.Lock()
+        self._warm_lock = threading.Lock()
+        self._step = model.forward
+        if compile:
+            mode = "reduce-overhead" if model.device.type == "cuda" else None  # CUDA graphs on GPU
+            self._step = torch.compile(model.forward, dynamic=False, mode=mode)
+            self.compiled = True
+
+    def bucket(self, total_len: int) -> Optional[int]:
+        return next((b for b in self.buckets if b >= total_len), None)
+
+    def warmup(self, **forward_kwargs):
+        """Prefill + a few decode steps in every bucket so compilation happens now, not on a user request.
+        Once per forward_kwargs; each bucket's warmed cache is pooled, so the first request decodes
+        on the buffers the step was compiled (and CUDA-graph recorded) against. Concurrent callers
+        wait for the warm-up under way on this engine only."""
+        key = repr(sorted(forward_kwargs.items()))
+        with self._warm_lock:
+            if key in self._warmed or not self.usable:
+                return
+            self._warmup(key, forward_kwargs)
+
+    def _warmup(self, key: str, forward_kwargs: Dict):
+        self._warmed.add(key)
+        if self.compiled:
+            dyn = torch._dynamo.config
+            limit = "recompile_limit" if hasattr(dyn, "recompile_limit") else "cache_size_limit"
+            setattr(dyn, limit, max(getattr(dyn, limit), 2 * len(self.buckets) * len(self._warmed)))
+        t0 = time.perf_counter()
+        ids = torch.zeros((1, 8), dtype=torch.long, device=self.model.device)
+        for b in self.buckets:
+            try:
+                self.generate(ids, max_new_tokens=3, bucket=b, **forward_kwargs)
+            except Exception as e:
+                self.error, self.usable = f"{type(e).__name__}: {e}"[:300], False
+                print(f"[static] static cache unusable, falling back to generate(): {self.error}")
+                return
+        self.stats["warmup_s"] += time.perf_counter() - t0
+        if self.compiled:
+            self.stats["compile_s"] = self.stats["warmup_s"]
+        print(f"[static] warmed up buckets {self.buckets} in {self.stats['warmup_s']:.1f}s "
+              f"({'compiled' if self.compiled else 'eager'})")
+
+    def _uncompile(self, e: Exception):
+        """The compiled step failed: keep the static caches, run the step eagerly from now on."""
+        self.error = f"{type(e).__name__}: {e}"[:300]
+        print(f"[static] compile failed, decoding eagerly on the static cache: {self.error}")
+        self.compiled, self._step = False, self.model.forward
+
+    def _take(self, bucket: int) -> StaticCache:
+        with self._lock:
+            if self._free[bucket]:
+                return self._free[bucket].pop()
+        return StaticCache(config=self.model.config, max_cache_len=bucket)
+
+    def _give(self, bucket: int, cache: StaticCache):
+        with self._lock:
+            if len(self._free[bucket]) >= self.max_idle:
+                return  # burst over: let this one go
+            cache.reset()  # in place: the compiled graph keeps pointing at the same tensors
+            self._free[bucket].append(cache)
+
+    def _decode(self, token: int, pos: int, cache, forward_kwargs) -> torch.Tensor:
+        x = torch.tensor([[token]], device=self.model.device)
+        cache_position = torch.tensor([pos], device=self.model.device)
+        try:
+            out = self._step(input_ids=x, past_key_values=cache, cache_position=cache_position,
+                             use_cache=True, **forward_kwargs)
+        except Exception as e:
+            if not self.compiled:
+                raise
+            self._uncompile(e)
+            out = self._step(input_ids=x, past_key_values=cache, cache_position=cache_position,
+                             use_cache=True, **forward_kwargs)
+        return out.logits[0, -1]
+
+    @torch.no_grad()
+    def generate(self, input_ids: torch.Tensor, *, max_new_tokens: int, eos_token_id=None,
+                 past_key_values=None, stopping_criteria=None, streamer=None,
+                 repetition_penalty: Optional[float] = None, return_kv: bool = False,
+                 bucket: Optional[int] = None, **forward_kwargs) -> SpecOutput:
+        """
+        Greedy decoding of a batch-of-one prompt on a pooled static cache.
+        past_key_values (DynamicCache for a prompt prefix) is copied in first.
+        With return_kv the KV of the finished sequence comes back as a DynamicCache.
+        """
+        ids = input_ids[0].tolist()
+        prompt_len = len(ids)
+        bucket = bucket or self.bucket(prompt_len + max_new_tokens)
+        if bucket is None:
+            raise ValueError(f"{prompt_len}+{max_new_tokens} tokens exceed the largest static bucket {self.buckets[-1]}")
+        eos = set(eos_token_id if isinstance(eos_token_id, (list, tuple)) else [eos_token_id]) - {None}
+        if repetition_penalty is None:
+            repetition_penalty = getattr(self.model.generation_config, "repetition_penalty", None) or 1.0
+        device = input_ids.device
+        cache = self._take(bucket)
+        self.stats["requests"] += 1
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+        try:
+            start = 0
+            for i, (k, v) in enumerate(kv_cache.cache_to_layers(past_key_values)):
+                start = int(k.shape[-2])
+                cache.update(k, v, i, {"cache_position": torch.arange(start, device=device)})
+            logits = self.model(input_ids=input_ids[:, start:], past_key_values=cache, use_cache=True,
+                                cache_position=torch.arange(start, prompt_len, device=device),
+                                logits_to_keep=1, **forward_kwargs).logits[0, -1]
+            while True:
+                token = pick_greedy(logits, ids, repetition_penalty)
+                ids.append(token)
+                if streamer is not None:
+                    streamer.put(torch.tensor([token]))
+                if token in eos or len(ids) - prompt_len >= max_new_tokens:
+                    break
+                if stopping_criteria is not None and bool(stopping_criteria(torch.tensor([ids], device=device), None).any()):
+                    break
+                logits = self._decode(token, len(ids) - 1, cache, forward_kwargs)
+            past = None
+            if return_kv:
+                n = len(ids) - 1  # the last token was never fed
+                layers = [(k[..., :n, :], v[..., :n, :]) for k, v in kv_cache.cache_to_layers(cache)]
+                past = kv_cache.layers_to_cache(kv_cache.clone(layers))
+        finally:
+            if streamer is not None:
+                streamer.end()
+            self._give(bucket, cache)
+        return SpecOutput(torch.tensor([ids], device=device), past, {"bucket": bucket, "compiled": self.compiled})
+
+def _bench():
+    from tiny_model import build_tiny_model
+
+    ap = argparse.ArgumentParser(description="Time per output token: generate() vs static cache (eager / compiled)")
+    ap.add_argument("--hidden", type=int, default=256)
+    ap.add_argument("--layers", type=int, default=4)
+    ap.add_argument("--prompt", type=int, default=200)
+    ap.add_argument("--max-new", type=int, default=64)
+    ap.add_argument("--max-len", type=int, default=1024)
+    ap.add_argument("--min-bucket", type=int, default=512)
+    args = ap.parse_args()
+
+    model, tok = build_tiny_model(hidden_size=args.hidden, num_layers=args.layers)
+    ids = torch.randint(0, 200, (1, args.prompt))
+
+    def tpot(run):
+        run()
+        t0 = time.perf_counter()
+        out = run()
+        return (time.perf_counter() - t0) * 1000.0 / args.max_new, out[0, args.prompt:].tolist()
+
+    with torch.no_grad():
+        base_ms, reference = tpot(lambda: model.generate(ids, max_new_tokens=args.max_new, min_new_tokens=args.max_new,
+                                                         do_sample=False, pad_token_id=tok.pad_token_id))
+    print(f"generate()       TPOT {base_ms:6.2f} ms")
+    for compiled in (False, True):
+        engine = StaticDecodeEngine(model, args.max_len, args.min_bucket, compile=compiled)
+        engine.warmup()
+        ms, new = tpot(lambda: engine.generate(ids, max_new_tokens=args.max_new).sequences)
+        name = "static compiled" if engine.compiled else "static eager"
+        print(f"{name:16s} TPOT {ms:6.2f} ms  ({base_ms / ms:.2f}x)  identical tokens: {new == reference}")
+
+if __name__ == "__main__":
+    _bench()
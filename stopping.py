@@ -0,0 +1,145 @@
+# stopping.py
+"""
+Early termination on stop strings, regex patterns and an explanation sentence budget.
+
+StopMatcher is fed the decoded stream piece by piece and returns the part that is
+safe to show. Matches may span chunk/token boundaries: stop strings are searched
+with an overlap of (longest stop string - 1) chars, and text that could still turn
+into a stop string is held back until it can't.
+
+    stop strings     -> output ends BEFORE the match (like OpenAI/HF stop)
+    regex patterns   -> output ends AFTER the match (the pattern is what we wanted, e.g. "Answer: B")
+    sentence budget  -> output ends after the Nth sentence following the marker ("Explanation:")
+
+A sentence ends at . ! or ? followed by whitespace and an uppercase letter (an
+opening quote or bracket may come first), so "Fig. 2" and "e.g. fever" don't
+count; a period after a known abbreviation ("Dr. Smith", "vs. B") or an initial
+never does.
+
+Pure text logic (no torch) so the Ollama path can use it too; the HF
+StoppingCriteria wrapper lives in hf_backend.py.
+"""
+import re
+from typing import Iterable, Optional
+
+_SENTENCE_END = re.compile(r"[.!?](?=\s+[\"'(\[]?[A-Z])")
+_UNDECIDED_END = re.compile(r"[.!?][\s\"'(\[]*$")  # terminator whose next letter hasn't arrived yet
+_LAST_WORD = re.compile(r"(?:^|[\s(\[])([\w.]+)$")
+_ABBREVIATIONS = {"e.g", "i.e", "dr", "mr", "mrs", "ms", "prof", "st", "vs", "approx", "fig", "figs",
+                  "no", "cf", "al", "ca", "resp", "jr", "sr"}
+
+def _abbreviation(text: str, dot: int) -> bool:
+    """Is the period at `dot` part of an abbreviation or an initial ("J. Smith")?"""
+    m = _LAST_WORD.search(text, max(0, dot - 12), dot)
+    if m is None:
+        return False
+    word = m.group(1).rstrip(".").lower()
+    return word in _ABBREVIATIONS or (len(word) == 1 and word.isalpha())
+
+class StopMatcher:
+    def __init__(self, stop_strings: Iterable[str] = (), stop_regexes: Iterable[str] = (),
+                 max_sentences: Optional[int] = None, sentence_marker: str = "Explanation:",
+                 regex_lookback: int = 256):
+        self.stop_strings = [s for s in stop_strings if s]
+        self.stop_regexes = [re.compile(p) for p in stop_regexes]
+        self.max_sentences = max_sentences
+        self.sentence_marker = sentence_marker
+        self.regex_lookback = regex_lookback
+        self._longest = max((len(s) for s in self.stop_strings), default=0)
+
+        self.text = ""
+        self.reason: Optional[str] = None
+        self._emitted = 0
+        self._scanned = 0            # text length at the previous feed
+        self._marker_end: Optional[int] = None
+        self._sent_scan = 0
+        self._sentences = 0
+
+    @property
+    def stopped(self) -> bool:
+        return self.reason is not None
+
+    def feed(self, delta: str) -> str:
+        """Add decoded text; return what can be shown now."""
+        if self.stopped or not delta:
+            return ""
+        self.text += delta
+        cut = self._find_cut()
+        self._scanned = len(self.text)
+        if cut is not None:
+            out = self.text[self._emitted:cut]
+            self._emitted = cut
+            return out
+        safe = len(self.text) - self._holdback()
+        out = self.text[self._emitted:safe] if safe > self._emitted else ""
+        self._emitted = max(self._emitted, safe)
+        return out
+
+    def flush(self) -> str:
+        """Generation ended without a match: release held-back text."""
+        if self.stopped:
+            return ""
+        out = self.text[self._emitted:]
+        self._emitted = len(self.text)
+        return out
+
+    def output(self) -> str:
+        """Everything that was (or will be, after flush) shown."""
+        return self.text[:self._emitted] if self.stopped else self.text
+
+    # ---- internals ----
+    def _find_cut(self) -> Optional[int]:
+        candidates = []
+        start = max(0, self._scanned - self._longest + 1)
+        for s in self.stop_strings:
+            i = self.text.find(s, start)
+            if i != -1:
+                candidates.append((i, "stop_string"))
+        if self.stop_regexes:
+            base = max(0, self._scanned - self.regex_lookback)
+            window = self.text[base:]
+            for rx in self.stop_regexes:
+                m = rx.search(window)
+                if m:
+                    candidates.append((base + m.end(), "stop_regex"))
+        if self.max_sentences:
+            end = self._sentence_cut()
+            if end is not None:
+                candidates.append((end, "sentence_budget"))
+        if not candidates:
+            return None
+        cut, self.reason = min(candidates)
+        return cut
+
+    def _sentence_cut(self) -> Optional[int]:
+        if self._marker_end is None:
+            i = self.text.find(self.sentence_marker, max(0, self._scanned - len(self.sentence_marker) + 1))
+            if i == -1:
+                return None
+            self._marker_end = self._sent_scan = i + len(self.sentence_marker)
+        for m in _SENTENCE_END.finditer(self.text, self._sent_scan):
+            if self.text[m.start()] == "." and _abbreviation(self.text, m.start()):
+                continue
+            self._sentences += 1
+            if self._sentences >= self.max_sentences:
+                return m.end()
+        # a terminator at the end may still be waiting for its whitespace / next letter
+        pending = _UNDECIDED_END.search(self.text, self._sent_scan)
+        self._sent_scan = max(self._sent_scan, pending.start() if pending else len(self.text))
+        return None
+
+    def _holdback(self) -> int:
+        """Length of the longest text suffix that is a proper prefix of some stop string
+        (or that follows a terminator which may still end the last budgeted sentence)."""
+        if self.max_sentences and self._marker_end is not None and self._sentences == self.max_sentences - 1:
+            pending = _UNDECIDED_END.search(self.text, self._sent_scan)
+            if pending is not None:
+                return max(len(self.text) - pending.start() - 1, self._stop_holdback())
+        return self._stop_holdback()
+
+    def _stop_holdback(self) -> int:
+        for k in range(min(self._longest - 1, len(self.text)), 0, -1):
+            tail = self.text[-k:]
+            if any(s.startswith(tail) for s in self.stop_strings):
+                return k
+        return 0
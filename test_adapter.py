@@ -1,6 +1,7 @@
 import argparse, time, torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from peft import PeftModel
+from merge_export import find_merged, load_merged
 
 EXPLAIN_PROMPT = """You are a medical expert. Answer the MCQ and briefly justify in 3–6 sentences.
 
@@ -33,17 +34,24 @@ Respond in the format:
 Answer: <A/B/C/D>
 """
 
-def build_chat_text(tokenizer, prompt: str):
-    """Use the model's chat template so formatting matches the base."""
-    messages = [
+def chat_messages(prompt: str):
+    return [
         {"role": "system", "content": "You are a medical expert."},
         {"role": "user", "content": prompt.strip()},
     ]
+
+def build_chat_text(tokenizer, prompt: str):
+    """Use the model's chat template so formatting matches the base."""
     return tokenizer.apply_chat_template(
-        messages, tokenize=False, add_generation_prompt=True
+        chat_messages(prompt), tokenize=False, add_generation_prompt=True
     )
 
-def load_base_and_adapter(base_id: str, adapter_path: str, load_in_4bit: bool):
+def load_base_and_adapter(base_id: str, adapter_path: str, load_in_4bit: bool, merged_dir: str = "merged"):
+    merged = find_merged(merged_dir, base_id, adapter_path)
+    if merged:
+        # pre-merged weights (merge_export.py): no PEFT wrapper, loaded memory-mapped
+        return load_merged(merged, load_in_4bit)
+
     kwargs = dict(
         device_map="auto",
         torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
@@ -102,6 +110,8 @@ def main():
     ap.add_argument("--mode", choices=["answer", "explain"], default="explain",
                     help="answer = letter only; explain = letter + brief explanation")
     ap.add_argument("--load-in-4bit", action="store_true", help="Use 4-bit (bitsandbytes) to reduce VRAM")
+    ap.add_argument("--merged-dir", default="merged", help="merge_export.py --root (its output cache): a fresh artifact there is "
+                         "loaded instead of base + adapter, a stale one is ignored ('' = don't look)")
     ap.add_argument("--max-new", type=int, default=256)
     # quick demo question (you can pass your own later by editing below)
     ap.add_argument("--question", default="Which one of these is absorbed in ileum?")
@@ -111,7 +121,7 @@ def main():
     ap.add_argument("--opd", default="Fat")
     args = ap.parse_args()
 
-    model, tok = load_base_and_adapter(args.base, args.adapter, args.load_in_4bit)
+    model, tok = load_base_and_adapter(args.base, args.adapter, args.load_in_4bit, args.merged_dir)
 
     if args.mode == "explain":
         prompt = EXPLAIN_PROMPT.format(
@@ -0,0 +1,73 @@
+# tiny_model.py
+"""
+Tiny randomly-initialised causal LM + byte-level tokenizer, built fully in memory.
+Used for load tests and CPU smoke runs: no GPU, no download, no HF token.
+Output is gibberish; only the shapes and the plumbing are real.
+"""
+TINY_MODEL_ID = "tiny-random"
+
+# ChatML-style template so apply_chat_template works like the Qwen path
+_CHAT_TEMPLATE = (
+    "{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+def build_tiny_raw_tokenizer():
+    """The byte-level tokenizers.Tokenizer alone (no transformers / torch import)."""
+    from tokenizers import Tokenizer, models, pre_tokenizers, decoders
+
+    alphabet = sorted(pre_tokenizers.ByteLevel.alphabet())
+    vocab = {c: i for i, c in enumerate(alphabet)}
+    raw = Tokenizer(models.BPE(vocab=vocab, merges=[]))
+    raw.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    raw.decoder = decoders.ByteLevel()
+    return raw
+
+def build_tiny_tokenizer():
+    from transformers import PreTrainedTokenizerFast
+
+    tok = PreTrainedTokenizerFast(
+        tokenizer_object=build_tiny_raw_tokenizer(),
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>",
+        additional_special_tokens=["<|im_start|>"],
+    )
+    tok.chat_template = _CHAT_TEMPLATE
+    tok.padding_side = "left"
+    return tok
+
+def build_tiny_model(seed: int = 0, hidden_size: int = 64, num_layers: int = 2, max_positions: int = 2048):
+    """Return (model, tok) for a random LLaMA-shaped model on CPU."""
+    import torch
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    tok = build_tiny_tokenizer()
+    torch.manual_seed(seed)
+    cfg = LlamaConfig(
+        vocab_size=len(tok),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=num_layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=max_positions,
+        bos_token_id=None,
+        eos_token_id=tok.eos_token_id,
+        pad_token_id=tok.pad_token_id,
+    )
+    model = LlamaForCausalLM(cfg)
+    model.generation_config.pad_token_id = tok.pad_token_id
+    model.generation_config.eos_token_id = tok.eos_token_id
+    model.eval()
+    return model, tok
+
+def save_tiny_adapter(path: str, seed: int = 1, base_seed: int = 0, r: int = 4) -> str:
+    """Write a random (non-zero) LoRA adapter for build_tiny_model(base_seed) to `path`."""
+    import torch
+    from peft import LoraConfig, get_peft_model
+
+    model, _ = build_tiny_model(seed=base_seed)
+    torch.manual_seed(seed)
+    cfg = LoraConfig(r=r, target_modules=["q_proj", "v_proj"], init_lora_weights=False)
+    get_peft_model(model, cfg).save_pretrained(path)
+    return path
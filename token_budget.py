@@ -0,0 +1,50 @@
+# token_budget.py
+"""
+Token counts for context trimming in a process that holds no model.
+
+With BACKEND "server" or "pool" the model runs in another process; importing
+hf_backend here would pull torch / transformers / peft into the Streamlit
+process and apply the CPU profile (torch threads, core pinning) to the UI.
+This reads only the base's tokenizer.json (with `tokenizers`) and config.json
+(context window). The chat template is not rendered: MESSAGE_OVERHEAD covers
+the role header + end of turn that ChatML / Llama 3 style templates add per
+message. Without the files (offline, gated repo) it falls back to the Ollama
+estimate of ~4 characters per token.
+"""
+import json
+import os
+from typing import Callable, Dict, Tuple
+
+from tiny_model import TINY_MODEL_ID, build_tiny_raw_tokenizer
+
+MESSAGE_OVERHEAD = 6      # <|im_start|>role\n ... <|im_end|>\n, <|start_header_id|>role<|end_header_id|>\n\n ... <|eot_id|>
+DEFAULT_WINDOW = 8192     # hf_backend.context_window's default
+_counters: Dict[str, Tuple[Callable[[str], int], int]] = {}
+
+def _file(base_id: str, name: str) -> str:
+    if os.path.isdir(base_id):
+        return os.path.join(base_id, name)
+    from huggingface_hub import hf_hub_download
+
+    return hf_hub_download(base_id, name)
+
+def counter(base_id: str) -> Tuple[Callable[[str], int], int]:
+    """(count(text) -> tokens of one message incl. MESSAGE_OVERHEAD, context window) for base_id."""
+    if base_id not in _counters:
+        _counters[base_id] = _load(base_id)
+    return _counters[base_id]
+
+def _load(base_id: str) -> Tuple[Callable[[str], int], int]:
+    if base_id == TINY_MODEL_ID or base_id.startswith(TINY_MODEL_ID + ":"):
+        tok, window = build_tiny_raw_tokenizer(), 2048
+    else:
+        try:
+            from tokenizers import Tokenizer
+
+            tok = Tokenizer.from_file(_file(base_id, "tokenizer.json"))
+            with open(_file(base_id, "config.json"), encoding="utf-8") as f:
+                window = int(json.load(f).get("max_position_embeddings") or DEFAULT_WINDOW)
+        except Exception as e:
+            print(f"[tokens] {base_id}: no tokenizer.json ({type(e).__name__}); estimating ~4 chars/token")
+            return (lambda text: (len(text) + 3) // 4 + MESSAGE_OVERHEAD), DEFAULT_WINDOW
+    return (lambda text: len(tok.encode(text, add_special_tokens=False).ids) + MESSAGE_OVERHEAD), window
@@ -0,0 +1,237 @@
+# tracing.py
+"""
+Per-request traces and Prometheus-style metrics for the inference path.
+
+A Trace is created by whoever owns a request (chat_core for the app, server.py
+for HTTP) and handed down to the backend, which fills `trace.metrics` and adds
+spans; nothing per-request lives in module globals. Spans:
+
+    chat_template, tokenize, prefix_lookup   prompt preparation (chat_template: the session's
+                                             token ids, only new messages rendered)
+    queue, batch_queue                       waiting for an admission slot / a scheduler row
+    prefill                                  generation start -> first token
+    decode_step                              one per model step (attr tokens: >1 for speculative)
+    detokenize                               many short interleaved intervals, summed into
+                                             one span with a `count`
+
+UI render time is not a span: the app reads the stream on a helper thread
+(ui.coalesce_stream), so the trace finishes before the last chunks are drawn;
+coalesce_stream adds it to the turn's metrics as ui_flush_ms.
+
+finish() feeds the process-wide histograms (TTFT, TPOT, end-to-end, queue wait)
+and counters, and appends the trace as one JSON line to TRACE_PATH if set.
+render() returns them in the Prometheus text format; server.py serves it on
+GET /metrics, the Streamlit app on a small side port (config.METRICS_PORT).
+"""
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence
+
+_config = {"trace_path": None}
+_write_lock = threading.Lock()
+_servers: Dict = {}
+
+def _labels(pairs) -> str:
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name, self.help = name, help
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + \
+               [f"{self.name}{_labels(k)} {v:g}" for k, v in items]
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float]):
+        self.name, self.help = name, help
+        self.buckets = sorted(buckets)
+        self._series: Dict[tuple, List] = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            s = self._series.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(s)) for k, s in self._series.items())
+        for key, s in items:
+            for b, n in zip(self.buckets, s):
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', f'{b:g}'),))} {n}")
+            lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {s[-1]}")
+            lines.append(f"{self.name}_sum{_labels(key)} {s[-2]:.6f}")
+            lines.append(f"{self.name}_count{_labels(key)} {s[-1]}")
+        return lines
+
+TTFT = Histogram("chat_ttft_seconds", "Request start to first generated token",
+                 (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+TPOT = Histogram("chat_tpot_seconds", "Time per output token, observed per decode step",
+                 (0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64))
+E2E = Histogram("chat_e2e_seconds", "Request start to last chunk handed to the client",
+                (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160))
+QUEUE = Histogram("chat_queue_wait_seconds", "Wait for an admission slot / scheduler row",
+                  (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+REQUESTS = Counter("chat_requests_total", "Finished requests by stop reason")
+PROMPT_TOKENS = Counter("chat_prompt_tokens_total", "Prompt tokens")
+CACHED_TOKENS = Counter("chat_cached_prompt_tokens_total", "Prompt tokens served from the prefix cache")
+GEN_TOKENS = Counter("chat_generated_tokens_total", "Generated tokens")
+UI_RENDER = Histogram("chat_ui_history_render_seconds", "Chat history render per Streamlit rerun",
+                      (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+POOL_BUSY = Counter("chat_pool_worker_busy_seconds_total", "Time each pool worker had a request in flight")
+POOL_REQUESTS = Counter("chat_pool_worker_requests_total", "Requests routed to each pool worker, by route")
+POOL_RESTARTS = Counter("chat_pool_worker_restarts_total", "Pool worker processes restarted after a crash")
+METRICS = (TTFT, TPOT, E2E, QUEUE, REQUESTS, PROMPT_TOKENS, CACHED_TOKENS, GEN_TOKENS, UI_RENDER,
+           POOL_BUSY, POOL_REQUESTS, POOL_RESTARTS)
+
+def render() -> str:
+    return "\n".join(line for m in METRICS for line in m.render()) + "\n"
+
+def configure(trace_path: Optional[str] = None):
+    """Append every finished trace to this JSONL file (None = off)."""
+    _config["trace_path"] = trace_path
+
+class Trace:
+    """One request: spans, per-request metrics and the timestamps the histograms need."""
+    def __init__(self, backend: str, model: Optional[str] = None, request_id: Optional[str] = None):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.backend = backend
+        self.model = model
+        self.metrics: Dict = {}
+        self.spans: List[Dict] = []
+        self.t0 = time.perf_counter()
+        self.started = time.time()
+        self.t_first: Optional[float] = None
+        self.finished = False
+        self._totals: Dict[str, List] = {}  # name -> [seconds, count]
+        self._steps: List[tuple] = []       # (seconds, tokens) per decode step
+
+    def add_span(self, name: str, start: float, end: float, **attrs):
+        """start / end are time.perf_counter() values."""
+        self.spans.append({"name": name, "start_ms": round((start - self.t0) * 1000.0, 3),
+                           "dur_ms": round((end - start) * 1000.0, 3), **attrs})
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, time.perf_counter(), **attrs)
+
+    def accumulate(self, name: str, seconds: float, count: int = 1):
+        t = self._totals.setdefault(name, [0.0, 0])
+        t[0] += seconds
+        t[1] += count
+
+    def first_token(self, when: Optional[float] = None):
+        if self.t_first is None:
+            self.t_first = when if when is not None else time.perf_counter()
+
+    def decode_timeline(self, start: float, times: Sequence[float], tokens: Optional[Sequence[int]] = None):
+        """prefill span (start -> first token) and one decode_step span per later token time."""
+        if not times:
+            return
+        self.first_token(times[0])
+        self.add_span("prefill", start, times[0])
+        for i in range(1, len(times)):
+            n = tokens[i] if tokens else 1
+            self.add_span("decode_step", times[i - 1], times[i], tokens=n)
+            self._steps.append((times[i] - times[i - 1], n))
+
+    def export(self) -> Dict:
+        """What absorb() needs, picklable: for a request served in another process (worker_pool.py)."""
+        totals = [{"name": k, "dur_ms": round(s * 1000.0, 3), "count": n} for k, (s, n) in self._totals.items()]
+        return {"t0": self.t0, "spans": self.spans + totals, "steps": list(self._steps), "metrics": dict(self.metrics)}
+
+    def absorb(self, exported: Dict, **attrs):
+        """Merge another process's trace of this request: its spans (shifted onto this
+        trace's clock; perf_counter is system-wide), decode steps and metrics."""
+        shift = (exported["t0"] - self.t0) * 1000.0
+        for s in exported["spans"]:
+            self.spans.append(dict(s, **attrs, start_ms=round(s["start_ms"] + shift, 3)) if "start_ms" in s
+                              else dict(s, **attrs))
+        self._steps.extend(exported["steps"])
+        self.metrics.update(exported["metrics"])
+
+    def to_dict(self) -> Dict:
+        totals = [{"name": k, "dur_ms": round(s * 1000.0, 3), "count": n} for k, (s, n) in self._totals.items()]
+        return {"request_id": self.request_id, "backend": self.backend, "model": self.model,
+                "started": self.started, "spans": self.spans + totals, "metrics": self.metrics}
+
+    def finish(self, **metrics):
+        """Close the request: record histograms / counters and write the JSONL line (once).
+        A request that ends without a stop_reason (consumer went away) counts as cancelled."""
+        if self.finished:
+            return
+        self.finished = True
+        self.metrics.update(metrics)
+        end = time.perf_counter()
+        self.metrics["e2e_ms"] = (end - self.t0) * 1000.0
+        b = {"backend": self.backend}
+        if self.t_first is not None:
+            TTFT.observe(self.t_first - self.t0, **b)
+        for seconds, n in self._steps:
+            TPOT.observe(seconds / max(n, 1), **b)
+        E2E.observe(end - self.t0, **b)
+        if self.metrics.get("queue_ms") is not None:
+            QUEUE.observe(self.metrics["queue_ms"] / 1000.0, **b)
+        REQUESTS.inc(stop_reason=self.metrics.get("stop_reason") or "cancelled", **b)
+        PROMPT_TOKENS.inc(self.metrics.get("prompt_tokens") or 0, **b)
+        CACHED_TOKENS.inc(self.metrics.get("cached_tokens") or 0, **b)
+        GEN_TOKENS.inc(self.metrics.get("gen_tokens") or 0, **b)
+        path = _config["trace_path"]
+        if path:
+            line = json.dumps(self.to_dict(), ensure_ascii=False, default=str)
+            with _write_lock, open(path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_metrics_server(host: str, port: int) -> bool:
+    """Serve GET /metrics from a daemon thread (once per process). False if the port is taken."""
+    if (host, port) in _servers:
+        return True
+    try:
+        httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        print(f"[metrics] not serving /metrics on {host}:{port}: {e}")
+        return False
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="metrics", daemon=True).start()
+    _servers[(host, port)] = httpd
+    print(f"[metrics] http://{host}:{port}/metrics")
+    return True
@@ -1,16 +1,23 @@
 # ui.py
 import json
+import queue
+import threading
+import time
+from functools import partial
 import streamlit as st
-from config import MODEL
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from config import MODEL, MODEL_CHOICES, HISTORY_RECENT_MESSAGES, HISTORY_PAGE_SIZE
+from tracing import UI_RENDER
 
 def render_header():
+    model = st.session_state.get("model_choice", MODEL)
     st.markdown(
         """
         <div style="display:flex;align-items:center;justify-content:space-between;margin-bottom:0.5rem;">
           <div style="display:flex;align-items:center;gap:.6rem;">
             <span style="font-size:1.8rem;">💬 Chatbot</span>
             <span style="font-size:.85rem;padding:.15rem .5rem;border:1px solid #ddd;border-radius:999px;color:#555;">
-              model: <b>""" + MODEL + """</b>
+              model: <b>""" + model + """</b>
             </span>
           </div>
         </div>
@@ -22,14 +29,33 @@ def render_header():
 def render_sidebar():
     st.subheader("Session")
     if st.button("🧹 Clear chat", use_container_width=True):
+        token = st.session_state.pop("__cancel", None)
+        if token is not None:
+            token.cancel("cleared")  # abort a generation still running for this session
         st.session_state.pop("messages", None)
         st.session_state.pop("__last_trim_info", None)
         st.session_state.pop("__last_metrics", None)
-        st.session_state.pop("full_message", None)
+        st.session_state.pop("__stream_parts", None)
+        st.session_state.pop("__history_pages", None)
+        st.session_state.pop("__history_md", None)
         st.rerun()
 
     st.markdown("---")
     st.subheader("Options")
+    labels = list(MODEL_CHOICES)
+    st.selectbox(
+        "Model",
+        labels,
+        index=labels.index(MODEL),
+        key="model_choice",
+        help="Picked per message; loaded models stay resident up to HF_MODEL_MEMORY_GB.",
+    )
+    mode = st.radio(
+        "Response mode",
+        ["Explain", "Answer only"],
+        horizontal=True,
+        help="Answer only scores the A/B/C/D letters in a single forward pass (no decoding).",
+    )
     use_system = st.checkbox("Use system prompt", value=False)
     prompt_value = """You are a medical expert. Answer the MCQ and briefly justify in 3–6 sentences.
 
@@ -58,20 +84,135 @@ def render_sidebar():
 
     st.markdown("---")
     st.subheader("Transcript")
-    export = [{"role": m["role"], "content": m["content"]} for m in st.session_state.get("messages", [])]
     st.download_button(
         "⬇️ Download chat.json",
-        data=json.dumps(export, ensure_ascii=False, indent=2),
+        data=partial(transcript_json, st.session_state.get("messages", [])),  # serialized only on click
         file_name="chat.json",
         mime="application/json",
         use_container_width=True,
     )
 
-    return use_system, system_prompt_text
+    return use_system, system_prompt_text, mode == "Answer only"
+
+def transcript_json(messages) -> str:
+    export = [{"role": m["role"], "content": m["content"]} for m in messages]
+    return json.dumps(export, ensure_ascii=False, indent=2)
+
+def _pump(stream, q: "queue.Queue", stop: threading.Event):
+    try:
+        for chunk in stream:
+            q.put(chunk)
+            if stop.is_set():
+                break  # the page stopped reading
+    except Exception as e:
+        q.put(_Failed(e))
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+        q.put(_END)
+
+class _Failed:
+    def __init__(self, error: Exception):
+        self.error = error
+
+_END = object()
+
+def coalesce_stream(stream, flush_ms: float, flush_chars: int):
+    """
+    Re-chunk a token stream for st.write_stream: the first chunk goes out at once,
+    then pieces are buffered until flush_ms has passed or flush_chars are waiting,
+    so the page redraws a few times a second instead of once per token.
+    The stream is read on a helper thread (with this session's script context), so
+    buffered text still goes out flush_ms later when the next token is slow to come.
+    The time st.write_stream spends rendering the chunks (between next() calls) is
+    added to the turn's metrics as ui_flush_ms / ui_flushes.
+    """
+    chunks = _coalesce(stream, flush_ms, flush_chars)
+    flush_s, flushes = 0.0, 0
+    try:
+        for chunk in chunks:
+            t = time.perf_counter()
+            yield chunk
+            flush_s += time.perf_counter() - t
+            flushes += 1
+    finally:
+        chunks.close()
+        metrics = st.session_state.get("__last_metrics")
+        if metrics is not None:
+            metrics.update(ui_flush_ms=flush_s * 1000.0, ui_flushes=flushes)
+
+def _coalesce(stream, flush_ms: float, flush_chars: int):
+    q: "queue.Queue" = queue.Queue()
+    stop = threading.Event()
+    reader = threading.Thread(target=_pump, args=(stream, q, stop), name="stream-reader", daemon=True)
+    add_script_run_ctx(reader, get_script_run_ctx())
+    reader.start()
+    parts, size, last = [], 0, None
+    try:
+        while True:
+            try:
+                item = q.get(timeout=max(last + flush_ms / 1000 - time.perf_counter(), 0) if parts else None)
+            except queue.Empty:  # nothing new within flush_ms: show what is waiting
+                yield "".join(parts)
+                parts, size, last = [], 0, time.perf_counter()
+                continue
+            if item is _END:
+                break
+            if isinstance(item, _Failed):
+                raise item.error
+            if not isinstance(item, str):
+                yield item
+                continue
+            parts.append(item)
+            size += len(item)
+            now = time.perf_counter()
+            if last is None or size >= flush_chars or (now - last) * 1000 >= flush_ms:
+                yield "".join(parts)
+                parts, size, last = [], 0, now
+        if parts:
+            yield "".join(parts)
+    finally:
+        stop.set()
+
+def _page_markdown(messages, page: int, size: int) -> str:
+    """One markdown block per page of old messages, built once per session (history only grows)."""
+    cache = st.session_state.setdefault("__history_md", {})
+    md = cache.get((page, size))
+    if md is None:
+        lines = []
+        for m in messages[page * size:(page + 1) * size]:
+            who = "You" if m["role"] == "user" else m["role"].capitalize()
+            lines.append(f"**{who}:**\n\n{m['content']}")
+        md = cache[(page, size)] = "\n\n---\n\n".join(lines)
+    return md
 
-def render_chat_history():
+def _open_pages(delta: int):
+    st.session_state["__history_pages"] = max(0, st.session_state.get("__history_pages", 0) + delta)
+
+def render_chat_history(recent: int = HISTORY_RECENT_MESSAGES, page_size: int = HISTORY_PAGE_SIZE):
+    """
+    The last `recent` (up to recent + page_size - 1) messages as chat bubbles; older
+    ones split into fixed pages that stay collapsed until "Show earlier" opens them,
+    each page one cached markdown block. Render time goes to tracing.UI_RENDER.
+    """
+    t0 = time.perf_counter()
+    messages = st.session_state.get("messages", [])
+    # page boundaries are fixed indexes, so a page's markdown never changes once it is old
+    split = max(0, (len(messages) - recent) // page_size * page_size)
+    hidden = split // page_size
+    opened = min(st.session_state.get("__history_pages", 0), hidden)
     chat_area = st.container()
     with chat_area:
-        for m in st.session_state.get("messages", []):
+        if opened < hidden:
+            st.button(f"Show earlier messages ({(hidden - opened) * page_size} hidden)",
+                      on_click=_open_pages, args=(1,), key="__history_more")
+        if opened:
+            st.button("Collapse earlier messages", on_click=_open_pages, args=(-opened,), key="__history_less")
+        for page in range(hidden - opened, hidden):
+            with st.expander(f"Messages {page * page_size + 1}–{(page + 1) * page_size}", expanded=True):
+                st.markdown(_page_markdown(messages, page, page_size))
+        for m in messages[split:]:
             with st.chat_message(m["role"]):
                 st.markdown(m["content"])
+    UI_RENDER.observe(time.perf_counter() - t0)
@@ -0,0 +1,489 @@
+# worker_pool.py
+"""
+Multi-process model workers behind one router (BACKEND = "pool").
+
+    python worker_pool.py --base tiny-random --workers 2          # CPU self-test: affinity, crash restart
+    python worker_pool.py --workers 2 --devices cuda:0,cuda:1     # default model, one GPU each
+
+Each worker is a fresh Python process (`worker_pool.py --worker <spec>`) that
+owns its own hf_backend: model registry, scheduler and prefix cache. It is pinned
+before torch loads, to a GPU through CUDA_VISIBLE_DEVICES and/or to a core set
+(one NUMA node / socket) through sched_setaffinity plus the CPU thread settings.
+safetensors checkpoints are memory-mapped, so workers loading the same files
+share the page cache. Workers are not multiprocessing children: spawn would
+re-import `__main__`, which under Streamlit is the app script.
+
+The router talks to every worker over a socketpair wrapped in a
+multiprocessing Connection. A request is ("run", rid, fn, messages, kwargs) for
+hf_backend.stream_generate / score_answer. Chunks stream back as ("chunk", rid,
+text) and the request ends with ("done", rid, trace) or ("error", rid, ...).
+One router thread reads all connections. A worker that dies (EOF on its
+connection) fails its in-flight requests and is restarted; the old process is
+reaped on a thread of its own. A request that had not streamed anything yet is
+retried on another worker. A request that hears nothing from its worker for
+timeout_s fails and is cancelled there.
+
+Routing: a session goes back to the worker that served it last, so its prefix
+cache (the conversation so far) stays warm. The router falls back to the
+least-loaded worker when that one is dead or has max_inflight requests running.
+Utilization (busy time / uptime) and requests per route are in stats(), and
+/metrics has them as counters.
+"""
+import argparse
+import glob
+import json
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.connection import Connection, wait
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from admission import CancelToken, Rejected
+from tracing import POOL_BUSY, POOL_REQUESTS, POOL_RESTARTS, Trace
+
+MAX_SESSIONS = 10000   # affinity entries kept (least recently used dropped)
+MAX_RESTARTS = 3       # consecutive crashes before ready; then the worker stays down
+_FNS = ("stream_generate", "score_answer")
+
+# ---- worker process ----
+def _worker_main(spec: Dict):
+    wid, device, cores, warm = spec["wid"], spec["device"], spec["cores"], spec["warm"]
+    conn = Connection(spec["fd"])
+    if device and device.startswith("cuda"):
+        os.environ["CUDA_VISIBLE_DEVICES"] = device.partition(":")[2] or "0"
+    elif device == "cpu":
+        os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    t0 = time.perf_counter()
+    from config import HF_MAX_CONCURRENCY, HF_MAX_QUEUE, HF_QUEUE_TIMEOUT_S, HF_LOAD_IN_4BIT, HF_MODEL_MEMORY_GB
+    from config import HF_CPU_PROFILE, HF_CPU_THREADS, HF_CPU_INTEROP_THREADS, HF_MERGED_DIR
+    from config import HF_CHAT_TOKENS_CHECK, HF_CHAT_TOKEN_SESSIONS
+    import hf_backend
+    from cpu_profile import parse_cores
+
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, parse_cores(cores))  # also on GPU hosts: keep to the GPU's NUMA node
+    hf_backend.configure_admission(HF_MAX_CONCURRENCY, HF_MAX_QUEUE, HF_QUEUE_TIMEOUT_S)
+    hf_backend.configure_cpu(HF_CPU_PROFILE, HF_CPU_THREADS, HF_CPU_INTEROP_THREADS, cores)
+    hf_backend.configure_chat_tokens(HF_CHAT_TOKENS_CHECK, HF_CHAT_TOKEN_SESSIONS)
+    if warm:
+        model, tok, name = hf_backend.load_hf(warm["base"], warm.get("adapter"), HF_LOAD_IN_4BIT,
+                                              HF_MODEL_MEMORY_GB, HF_MERGED_DIR)
+        hf_backend.warm_up(model, tok, name)
+    send_lock = threading.Lock()
+    running: Dict[str, CancelToken] = {}
+
+    def _send(msg):
+        with send_lock:
+            conn.send(msg)
+
+    def _run(rid: str, fn: str, messages, kwargs: Dict):
+        token = running[rid]
+        trace = Trace("hf", model=kwargs.get("base_id"), request_id=rid)
+        try:
+            for chunk in getattr(hf_backend, fn)(messages, cancel=token, trace=trace, **kwargs):
+                _send(("chunk", rid, chunk))
+            _send(("done", rid, trace.export()))
+        except Rejected as e:
+            _send(("error", rid, "rejected", str(e)))
+        except Exception as e:
+            _send(("error", rid, "error", f"{type(e).__name__}: {e}"))
+        finally:
+            running.pop(rid, None)
+
+    _send(("ready", None, {"pid": os.getpid(), "load_s": time.perf_counter() - t0,
+                           "cores": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None}))
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break  # router gone
+        if msg is None:
+            break
+        if msg[0] == "cancel":
+            token = running.get(msg[1])
+            if token is not None:
+                token.cancel("router")
+        elif msg[0] == "run":
+            _, rid, fn, messages, kwargs = msg
+            running[rid] = CancelToken()
+            threading.Thread(target=_run, args=(rid, fn, messages, kwargs), name=f"job-{rid[:8]}", daemon=True).start()
+    for token in list(running.values()):
+        token.cancel("shutdown")
+
+# ---- router side ----
+class _Worker:
+    def __init__(self, wid: int, device: Optional[str], cores):
+        self.wid, self.device, self.cores = wid, device, cores
+        self.proc = None
+        self.conn = None
+        self.ready = False
+        self.alive = False
+        self.info: Dict = {}
+        self.inflight: Dict[str, "queue.Queue"] = {}
+        self.requests = 0
+        self.errors = 0
+        self.restarts = 0
+        self.crashes_in_row = 0
+        self.started = time.monotonic()
+        self.busy_s = 0.0
+        self.busy_since: Optional[float] = None
+        self.send_lock = threading.Lock()
+
+    def send(self, msg) -> bool:
+        try:
+            with self.send_lock:
+                self.conn.send(msg)
+            return True
+        except (OSError, ValueError):
+            return False  # pipe closed: the router thread is handling the crash
+
+    def utilization(self, now: float) -> float:
+        busy = self.busy_s + (now - self.busy_since if self.busy_since is not None else 0.0)
+        return busy / max(now - self.started, 1e-9)
+
+class WorkerPool:
+    def __init__(self, n: int = 2, devices: Optional[Sequence[str]] = None, cores: Optional[Sequence] = None,
+                 max_inflight: int = 8, warm: Optional[Dict] = None, timeout_s: Optional[float] = 120.0):
+        """
+        devices: per worker "cuda:<i>" / "cpu" / None (inherit). cores: per worker core
+        set ("0-15" or a list); None on a CPU-only pool splits this process's cores evenly.
+        warm: {"base", "adapter"} each worker loads and warms before reporting ready.
+        timeout_s: longest wait for a request's next message (queue + prefill included); None = no limit.
+        """
+        if cores is None and _cpu_only(devices) and hasattr(os, "sched_getaffinity"):
+            cores = split_cores(n)
+        self.max_inflight = max_inflight
+        self.timeout_s = timeout_s
+        self.warm = warm
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._affinity: "OrderedDict[str, int]" = OrderedDict()
+        self._closed = False
+        self.workers = [_Worker(i, devices[i] if devices else None, cores[i] if cores else None) for i in range(n)]
+        for w in self.workers:
+            self._spawn(w)
+        self._router = threading.Thread(target=self._route_loop, name="pool-router", daemon=True)
+        self._router.start()
+
+    def _spawn(self, w: _Worker):
+        parent, child = socket.socketpair()
+        spec = {"wid": w.wid, "device": w.device, "cores": w.cores, "warm": self.warm, "fd": child.fileno()}
+        w.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(spec)],
+                                  pass_fds=(child.fileno(),), cwd=os.path.dirname(os.path.abspath(__file__)))
+        child.close()
+        w.conn, w.ready, w.alive = Connection(parent.detach()), False, True
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until every live worker has loaded (or timeout); True if all are up."""
+        deadline = time.monotonic() + timeout if timeout else None
+        with self._ready:
+            while not all(w.ready or not w.alive for w in self.workers):
+                left = deadline - time.monotonic() if deadline else None
+                if left is not None and left <= 0:
+                    return False
+                self._ready.wait(left if left is not None else 1.0)
+            return all(w.ready for w in self.workers)
+
+    # ---- routing ----
+    def _pick(self, session: Optional[str], exclude=()) -> Tuple[_Worker, str]:
+        with self._lock:
+            live = [w for w in self.workers if w.alive and w.wid not in exclude]
+            if not live:
+                raise Rejected("no model worker is running")
+            w = self.workers[self._affinity[session]] if session in self._affinity else None
+            route = "affinity"
+            if w is None or not w.alive or w.wid in exclude or len(w.inflight) >= self.max_inflight:
+                route = "new" if w is None else "fallback"
+                w = min(live, key=lambda x: (len(x.inflight), not x.ready, x.requests))
+            if session is not None:
+                self._affinity[session] = w.wid
+                self._affinity.move_to_end(session)
+                if len(self._affinity) > MAX_SESSIONS:
+                    self._affinity.popitem(last=False)
+            return w, route
+
+    def _enter(self, w: _Worker, rid: str, q: "queue.Queue"):
+        with self._lock:
+            if not w.inflight:
+                w.busy_since = time.monotonic()
+            w.inflight[rid] = q
+            w.requests += 1
+
+    def _leave(self, w: _Worker, rid: str):
+        with self._lock:
+            if w.inflight.pop(rid, None) is not None and not w.inflight and w.busy_since is not None:
+                busy = time.monotonic() - w.busy_since
+                w.busy_s += busy
+                w.busy_since = None
+                POOL_BUSY.inc(busy, worker=str(w.wid))
+
+    def stream(self, fn: str, messages, kwargs: Dict, session: Optional[str] = None,
+               cancel: Optional[CancelToken] = None, trace: Optional[Trace] = None):
+        """
+        Generator with hf_backend's streaming interface, served by a worker process.
+        kwargs are fn's keyword arguments (picklable: no cancel / trace). The worker's
+        spans and metrics are merged into `trace`. Raises admission.Rejected when no
+        worker can take the request or the worker's own admission rejects it.
+        """
+        if fn not in _FNS:
+            raise ValueError(f"fn must be one of {_FNS}")
+        trace = trace if trace is not None else Trace("hf", model=kwargs.get("base_id"))
+        cancel = cancel if cancel is not None else CancelToken()
+        rid = trace.request_id
+        tried = []
+        while True:
+            w, route = self._pick(session, exclude=tried)
+            tried.append(w.wid)
+            POOL_REQUESTS.inc(worker=str(w.wid), route=route)
+            trace.metrics.update(worker=w.wid, route=route)
+            q: "queue.Queue" = queue.Queue()
+            self._enter(w, rid, q)
+            sent, kind, item = False, "crashed", None
+            last = time.monotonic()
+            try:
+                if w.send(("run", rid, fn, messages, kwargs)):
+                    while True:
+                        try:
+                            kind, item = q.get(timeout=0.05)
+                        except queue.Empty:
+                            if cancel.cancelled:
+                                kind = "cancelled"
+                                trace.metrics.setdefault("stop_reason", "cancelled")
+                                return
+                            if self.timeout_s is not None and time.monotonic() - last > self.timeout_s:
+                                kind = "stalled"
+                                break
+                            continue
+                        last = time.monotonic()
+                        if kind != "chunk":
+                            break
+                        if not sent:
+                            trace.first_token()
+                            sent = True
+                        yield item
+            finally:
+                if kind not in ("done", "rejected", "error", "crashed"):
+                    w.send(("cancel", rid))  # consumer went away or cancelled: stop decoding there
+                self._leave(w, rid)
+            if kind == "done":
+                trace.absorb(item, worker=w.wid)
+                return
+            if kind == "rejected":
+                raise Rejected(item)
+            if kind == "error":
+                w.errors += 1
+                raise RuntimeError(f"model worker {w.wid}: {item}")
+            if kind == "stalled":
+                w.errors += 1
+                trace.metrics["stop_reason"] = "error"
+                raise Rejected(f"model worker {w.wid} sent nothing for {self.timeout_s:.0f}s; retry")
+            # crashed: retry on another worker if nothing reached the caller yet
+            if sent or len(tried) >= len(self.workers):
+                trace.metrics["stop_reason"] = "error"
+                raise Rejected(f"model worker {w.wid} crashed; retry")
+
+    # ---- router thread ----
+    def _route_loop(self):
+        while not self._closed:
+            with self._lock:
+                by_handle = {}
+                for w in self.workers:
+                    if w.alive:
+                        by_handle[w.conn] = w
+            if not by_handle:
+                time.sleep(0.2)
+                continue
+            for h in wait(list(by_handle), timeout=0.5):
+                w = by_handle[h]
+                if not w.alive:
+                    continue
+                try:
+                    while w.conn.poll():
+                        self._deliver(w, w.conn.recv())
+                except (EOFError, OSError):
+                    self._crashed(w)  # connection closed: the process is gone
+
+    def _deliver(self, w: _Worker, msg):
+        kind, rid = msg[0], msg[1]
+        if kind == "ready":
+            print(f"[pool] worker {w.wid} ready (pid {msg[2]['pid']}, {w.device or 'default device'}, "
+                  f"{len(msg[2]['cores'] or [])} cores, {msg[2]['load_s']:.1f}s)")
+            with self._ready:
+                w.ready, w.info, w.crashes_in_row = True, msg[2], 0
+                self._ready.notify_all()
+            return
+        q = w.inflight.get(rid)
+        if q is None:
+            return  # caller already gone
+        if kind == "chunk":
+            q.put(("chunk", msg[2]))
+        elif kind == "done":
+            q.put(("done", msg[2]))
+        else:
+            q.put((msg[2], msg[3]))  # ("rejected" | "error", detail)
+
+    def _crashed(self, w: _Worker):
+        if self._closed:
+            return
+        threading.Thread(target=_reap, args=(w.wid, w.proc), name=f"pool-reap-{w.wid}", daemon=True).start()
+        with self._ready:
+            failed = list(w.inflight.values())
+            w.crashes_in_row += 1
+            restart = w.crashes_in_row <= MAX_RESTARTS
+            try:
+                w.conn.close()
+            except OSError:
+                pass
+            if restart:
+                w.restarts += 1
+                self._spawn(w)  # under the lock: wait_ready() never sees a gap with no process
+            else:
+                w.alive, w.ready = False, False
+            self._ready.notify_all()
+        for q in failed:
+            q.put(("crashed", None))
+        if restart:
+            POOL_RESTARTS.inc(worker=str(w.wid))
+            print(f"[pool] worker {w.wid} exited; restarted, {len(failed)} request(s) failed")
+        else:
+            print(f"[pool] worker {w.wid} exited {w.crashes_in_row} times in a row; giving up on it")
+
+    # ---- reporting / shutdown ----
+    def stats(self) -> List[Dict]:
+        now = time.monotonic()
+        with self._lock:
+            return [{"worker": w.wid, "pid": w.proc.pid, "device": w.device, "cores": w.cores,
+                     "alive": w.alive, "ready": w.ready, "inflight": len(w.inflight), "requests": w.requests,
+                     "errors": w.errors, "restarts": w.restarts, "utilization": round(w.utilization(now), 3)}
+                    for w in self.workers]
+
+    def close(self, timeout: float = 5.0):
+        self._closed = True
+        for w in self.workers:
+            if w.alive:
+                w.send(None)
+        for w in self.workers:
+            try:
+                w.proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                w.proc.terminate()
+            w.alive = False
+
+def _reap(wid: int, proc: subprocess.Popen):
+    """Collect a dead worker's exit code (off the router thread); kill it if it hangs instead."""
+    try:
+        code = proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()  # closed its end but hangs: its replacement is already starting
+        code = proc.wait()
+    print(f"[pool] worker {wid} (pid {proc.pid}) exit code {code}")
+
+def _cpu_only(devices: Optional[Sequence[str]]) -> bool:
+    """Whether the workers run on CPU: every configured device "cpu", or inherited devices with
+    no GPU visible (CUDA_VISIBLE_DEVICES="" or no /dev/nvidia*). No torch import in the router."""
+    if devices:
+        return all(d == "cpu" for d in devices)
+    if os.environ.get("CUDA_VISIBLE_DEVICES") == "":
+        return True
+    return not glob.glob("/dev/nvidia[0-9]*")
+
+def split_cores(n: int) -> Optional[List[List[int]]]:
+    """This process's cores in n contiguous groups (None when there are fewer cores than workers)."""
+    ids = sorted(os.sched_getaffinity(0))
+    if len(ids) < n:
+        return None
+    step = len(ids) // n
+    return [ids[i * step:(i + 1) * step] for i in range(n)]
+
+# ---- CPU self-test ----
+def _selftest(args) -> bool:
+    from config import HF_MAX_NEW_TOKENS
+    devices = args.devices.split(",") if args.devices else None
+    cores = args.cores.split(";") if args.cores else None
+    warm = {"base": args.base, "adapter": args.adapter}
+    pool = WorkerPool(args.workers, devices, cores, max_inflight=args.max_inflight, warm=warm)
+    ok = True
+    try:
+        t = time.perf_counter()
+        print(f"[pool] ready={pool.wait_ready(600)} in {time.perf_counter() - t:.1f}s")
+        kwargs = dict(base_id=args.base, adapter_path=args.adapter, load_in_4bit=False,
+                      max_new_tokens=min(args.max_new, HF_MAX_NEW_TOKENS), batching=True)
+        seen: Dict[str, set] = {}
+        lock = threading.Lock()
+
+        def _session(s: int):
+            sid, history = f"s{s}", []
+            for turn in range(args.turns):
+                history.append({"role": "user", "content": f"Session {s}, question {turn}: which nerve?"})
+                trace = Trace("hf", model=args.base)
+                text = "".join(pool.stream("stream_generate", history, kwargs, session=sid, trace=trace))
+                history.append({"role": "assistant", "content": text})
+                with lock:
+                    seen.setdefault(sid, set()).add(trace.metrics["worker"])
+
+        threads = [threading.Thread(target=_session, args=(s,)) for s in range(args.sessions)]
+        t = time.perf_counter()
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        sticky = sum(len(v) == 1 for v in seen.values())
+        used = sorted({w for v in seen.values() for w in v})
+        print(f"[pool] {args.sessions}x{args.turns} turns in {time.perf_counter() - t:.1f}s • "
+              f"{sticky}/{len(seen)} sessions stayed on one worker • workers used {used}")
+        ok &= len(seen) == args.sessions and len(used) == min(args.workers, args.sessions)
+
+        if args.crash:
+            victim = pool.workers[0]
+            stream = pool.stream("stream_generate", [{"role": "user", "content": "Crash test"}],
+                                 dict(kwargs, max_new_tokens=1500), session="s0")
+            next(stream)
+            os.kill(victim.proc.pid, 9)
+            try:
+                for _ in stream:
+                    pass
+                ok = False
+                print("[pool] stream survived a killed worker?")
+            except Rejected as e:
+                print(f"[pool] in-flight request failed as expected: {e}")
+            ok &= pool.wait_ready(600)
+            trace = Trace("hf", model=args.base)
+            text = "".join(pool.stream("stream_generate", [{"role": "user", "content": "After the crash"}],
+                                       kwargs, session="s0", trace=trace))
+            print(f"[pool] after restart: worker {trace.metrics['worker']} answered {len(text)} chars, "
+                  f"worker 0 restarts={victim.restarts}")
+            ok &= victim.restarts == 1 and victim.ready and bool(text)
+        for s in pool.stats():
+            print(f"[pool] worker {s['worker']}: pid {s['pid']} • {s['requests']} requests • "
+                  f"{s['utilization']:.0%} busy • restarts {s['restarts']} • errors {s['errors']}")
+    finally:
+        pool.close()
+    print("[pool] self-test", "passed" if ok else "FAILED")
+    return ok
+
+def main():
+    ap = argparse.ArgumentParser(description="Model worker pool self-test (CPU with --base tiny-random)")
+    ap.add_argument("--worker", default=None, help=argparse.SUPPRESS)  # internal: run one worker process
+    ap.add_argument("--base", default="tiny-random")
+    ap.add_argument("--adapter", default=None)
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--devices", default=None, help="comma separated, e.g. cuda:0,cuda:1")
+    ap.add_argument("--cores", default=None, help="per worker, ';' separated, e.g. '0-7;8-15'")
+    ap.add_argument("--max-inflight", type=int, default=8)
+    ap.add_argument("--sessions", type=int, default=6)
+    ap.add_argument("--turns", type=int, default=3)
+    ap.add_argument("--max-new", type=int, default=32)
+    ap.add_argument("--no-crash", dest="crash", action="store_false", help="skip the kill-and-restart check")
+    args = ap.parse_args()
+    if args.worker:
+        _worker_main(json.loads(args.worker))
+        return
+    raise SystemExit(0 if _selftest(args) else 1)
+
+if __name__ == "__main__":
+    main()